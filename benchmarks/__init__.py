@@ -0,0 +1,11 @@
+"""
+Benchmarks for the overhead of boyle itself.
+
+Run them from the repository root with
+
+    python -m benchmarks --output results.json
+
+and compare the JSON output between releases. Use --quick for a fast
+run with small sizes, and --select to run only benchmarks whose names
+contain a given string.
+"""
@@ -0,0 +1,63 @@
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+
+import boyleworkflow
+
+from benchmarks.common import BENCHMARKS
+
+# Importing the modules registers their benchmarks.
+from benchmarks import bench_make, bench_log, bench_storage  # noqa
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument(
+        "--output", "-o", help="write the results as JSON to this file"
+    )
+    parser.add_argument(
+        "--quick", action="store_true", help="run with small sizes only"
+    )
+    parser.add_argument(
+        "--select",
+        "-k",
+        default="",
+        help="only run benchmarks whose names contain this string",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = []
+    for bench in BENCHMARKS:
+        if args.select not in bench.name:
+            continue
+        if args.quick and not bench.quick:
+            continue
+
+        for measurement in bench.func(quick=args.quick):
+            result = dict(benchmark=bench.name, **measurement)
+            print(json.dumps(result), flush=True)
+            results.append(result)
+
+    report = dict(
+        boyleworkflow=boyleworkflow.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        quick=args.quick,
+        results=results,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
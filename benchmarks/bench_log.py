@@ -0,0 +1,74 @@
+import datetime
+import concurrent.futures
+
+from boyleworkflow.core import Calc, Result
+
+from benchmarks.common import benchmark, measure, temp_env, Timer
+from benchmarks.graphs import SyntheticOp
+
+
+@benchmark("log")
+def bench_log(quick):
+    """Time saving runs and looking up their results."""
+    sizes = [1000] if quick else [1000, 10000]
+    t = datetime.datetime.utcnow()
+
+    for n in sizes:
+        calcs = [
+            Calc(SyntheticOp("op"), [Result("in", f"input {i}")])
+            for i in range(n)
+        ]
+        results = [[Result("out", f"output {i}")] for i in range(n)]
+
+        with temp_env() as (log, storage):
+            save_run = Timer()
+            with save_run.measure():
+                for calc, calc_results in zip(calcs, results):
+                    log.save_run(calc, calc_results, t, t)
+
+            get_result = Timer()
+            with get_result.measure():
+                for calc in calcs:
+                    log.get_result(calc, "out")
+
+            get_results = Timer()
+            with get_results.measure():
+                log.get_results((calc, "out") for calc in calcs)
+
+        yield measure(n, save_run.seconds, case="save_run")
+        yield measure(n, get_result.seconds, case="get_result")
+        yield measure(n, get_results.seconds, case="get_results")
+
+
+@benchmark("log_concurrency")
+def bench_log_concurrency(quick):
+    """
+    Time save_run() and get_result() from many threads at once, with the
+    WAL journal and with the rollback journal SQLite uses by default.
+    """
+    n = 2000 if quick else 20000
+    t = datetime.datetime.utcnow()
+
+    def work(log, i):
+        calc = Calc(SyntheticOp("op"), [Result("in", f"input {i}")])
+        log.save_run(calc, [Result("out", f"output {i}")], t, t)
+        log.get_result(calc, "out")
+
+    for journal_mode in ["wal", "delete"]:
+        for workers in [1, 4, 32]:
+            with temp_env() as (log, storage):
+                log.conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+                timer = Timer()
+                with timer.measure():
+                    with concurrent.futures.ThreadPoolExecutor(
+                        workers
+                    ) as executor:
+                        list(executor.map(lambda i: work(log, i), range(n)))
+
+            yield measure(
+                n,
+                timer.seconds,
+                case="save_run and get_result",
+                journal_mode=journal_mode,
+                workers=workers,
+            )
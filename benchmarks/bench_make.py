@@ -0,0 +1,195 @@
+import itertools
+
+import boyleworkflow
+
+from benchmarks.common import (
+    benchmark,
+    measure,
+    simulate_makespan,
+    temp_env,
+    Timer,
+)
+from benchmarks import graphs
+
+
+def _graph_cases(quick: bool):
+    if quick:
+        return [
+            ("chain", graphs.chain, 1000),
+            ("fan_out", graphs.fan_out, 1000),
+            ("diamonds", graphs.diamonds, 30),
+            ("sweep", graphs.sweep, (20, 5, 2)),
+        ]
+
+    return [
+        ("chain", graphs.chain, 1000),
+        ("chain", graphs.chain, 10000),
+        ("fan_out", graphs.fan_out, 1000),
+        ("fan_out", graphs.fan_out, 10000),
+        ("diamonds", graphs.diamonds, 30),
+        ("diamonds", graphs.diamonds, 1000),
+        ("sweep", graphs.sweep, (200, 5, 2)),
+    ]
+
+
+@benchmark("make")
+def bench_make(quick):
+    """
+    Time make() on graphs of no-op steps, i.e., boyle's own overhead,
+    and then the planning when everything is already made.
+    """
+    for graph, func, size in _graph_cases(quick):
+        requested = func(size)
+        n_comps = len(boyleworkflow.core.get_upstream_sorted(requested))
+
+        with temp_env() as (log, storage):
+            cold_plan = Timer()
+            with cold_plan.measure():
+                boyleworkflow.plan(requested, log, storage)
+
+            cold_make = Timer()
+            with cold_make.measure():
+                boyleworkflow.make(requested, log, storage)
+
+            warm_plan = Timer()
+            with warm_plan.measure():
+                boyleworkflow.plan(requested, log, storage)
+
+            warm_make = Timer()
+            with warm_make.measure():
+                boyleworkflow.make(requested, log, storage)
+
+        params = dict(graph=graph, size=size)
+        yield measure(n_comps, cold_plan.seconds, case="plan cold", **params)
+        yield measure(n_comps, cold_make.seconds, case="make cold", **params)
+        yield measure(n_comps, warm_plan.seconds, case="plan warm", **params)
+        yield measure(n_comps, warm_make.seconds, case="make warm", **params)
+
+
+@benchmark("upstream")
+def bench_upstream(quick):
+    """
+    Time building chains of diamonds, hashing all their comps, and
+    listing them with get_upstream_sorted(). Before comps cached their
+    hashes and the listing visited each comp once, both took time
+    exponential in the levels, and 30 levels never finished.
+    """
+    levels = [30, 100] if quick else [30, 100, 1000, 10000]
+    for n in levels:
+        build = Timer()
+        with build.measure():
+            requested = graphs.diamonds(n)
+
+        upstream = Timer()
+        with upstream.measure():
+            comps = boyleworkflow.core.get_upstream_sorted(requested)
+
+        hashing = Timer()
+        with hashing.measure():
+            assert len(set(comps)) == len(comps)
+
+        n_comps = len(comps)
+        yield measure(n_comps, build.seconds, case="build", levels=n)
+        yield measure(n_comps, upstream.seconds, case="upstream", levels=n)
+        yield measure(n_comps, hashing.seconds, case="hash", levels=n)
+
+
+def _count_queries(log):
+    # Count the SELECT statements on the connection of this thread.
+    queries = [0]
+
+    def trace(statement):
+        if statement.lstrip().upper().startswith("SELECT"):
+            queries[0] += 1
+
+    log.conn.set_trace_callback(trace)
+    return queries
+
+
+@benchmark("planning_queries")
+def bench_planning_queries(quick):
+    """
+    Count the log queries of make() on graphs of about 10k comps, when
+    nothing and when everything is made, to check that the planning
+    looks up each comp about once.
+    """
+    if quick:
+        cases = [("chain", graphs.chain, 1000)]
+    else:
+        cases = [
+            ("chain", graphs.chain, 10000),
+            ("sweep", graphs.sweep, (500, 5, 2)),
+        ]
+
+    for graph, func, size in cases:
+        requested = func(size)
+        n_comps = len(boyleworkflow.core.get_upstream_sorted(requested))
+
+        with temp_env() as (log, storage):
+            for case in ["make cold", "make warm"]:
+                queries = _count_queries(log)
+                timer = Timer()
+                with timer.measure():
+                    boyleworkflow.make(requested, log, storage)
+                yield measure(
+                    n_comps,
+                    timer.seconds,
+                    case=case,
+                    graph=graph,
+                    size=size,
+                    queries=queries[0],
+                    queries_per_comp=queries[0] / n_comps,
+                )
+
+
+@benchmark("makespan")
+def bench_makespan(quick):
+    """
+    Compare the simulated total time of random DAGs with critical path
+    ordering of the runs, against first in, first out.
+    """
+    seeds = range(3) if quick else range(10)
+    for n, jobs, seed in itertools.product([200], [4, 16], seeds):
+        requested, durations = graphs.random_dag(n, seed=seed)
+        fifo = simulate_makespan(
+            requested, durations, jobs, prioritize=False
+        )
+        critical = simulate_makespan(requested, durations, jobs)
+        yield dict(
+            n=n,
+            jobs=jobs,
+            seed=seed,
+            fifo=fifo,
+            critical_path=critical,
+            speedup=fifo / critical,
+        )
+
+
+@benchmark("log_batching")
+def bench_log_batching(quick):
+    """
+    Time make() on a parameter sweep of 10k comps, requesting every
+    score, with each write to the log committed on its own and with the
+    writes batched (the default).
+    """
+    shape = (50, 5, 2) if quick else (500, 5, 2)
+    (collect,) = graphs.sweep(shape)
+    requested = list(collect.parents) + [collect]
+    n_comps = len(boyleworkflow.core.get_upstream_sorted(requested))
+
+    for batch_rows in [1, boyleworkflow.log.DEFAULT_BATCH_ROWS]:
+        for jobs in [1, 8]:
+            with temp_env() as (log, storage):
+                log.batch_rows = batch_rows
+                timer = Timer()
+                with timer.measure():
+                    boyleworkflow.make(requested, log, storage, jobs=jobs)
+
+            yield measure(
+                n_comps,
+                timer.seconds,
+                case="make cold",
+                batch_rows=batch_rows,
+                jobs=jobs,
+                responses=len(requested),
+            )
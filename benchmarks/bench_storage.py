@@ -0,0 +1,604 @@
+import os
+import random
+import hashlib
+import tempfile
+import itertools
+import datetime
+import contextlib
+
+from boyleworkflow import util, digest_cache, placement
+from boyleworkflow import storage as storage_module
+from boyleworkflow import remote as remote_module
+from boyleworkflow import verify as verify_module
+from boyleworkflow.util import digest_file
+
+from benchmarks.common import benchmark, measure, temp_env, Timer, write_file
+
+
+def _store_cases(quick):
+    # (number of files, file size)
+    if quick:
+        return [(1000, 1 << 10), (10, 1 << 20)]
+    return [(10000, 1 << 10), (1000, 1 << 20), (10, 1 << 27)]
+
+
+@benchmark("storage")
+def bench_storage(quick):
+    """Time storing and restoring files of different sizes."""
+    for n, size in _store_cases(quick):
+        with temp_env() as (log, storage), tempfile.TemporaryDirectory() as td:
+            paths = [os.path.join(td, f"file {i}") for i in range(n)]
+            for i, path in enumerate(paths):
+                write_file(path, size, seed=i)
+
+            store = Timer()
+            with store.measure():
+                digests = [storage.store(path) for path in paths]
+
+            for path in paths:
+                os.remove(path)
+
+            restore = Timer()
+            with restore.measure():
+                for digest, path in zip(digests, paths):
+                    storage.restore(digest, path)
+
+        params = dict(size=size)
+        yield measure(n, store.seconds, case="store", bytes=n * size, **params)
+        yield measure(
+            n, restore.seconds, case="restore", bytes=n * size, **params
+        )
+
+
+def _populate(storage, n):
+    """
+    Fill a storage with n small objects, quicker than storing them, by
+    writing the objects and index entries directly.
+    """
+    files = []
+    for i in range(n):
+        digest = hashlib.sha1(str(i).encode()).hexdigest()
+        storage._make_dirs(digest)
+        path = storage._get_store_path(digest)
+        with open(path, "w") as f:
+            f.write(digest)
+        files.append((digest, os.stat(path)))
+    storage.index.put_files(files)
+
+
+@benchmark("layout")
+def bench_layout(quick):
+    """
+    Time can_restore() and store() in large stores with the flat and the
+    sharded layouts.
+    """
+    sizes = [10000] if quick else [10000, 1000000]
+    lookups = 1000
+
+    for n, shard_depth in itertools.product(sizes, [0, 1, 2]):
+        with temp_env(shard_depth=shard_depth) as (log, storage):
+            _populate(storage, n)
+            os.sync()
+
+            rng = random.Random(0)
+            present = [
+                hashlib.sha1(str(rng.randrange(n)).encode()).hexdigest()
+                for _ in range(lookups)
+            ]
+            absent = [
+                hashlib.sha1(f"absent {i}".encode()).hexdigest()
+                for i in range(lookups)
+            ]
+
+            # In a new process, without the entries in memory.
+            storage = storage_module.Storage(storage.storage_dir)
+            can_restore = Timer()
+            with can_restore.measure():
+                for digest in present + absent:
+                    storage.can_restore(digest)
+
+            storage = storage_module.Storage(storage.storage_dir)
+            can_restore_many = Timer()
+            with can_restore_many.measure():
+                storage.can_restore_many(present + absent)
+
+            with tempfile.TemporaryDirectory() as td:
+                paths = [os.path.join(td, f"file {i}") for i in range(lookups)]
+                for i, path in enumerate(paths):
+                    write_file(path, 1 << 10, seed=n + i)
+
+                store = Timer()
+                with store.measure():
+                    for path in paths:
+                        storage.store(path)
+
+        params = dict(objects=n, shard_depth=shard_depth)
+        yield measure(
+            2 * lookups, can_restore.seconds, case="can_restore", **params
+        )
+        yield measure(
+            2 * lookups,
+            can_restore_many.seconds,
+            case="can_restore_many",
+            **params,
+        )
+        yield measure(lookups, store.seconds, case="store", **params)
+
+
+def _digest_file_1k(path):
+    # The implementation before the hashing was reworked, for reference.
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1024)
+            if not data:
+                break
+            digest.update(data)
+        return digest.hexdigest()
+
+
+@benchmark("hashing")
+def bench_hashing(quick):
+    """
+    Compare ways of hashing files: the old 1 KiB reads, buffered reads
+    and memory maps with different algorithms, and hashing several
+    outputs in parallel.
+    """
+    n, size = (4, 1 << 24) if quick else (8, 1 << 28)
+
+    with tempfile.TemporaryDirectory() as td:
+        paths = [os.path.join(td, f"file {i}") for i in range(n)]
+        for i, path in enumerate(paths):
+            write_file(path, size, seed=i)
+
+        params = dict(files=n, size=size, bytes=n * size)
+
+        timer = Timer()
+        with timer.measure():
+            for path in paths:
+                _digest_file_1k(path)
+        yield measure(n, timer.seconds, case="sha1 1k reads", **params)
+
+        for algorithm in ["sha1", "sha256", "blake2b"]:
+            for use_mmap in [False, True]:
+                threshold = 1 if use_mmap else size + 1
+                with _mmap_threshold(threshold):
+                    timer = Timer()
+                    with timer.measure():
+                        for path in paths:
+                            digest_file(path, algorithm)
+
+                method = "mmap" if use_mmap else "buffered"
+                yield measure(
+                    n, timer.seconds, case=f"{algorithm} {method}", **params
+                )
+
+        for max_workers in [1, n]:
+            with temp_env() as (log, storage):
+                timer = Timer()
+                with timer.measure():
+                    storage.store_many(paths, max_workers=max_workers)
+
+            yield measure(
+                n,
+                timer.seconds,
+                case=f"store_many {max_workers} threads",
+                **params,
+            )
+
+
+@contextlib.contextmanager
+def _mmap_threshold(threshold):
+    original = util._MMAP_THRESHOLD
+    util._MMAP_THRESHOLD = threshold
+    try:
+        yield
+    finally:
+        util._MMAP_THRESHOLD = original
+
+
+@benchmark("digest_cache")
+def bench_digest_cache(quick):
+    """Time storing unchanged files again, with and without the cache."""
+    n, size = (100, 1 << 20) if quick else (1000, 1 << 24)
+
+    # Pretend that the files are old enough to be cached.
+    original = digest_cache._RACY_SECONDS
+    digest_cache._RACY_SECONDS = 0
+
+    try:
+        for use_digest_cache in [False, True]:
+            with temp_env(use_digest_cache=use_digest_cache) as (
+                log,
+                storage,
+            ), tempfile.TemporaryDirectory() as td:
+                paths = [os.path.join(td, f"file {i}") for i in range(n)]
+                for i, path in enumerate(paths):
+                    write_file(path, size, seed=i)
+
+                for path in paths:
+                    storage.store(path)
+
+                timer = Timer()
+                with timer.measure():
+                    for path in paths:
+                        storage.store(path)
+
+            yield measure(
+                n,
+                timer.seconds,
+                case="store again",
+                size=size,
+                digest_cache=use_digest_cache,
+            )
+    finally:
+        digest_cache._RACY_SECONDS = original
+
+
+def _write_text(path, size, seed):
+    # Compressible, but not trivially so.
+    rng = random.Random(seed)
+    words = ["alpha", "beta", "gamma", "delta", "0.125", "-3.5", "1e-9"]
+    with open(path, "w") as f:
+        written = 0
+        while written < size:
+            line = ",".join(rng.choice(words) for _ in range(10)) + "\n"
+            f.write(line)
+            written += len(line)
+
+
+@benchmark("tiers")
+def bench_tiers(quick):
+    """
+    Compress text files into the cold tier with each codec, and compare
+    the space saved and the restore latency of the tiers.
+    """
+    n, size = (10, 1 << 20) if quick else (20, 1 << 26)
+
+    for codec in sorted(storage_module.CODECS):
+        with temp_env() as (log, storage), tempfile.TemporaryDirectory() as td:
+            paths = [os.path.join(td, f"file {i}") for i in range(n)]
+            for i, path in enumerate(paths):
+                _write_text(path, size, seed=i)
+            digests = storage.store_many(paths)
+            for path in paths:
+                os.remove(path)
+
+            compress = Timer()
+            with compress.measure():
+                report = storage.compress_cold(datetime.timedelta(), codec)
+
+            # The first restore decompresses, the second is from the
+            # hot tier.
+            for _ in range(2):
+                for digest, path in zip(digests, paths):
+                    storage.restore(digest, path)
+                    os.remove(path)
+
+            stats = storage.restore_stats
+
+        yield dict(
+            case="compress",
+            codec=codec,
+            objects=report.objects,
+            bytes_before=report.bytes_before,
+            bytes_after=report.bytes_after,
+            bytes_saved=report.bytes_saved,
+            seconds=compress.seconds,
+        )
+        for tier in [storage_module.HOT, storage_module.COLD]:
+            yield measure(
+                stats.counts[tier],
+                stats.seconds[tier],
+                case="restore",
+                codec=codec,
+                tier=tier,
+                size=size,
+            )
+
+
+@benchmark("trees")
+def bench_trees(quick):
+    """Time storing and restoring directories with many files."""
+    cases = [(1000, 1 << 10)] if quick else [(1000, 1 << 10), (10000, 1 << 16)]
+
+    for n, size in cases:
+        with temp_env() as (log, storage), tempfile.TemporaryDirectory() as td:
+            src = os.path.join(td, "src")
+            for i in range(n):
+                # Spread the files over a few subdirectories.
+                path = os.path.join(src, str(i % 10), f"shard {i}")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_file(path, size, seed=i)
+
+            store = Timer()
+            with store.measure():
+                digest = storage.store(src)
+
+            restore = Timer()
+            with restore.measure():
+                storage.restore(digest, os.path.join(td, "restored"))
+
+        params = dict(files=n, size=size, bytes=n * size)
+        yield measure(n, store.seconds, case="store", **params)
+        yield measure(n, restore.seconds, case="restore", **params)
+
+
+@benchmark("chunking")
+def bench_chunking(quick):
+    """
+    Store versions of a large file that differ by a few records, with and
+    without chunking, and report the bytes on disk and restore throughput.
+    """
+    size, n_versions = (1 << 22, 5) if quick else (1 << 27, 10)
+    chunk_size = 1 << 16 if quick else 1 << 20
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as td:
+        original = os.path.join(td, "original")
+        _write_text(original, size, seed=0)
+        with open(original, "rb") as f:
+            lines = f.read().splitlines(keepends=True)
+
+        paths = []
+        for i in range(n_versions):
+            for _ in range(3):
+                lines[rng.randrange(len(lines))] = b"changed,%d\n" % i
+            path = os.path.join(td, f"version {i}")
+            with open(path, "wb") as f:
+                f.writelines(lines)
+            paths.append(path)
+
+        total_bytes = sum(os.path.getsize(path) for path in paths)
+
+        for storage_chunk_size in [None, chunk_size]:
+            with temp_env(chunk_size=storage_chunk_size) as (log, storage):
+                store = Timer()
+                with store.measure():
+                    digests = [storage.store(path) for path in paths]
+
+                stored_bytes = sum(
+                    size for _, size in storage.get_usage().values()
+                )
+
+                restore = Timer()
+                with restore.measure():
+                    for i, digest in enumerate(digests):
+                        storage.restore(digest, os.path.join(td, f"r{i}"))
+                for i in range(len(digests)):
+                    os.remove(os.path.join(td, f"r{i}"))
+
+            params = dict(chunk_size=storage_chunk_size, bytes=total_bytes)
+            yield dict(
+                case="dedup",
+                stored_bytes=stored_bytes,
+                dedup_ratio=total_bytes / stored_bytes,
+                **params,
+            )
+            yield measure(
+                total_bytes, store.seconds, case="store bytes", **params
+            )
+            yield measure(
+                total_bytes, restore.seconds, case="restore bytes", **params
+            )
+
+
+@benchmark("placement")
+def bench_placement(quick):
+    """
+    Compare the placement strategies for files of different sizes, and
+    restore to another file system (/dev/shm) if there is one.
+    """
+    n = 20 if quick else 100
+    sizes = [1 << 12, 1 << 24] if quick else [1 << 12, 1 << 20, 1 << 26]
+    names = [name for name, _ in placement.STRATEGIES]
+
+    with tempfile.TemporaryDirectory() as td:
+        for size in sizes:
+            src = os.path.join(td, "src")
+            write_file(src, size)
+            for i, name in enumerate(names):
+                placer = placement.Placer()
+                original = placement.STRATEGIES
+                placement.STRATEGIES = original[i:]
+                try:
+                    timer = Timer()
+                    with timer.measure():
+                        for j in range(n):
+                            placer.place(src, os.path.join(td, str(j)), "")
+                finally:
+                    placement.STRATEGIES = original
+
+                for j in range(n):
+                    os.remove(os.path.join(td, str(j)))
+
+                used = ", ".join(sorted(k[1] for k in placer.counts))
+                yield measure(
+                    n, timer.seconds, case=name, used=used, size=size
+                )
+            os.remove(src)
+
+    other_dir = "/dev/shm"
+    if not os.path.isdir(other_dir):
+        return
+
+    size = sizes[-1]
+    with temp_env() as (log, storage):
+        if os.stat(other_dir).st_dev == os.stat(storage.storage_dir).st_dev:
+            return
+        with tempfile.TemporaryDirectory() as td:
+            src = os.path.join(td, "src")
+            write_file(src, size)
+            digest = storage.store(src)
+
+        with tempfile.TemporaryDirectory(dir=other_dir) as td:
+            timer = Timer()
+            with timer.measure():
+                for j in range(n):
+                    storage.restore(digest, os.path.join(td, str(j)))
+
+        used = ", ".join(
+            sorted(name for op, name in storage.placer.counts if op != "store")
+        )
+        yield measure(
+            n, timer.seconds, case="restore across", used=used, size=size
+        )
+
+
+@benchmark("remote")
+def bench_remote(quick):
+    """
+    Time uploads to a directory remote, and getting the objects into
+    another store by restoring them one at a time or by prefetching.
+    """
+    n, size = (50, 1 << 16) if quick else (500, 1 << 20)
+    params = dict(files=n, size=size)
+
+    with tempfile.TemporaryDirectory() as td:
+        remote = remote_module.DirectoryRemote(os.path.join(td, "remote"))
+        with temp_env(remote=remote) as (log, storage):
+            paths = [os.path.join(td, f"file {i}") for i in range(n)]
+            for i, path in enumerate(paths):
+                write_file(path, size, seed=i)
+            digests = storage.store_many(paths)
+
+            timer = Timer()
+            with timer.measure():
+                storage.upload_async(digests)
+                storage.wait_for_uploads()
+            yield measure(n, timer.seconds, case="upload_async", **params)
+
+        for case in ["restore", "prefetch"]:
+            with temp_env(remote=remote) as (log, storage):
+                timer = Timer()
+                with timer.measure():
+                    if case == "prefetch":
+                        storage.prefetch(digests)
+                    for i, digest in enumerate(digests):
+                        storage.restore(digest, os.path.join(td, f"r{i}"))
+
+            for i in range(n):
+                os.remove(os.path.join(td, f"r{i}"))
+            yield measure(n, timer.seconds, case=case, **params)
+
+
+@benchmark("streaming")
+def bench_streaming(quick):
+    """
+    Compare writing outputs to a file and storing it afterwards with
+    writing them to the store with open_writer().
+    """
+    n, size = (4, 1 << 24) if quick else (8, 1 << 28)
+    block = os.urandom(1 << 16)
+    params = dict(files=n, size=size, bytes=n * size)
+
+    def write(f, seed):
+        f.write(seed.to_bytes(8, "little"))
+        for _ in range(size // len(block)):
+            f.write(block)
+
+    with temp_env() as (log, storage):
+        with tempfile.TemporaryDirectory() as td:
+            timer = Timer()
+            with timer.measure():
+                for i in range(n):
+                    path = os.path.join(td, f"file {i}")
+                    with open(path, "wb") as f:
+                        write(f, i)
+                    storage.store(path)
+        yield measure(n, timer.seconds, case="write and store", **params)
+
+    with temp_env() as (log, storage):
+        timer = Timer()
+        with timer.measure():
+            for i in range(n):
+                with storage.open_writer() as writer:
+                    write(writer, i)
+        yield measure(n, timer.seconds, case="open_writer", **params)
+
+
+def _files_on_disk(storage_dir):
+    return sum(len(names) for _, _, names in os.walk(storage_dir))
+
+
+@benchmark("packs")
+def bench_packs(quick):
+    """
+    Store, restore and read many small files, as files of their own and
+    packed, and count the files in the store.
+    """
+    n, size = (2000, 1 << 9) if quick else (100000, 1 << 10)
+
+    with tempfile.TemporaryDirectory() as td:
+        src = os.path.join(td, "src")
+        for i in range(n):
+            path = os.path.join(src, str(i % 10), f"small {i}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_file(path, size, seed=i)
+
+        for threshold in [None, 1 << 12]:
+            params = dict(files=n, size=size, pack_threshold=threshold)
+            with temp_env(pack_threshold=threshold) as (log, storage):
+                store = Timer()
+                with store.measure():
+                    digest = storage.store(src)
+
+                restore = Timer()
+                with restore.measure():
+                    storage.restore(
+                        digest, os.path.join(td, f"restored {threshold}")
+                    )
+
+                digests = list(storage.get_closure([digest]))
+                read = Timer()
+                with read.measure():
+                    for d in digests:
+                        storage.read_bytes(d)
+
+                files = _files_on_disk(storage.storage_dir)
+
+            yield measure(n, store.seconds, case="store", **params)
+            yield measure(n, restore.seconds, case="restore", **params)
+            yield measure(
+                len(digests),
+                read.seconds,
+                case="read_bytes",
+                files_on_disk=files,
+                **params,
+            )
+
+
+@benchmark("verify")
+def bench_verify(quick):
+    """
+    Time verifying a store in one and several processes, and with a
+    bytes per second budget.
+    """
+    n, size = (200, 1 << 16) if quick else (2000, 1 << 20)
+    total = n * size
+    cases = [(1, None), (os.cpu_count() or 1, None)]
+    # The budget should make the scrub take about a second.
+    cases.append((os.cpu_count() or 1, total))
+
+    with temp_env() as (log, storage), tempfile.TemporaryDirectory() as td:
+        for i in range(n):
+            path = os.path.join(td, f"file {i}")
+            write_file(path, size, seed=i)
+            storage.store(path)
+
+        for workers, bytes_per_second in cases:
+            timer = Timer()
+            with timer.measure():
+                report = verify_module.verify_storage(
+                    storage,
+                    bytes_per_second=bytes_per_second,
+                    max_workers=workers,
+                )
+            yield measure(
+                report.objects,
+                timer.seconds,
+                workers=workers,
+                bytes_per_second_limit=bytes_per_second,
+                bytes=report.bytes,
+                MB_per_second=report.bytes / timer.seconds / 1e6,
+            )
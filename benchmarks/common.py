@@ -0,0 +1,131 @@
+from typing import Callable, Dict, List, Any, Iterator, Mapping, Sequence
+import os
+import time
+import heapq
+import itertools
+import shutil
+import tempfile
+import contextlib
+
+import attr
+
+import boyleworkflow
+from boyleworkflow.core import Comp, Op
+from boyleworkflow.make import Scheduler
+
+
+@attr.s(auto_attribs=True)
+class Benchmark:
+    name: str
+    func: Callable[..., Iterator[Dict[str, Any]]]
+    quick: bool
+
+
+BENCHMARKS: List[Benchmark] = []
+
+
+def benchmark(name: str, quick: bool = True):
+    """
+    Register a benchmark function.
+
+    The function takes the keyword argument quick (True for a fast run
+    with small sizes) and yields one dict of measurements per case.
+    Benchmarks registered with quick=False are skipped in quick runs.
+    """
+
+    def decorator(func):
+        BENCHMARKS.append(Benchmark(name, func, quick))
+        return func
+
+    return decorator
+
+
+class Timer:
+    def __init__(self):
+        self.seconds = 0.0
+
+    @contextlib.contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def measure(count: int, seconds: float, **params) -> Dict[str, Any]:
+    """Make a dict of measurements for count operations in some time."""
+    return dict(
+        params,
+        count=count,
+        seconds=seconds,
+        per_second=count / seconds if seconds > 0 else None,
+    )
+
+
+@contextlib.contextmanager
+def temp_env(**storage_kwargs):
+    """Yield a new (log, storage) pair in a temporary directory."""
+    temp_dir = tempfile.mkdtemp()
+    log = boyleworkflow.Log(os.path.join(temp_dir, "log.db"))
+    storage = boyleworkflow.Storage(
+        os.path.join(temp_dir, "storage"), **storage_kwargs
+    )
+    try:
+        yield log, storage
+    finally:
+        log.close()
+        shutil.rmtree(temp_dir)
+
+
+def write_file(path, size: int, seed: int = 0):
+    """Write a file of pseudo-random bytes that differs for each seed."""
+    block = os.urandom(min(size, 1 << 20))
+    with open(path, "wb") as f:
+        f.write(seed.to_bytes(8, "little"))
+        written = 8
+        while written < size:
+            chunk = block[: size - written]
+            f.write(chunk)
+            written += len(chunk)
+
+
+def simulate_makespan(
+    requested: Sequence[Comp],
+    durations: Mapping[Op, float],
+    jobs: int,
+    **scheduler_kwargs,
+) -> float:
+    """
+    Make the requested comps in a new log and storage, pretending that
+    each op takes the given time, and return the simulated total time.
+
+    The runs are started in the order of a Scheduler, created with the
+    given keyword arguments, with at most jobs runs at a time.
+    """
+    with temp_env() as (log, storage):
+        scheduler = Scheduler(requested, log, storage, **scheduler_kwargs)
+        running: List = []
+        counter = itertools.count()
+        now = 0.0
+
+        while True:
+            while len(running) < jobs:
+                ready = scheduler.pop_ready()
+                if ready is None:
+                    break
+                calc, out_locs = ready
+                end = now + durations[calc.op]
+                heapq.heappush(running, (end, next(counter), calc, out_locs))
+
+            if not running:
+                break
+
+            now, _, calc, out_locs = heapq.heappop(running)
+            results = calc.op.run(calc.inputs, out_locs, storage)
+            log.save_run(calc, results, None, None)
+            scheduler.finish(calc, results)
+
+        assert scheduler.done, scheduler.needed
+
+    return now
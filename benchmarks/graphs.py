@@ -0,0 +1,144 @@
+"""
+Synthetic ops and graphs for benchmarks.
+"""
+
+from typing import Iterable, List, Sequence, Tuple, Mapping
+import os
+import time
+import random
+import tempfile
+import itertools
+
+import attr
+
+from boyleworkflow.core import Op, Comp, Result, Loc
+from boyleworkflow.storage import Storage
+from boyleworkflow.util import id_property, unique_json
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class SyntheticOp(Op):
+    """
+    An op that sleeps for a while and then writes small outputs.
+
+    Each output contains the op definition, the loc and the input
+    digests, so different calcs give different outputs.
+    """
+
+    name: str
+    seconds: float = 0
+
+    @property
+    def definition(self):
+        return unique_json(attr.asdict(self))
+
+    @id_property
+    def op_id(self):
+        return attr.asdict(self)
+
+    def run(
+        self,
+        inputs: Iterable[Result],
+        out_locs: Iterable[Loc],
+        storage: Storage,
+    ) -> Iterable[Result]:
+        if self.seconds:
+            time.sleep(self.seconds)
+
+        input_digests = sorted(inp.digest for inp in inputs)
+        results = []
+        with tempfile.TemporaryDirectory() as td:
+            for loc in out_locs:
+                path = os.path.join(td, "output")
+                with open(path, "w") as f:
+                    f.write(unique_json([self.definition, loc, input_digests]))
+                results.append(Result(loc, storage.store(path)))
+                os.remove(path)
+
+        return results
+
+
+def chain(n: int, seconds: float = 0) -> List[Comp]:
+    """A chain of n steps, each depending on the previous one."""
+    comp = Comp(SyntheticOp("chain 0", seconds), (), "out")
+    for i in range(1, n):
+        comp = Comp(SyntheticOp(f"chain {i}", seconds), (comp,), "out")
+    return [comp]
+
+
+def fan_out(n: int, seconds: float = 0) -> List[Comp]:
+    """One root step with n independent steps depending on it."""
+    root = Comp(SyntheticOp("root", seconds), (), "out")
+    return [
+        Comp(SyntheticOp(f"branch {i}", seconds), (root,), "out")
+        for i in range(n)
+    ]
+
+
+def diamonds(levels: int, seconds: float = 0) -> List[Comp]:
+    """
+    A chain of diamonds: on each level, two steps that both depend on
+    both steps on the previous level.
+    """
+    a = Comp(SyntheticOp("start a", seconds), (), "a")
+    b = Comp(SyntheticOp("start b", seconds), (), "b")
+    for i in range(levels):
+        op = SyntheticOp(f"level {i}", seconds)
+        a, b = Comp(op, (a, b), "a"), Comp(op, (a, b), "b")
+
+    return [Comp(SyntheticOp("merge", seconds), (a, b), "out")]
+
+
+def sweep(
+    shape: Sequence[int] = (200, 5, 2), seconds: float = 0
+) -> List[Comp]:
+    """
+    A parameter sweep like the one in notes/sweep.py.
+
+    For each combination of parameters, a fit step and a score step
+    depend on a shared data step. A final step collects all the scores.
+    """
+    data = Comp(SyntheticOp("data", seconds), (), "data")
+
+    scores = []
+    for params in itertools.product(*(range(n) for n in shape)):
+        name = "-".join(map(str, params))
+        fit = Comp(SyntheticOp(f"fit {name}", seconds), (data,), "fit")
+        score = Comp(SyntheticOp("score", seconds), (fit, data), name)
+        scores.append(score)
+
+    return [Comp(SyntheticOp("collect", seconds), scores, "out")]
+
+
+def random_dag(
+    n: int, max_parents: int = 3, seed: int = 0
+) -> Tuple[List[Comp], Mapping[Op, float]]:
+    """
+    A random DAG of n steps with random durations between 1 and 10.
+
+    Returns:
+        A tuple (leaves, durations), where durations maps each op
+        to its duration.
+    """
+    rng = random.Random(seed)
+    comps: List[Comp] = []
+    durations = {}
+    has_children = set()
+
+    for i in range(n):
+        op = SyntheticOp(f"step {i}")
+        durations[op] = rng.uniform(1, 10)
+        k = rng.randint(0, min(max_parents, len(comps)))
+        parents = rng.sample(comps, k)
+        # Give the parents distinct locs, as required for inputs.
+        parents = [
+            Comp(SyntheticOp(f"rename {i} {j}"), (p,), f"in{j}")
+            for j, p in enumerate(parents)
+        ]
+        for p in parents:
+            durations[p.op] = 0
+            has_children.add(p.parents[0])
+        comps.append(Comp(op, parents, "out"))
+
+    leaves = [comp for comp in comps if comp not in has_children]
+    return leaves, durations
@@ -10,6 +10,6 @@ import boyleworkflow.config
 from boyleworkflow.core import Op, Comp, Calc
 from boyleworkflow.log import Log, ConflictException, NotFoundException
 from boyleworkflow.storage import Storage
-from boyleworkflow.make import make
+from boyleworkflow.make import make, make_async, plan, Plan
 
 logger = logging.getLogger(__name__)
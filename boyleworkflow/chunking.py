@@ -0,0 +1,91 @@
+"""
+Content-defined chunking of files.
+
+The chunk boundaries are found with a rolling (gear) hash, as in FastCDC,
+so they depend only on the nearby contents. Inserting or removing some
+bytes in a file therefore only changes the chunks around the change, and
+the other chunks can be shared between versions of the file.
+
+This is pure Python and only hashes about 10 MB/s, so it is meant for
+large files that change little between versions.
+"""
+
+from typing import BinaryIO, Iterator
+import hashlib
+
+# The hash is updated as h = (h >> 1) + gear[byte], so with 29-bit gear
+# values it stays below 2 ** 30 (fast small ints in CPython) and depends
+# on about the last 30 bytes. Boundaries are where some bits are zero.
+_GEAR_BITS = 29
+_MASK_SHIFT = 5
+_MAX_MASK_BITS = 24
+
+
+def _make_gear_table():
+    # Fixed pseudo-random values, so that the boundaries never change.
+    return [
+        int.from_bytes(
+            hashlib.sha256(f"boyle gear {i}".encode()).digest()[:4], "little"
+        )
+        >> (32 - _GEAR_BITS)
+        for i in range(256)
+    ]
+
+
+_GEAR = _make_gear_table()
+
+_READ_SIZE = 1 << 20
+
+
+def _find_cut(data: bytearray, min_size: int, max_size: int, mask: int):
+    # The bytes before min_size are skipped, as they cannot be cut.
+    n = min(len(data), max_size)
+    if n <= min_size:
+        return n
+
+    gear = _GEAR
+    h = 0
+    for i, byte in enumerate(data[min_size:n], min_size):
+        h = (h >> 1) + gear[byte]
+        if not h & mask:
+            return i + 1
+
+    return n
+
+
+def iter_chunks(f: BinaryIO, avg_size: int) -> Iterator[bytes]:
+    """
+    Split a file into content-defined chunks.
+
+    Args:
+        f: A file opened for reading in binary mode.
+        avg_size: The approximate mean chunk size. The chunks are between
+            a fourth of it and four times it, except the last one.
+
+    Returns:
+        An iterator of the chunks, which together make up the file.
+    """
+    min_size = avg_size // 4
+    max_size = avg_size * 4
+
+    # A boundary is found after 2 ** bits bytes on average (after min_size).
+    bits = max(1, (avg_size - min_size).bit_length() - 1)
+    bits = min(bits, _MAX_MASK_BITS)
+    mask = ((1 << bits) - 1) << _MASK_SHIFT
+
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = f.read(max(_READ_SIZE, max_size))
+            if data:
+                buffer += data
+            else:
+                eof = True
+
+        if not buffer:
+            return
+
+        cut = _find_cut(buffer, min_size, max_size, mask)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
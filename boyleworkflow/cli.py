@@ -2,12 +2,24 @@
 
 """Console script for boyle."""
 import sys
+import logging
+import datetime
 import click
 
+from boyleworkflow.distributed import run_worker, DEFAULT_LEASE
+from boyleworkflow.storage import Storage, DEFAULT_SHARD_DEPTH, CODECS
+from boyleworkflow.log import Log
+from boyleworkflow.garbage import collect_garbage
+from boyleworkflow.verify import verify_storage
 
-@click.command()
-def main(args=None):
+
+@click.group(invoke_without_command=True)
+@click.pass_context
+def main(ctx, args=None):
     """Console script for boyle."""
+    if ctx.invoked_subcommand is not None:
+        return 0
+
     click.echo(
         "Replace this message by putting your code into "
         "boyleworkflow.cli.main"
@@ -16,5 +28,226 @@ def main(args=None):
     return 0
 
 
+@main.command()
+@click.argument("queue_path", type=click.Path(dir_okay=False))
+@click.option(
+    "--poll-interval",
+    type=float,
+    default=0.1,
+    show_default=True,
+    help="Seconds between checks for new jobs.",
+)
+@click.option(
+    "--idle-timeout",
+    type=float,
+    default=None,
+    help="Stop after this many seconds without jobs.",
+)
+@click.option(
+    "--lease",
+    type=float,
+    default=DEFAULT_LEASE,
+    show_default=True,
+    help="Seconds after which a job is failed if this worker dies.",
+)
+def worker(queue_path, poll_interval, idle_timeout, lease):
+    """Run jobs from the job table in QUEUE_PATH.
+
+    The jobs can run any code as this user, so QUEUE_PATH must be owned
+    by this user and not be writable by others.
+    """
+    logging.basicConfig(level=logging.INFO)
+    run_worker(
+        queue_path,
+        poll_interval=poll_interval,
+        idle_timeout=idle_timeout,
+        lease=lease,
+    )
+
+
+@main.command()
+@click.argument("storage_dir", type=click.Path(file_okay=False, exists=True))
+@click.option(
+    "--shard-depth",
+    type=click.IntRange(0, 8),
+    default=DEFAULT_SHARD_DEPTH,
+    show_default=True,
+    help="Levels of subdirectories to spread the objects over.",
+)
+def migrate_storage(storage_dir, shard_depth):
+    """Move the objects in STORAGE_DIR to another layout.
+
+    This can be done while the storage is in use.
+    """
+    logging.basicConfig(level=logging.INFO)
+    moved = Storage(storage_dir).migrate_layout(shard_depth)
+    click.echo(f"Moved {moved} objects")
+
+
+@main.command()
+@click.argument("storage_dir", type=click.Path(file_okay=False, exists=True))
+@click.option(
+    "--min-idle-days",
+    type=float,
+    default=30,
+    show_default=True,
+    help="Compress objects not used for this many days.",
+)
+@click.option(
+    "--codec",
+    type=click.Choice(sorted(CODECS)),
+    default="lzma",
+    show_default=True,
+)
+def compress(storage_dir, min_idle_days, codec):
+    """Move unused objects in STORAGE_DIR to the compressed tier.
+
+    This can be done while the storage is in use.
+    """
+    logging.basicConfig(level=logging.INFO)
+    storage = Storage(storage_dir)
+    report = storage.compress_cold(
+        datetime.timedelta(days=min_idle_days), codec
+    )
+    click.echo(
+        f"Compressed {report.objects} objects "
+        f"({report.bytes_before} to {report.bytes_after} bytes)"
+    )
+    for tier, (objects, size) in storage.get_usage().items():
+        click.echo(f"{tier}: {objects} objects, {size} bytes")
+
+
+@main.command()
+@click.argument("storage_dir", type=click.Path(file_okay=False, exists=True))
+@click.option(
+    "--max-garbage",
+    type=click.FloatRange(0, 1),
+    default=0.5,
+    show_default=True,
+    help="Compact packs with more than this fraction of removed bytes.",
+)
+def repack(storage_dir, max_garbage):
+    """Compact the packs of small objects in STORAGE_DIR.
+
+    Run this after gc to free the space of removed packed objects. This
+    can be done while the storage is in use.
+    """
+    logging.basicConfig(level=logging.INFO)
+    report = Storage(storage_dir).repack(max_garbage)
+    click.echo(
+        f"Compacted {report.packs} packs ({report.objects} objects kept), "
+        f"freeing {report.bytes_freed} bytes"
+    )
+
+
+@main.command()
+@click.argument("log_path", type=click.Path(dir_okay=False, exists=True))
+@click.argument("storage_dir", type=click.Path(file_okay=False, exists=True))
+@click.option(
+    "--keep-last",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Only keep the last N responses to each comp.",
+)
+@click.option(
+    "--min-idle-hours",
+    type=float,
+    default=24,
+    show_default=True,
+    help="Keep objects used within this many hours.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=500,
+    show_default=True,
+    help="Rows to read and objects to remove at a time.",
+)
+@click.option("--dry-run", is_flag=True, help="Only report what to remove.")
+def gc(log_path, storage_dir, keep_last, min_idle_hours, batch_size, dry_run):
+    """Remove objects in STORAGE_DIR that LOG_PATH does not refer to.
+
+    This can be done while makes are in progress, as long as no run takes
+    longer than --min-idle-hours.
+    """
+    logging.basicConfig(level=logging.INFO)
+    log = Log(log_path)
+    try:
+        report = collect_garbage(
+            log,
+            Storage(storage_dir),
+            keep_last=keep_last,
+            min_idle=datetime.timedelta(hours=min_idle_hours),
+            batch_size=batch_size,
+            dry_run=dry_run,
+        )
+    finally:
+        log.close()
+
+    verb = "Would remove" if dry_run else "Removed"
+    click.echo(
+        f"{verb} {report.objects_removed} objects "
+        f"({report.bytes_removed} bytes), kept {report.objects_kept}"
+    )
+
+
+@main.command()
+@click.argument("storage_dir", type=click.Path(file_okay=False, exists=True))
+@click.option(
+    "--log",
+    "log_path",
+    type=click.Path(dir_okay=False, exists=True),
+    default=None,
+    help="Distrust the results in this log that use corrupt objects.",
+)
+@click.option(
+    "--bytes-per-second",
+    type=click.FloatRange(min=1),
+    default=None,
+    help="Read at most this many bytes per second. By default, no limit.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Processes to hash in. By default, one per CPU.",
+)
+@click.option(
+    "--limit",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Check at most this many objects, and continue there next time.",
+)
+def verify(storage_dir, log_path, bytes_per_second, workers, limit):
+    """Check the objects in STORAGE_DIR against their digests.
+
+    Corrupt objects are moved to STORAGE_DIR/quarantine, so that they are
+    made again. This can be done while the storage is in use.
+    """
+    logging.basicConfig(level=logging.INFO)
+    log = Log(log_path) if log_path else None
+    try:
+        report = verify_storage(
+            Storage(storage_dir),
+            log,
+            bytes_per_second=bytes_per_second,
+            max_workers=workers,
+            limit=limit,
+        )
+    finally:
+        if log is not None:
+            log.close()
+
+    click.echo(
+        f"Checked {report.objects} objects ({report.bytes} bytes), "
+        f"quarantined {len(report.corrupt)}, "
+        f"distrusted {report.distrusted} results"
+    )
+    if not report.finished:
+        click.echo("Stopped at the limit; run again to continue.")
+    if report.corrupt:
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     sys.exit(main())  # pragma: no cover
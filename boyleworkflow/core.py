@@ -1,5 +1,18 @@
-from typing import Mapping, Union, Any, Iterable, NewType, Sequence, Tuple, List
+from typing import (
+    Mapping,
+    Union,
+    Any,
+    Iterable,
+    Iterator,
+    NewType,
+    Sequence,
+    Tuple,
+    List,
+    Set,
+    Container,
+)
 import itertools
+import asyncio
 
 import attr
 
@@ -30,6 +43,19 @@ class Op:
     ) -> Iterable[Result]:
         raise NotImplemented
 
+    async def run_async(
+        self,
+        inputs: Iterable[Result],
+        out_locs: Iterable[Loc],
+        storage: Storage,
+    ) -> Iterable[Result]:
+        # Ops that have no native async implementation are run in the
+        # event loop's default executor.
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, self.run, inputs, out_locs, storage
+        )
+
 
 def _make_tuple_sorted_by_loc(items) -> Tuple:
     items = sorted(items, key=lambda x: x.loc)
@@ -57,8 +83,10 @@ class Calc:
 
     @id_property
     def calc_id(self):
+        # Before log schema v0.2.0, the inputs were turned into
+        # {"loc": "digest"}, i.e., the ids ignored the input digests.
         value = attr.asdict(self)
-        value["inputs"] = dict(value["inputs"])
+        value["inputs"] = {inp.loc: inp.digest for inp in self.inputs}
         return value
 
 
@@ -66,7 +94,7 @@ def validate_out_loc(instance, attribute, value):
     check_valid_loc(value)
 
 
-@attr.s(auto_attribs=True, frozen=True)
+@attr.s(auto_attribs=True, frozen=True, hash=False)
 class Comp:
     op: Op
     parents: Tuple["Comp", ...] = attr.ib(converter=_make_tuple_sorted_by_loc)
@@ -80,6 +108,25 @@ class Comp:
     def validate(instance, attribute, value):
         check_valid_loc(value)
 
+    def __attrs_post_init__(self):
+        # Cache the hash while the parents' hashes are cached, so that
+        # hashing a long chain never has to recurse through it.
+        value = hash((self.op, self.parents, self.loc))
+        object.__setattr__(self, "_hash", value)
+
+    def __hash__(self):
+        return self._hash
+
+    def __getstate__(self):
+        # The cached hash is only valid within this process.
+        state = dict(self.__dict__)
+        del state["_hash"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__attrs_post_init__()
+
     @id_property
     def comp_id(self):
         return {
@@ -93,10 +140,37 @@ def get_parents(comps: Iterable[Comp]) -> Iterable[Comp]:
     return list(itertools.chain(*(comp.parents for comp in comps)))
 
 
-def get_upstream_sorted(requested: Iterable[Comp]) -> Sequence[Comp]:
-    chunks: List[Iterable[Comp]] = []
-    new: Iterable[Comp] = list(requested)
-    while new:
-        chunks.insert(0, new)
-        new = get_parents(new)
-    return list(itertools.chain(*chunks))
+def get_upstream_sorted(
+    requested: Iterable[Comp], exclude: Container[Comp] = ()
+) -> Sequence[Comp]:
+    """
+    List the requested comps and all their ancestors in topological order.
+
+    Each comp is visited and listed exactly once, after all its parents,
+    so shared ancestors (e.g. in diamond-shaped graphs) cost nothing extra.
+    The traversal is iterative to handle arbitrarily long chains.
+
+    Comps in exclude are neither listed nor traversed, so the traversal
+    stops at them.
+    """
+    result: List[Comp] = []
+    visited: Set[Comp] = set()
+
+    for root in requested:
+        if root in visited or root in exclude:
+            continue
+        visited.add(root)
+
+        stack: List[Tuple[Comp, Iterator[Comp]]] = [(root, iter(root.parents))]
+        while stack:
+            comp, parents = stack[-1]
+            for parent in parents:
+                if parent not in visited and parent not in exclude:
+                    visited.add(parent)
+                    stack.append((parent, iter(parent.parents)))
+                    break
+            else:
+                stack.pop()
+                result.append(comp)
+
+    return result
@@ -0,0 +1,181 @@
+"""
+A persistent cache of file digests, to avoid hashing unchanged files again.
+
+The digests are keyed on the stat of the file: (device, inode, size,
+mtime_ns, ctime_ns). Any change of the contents through the file system
+changes the mtime, and setting the mtime back changes the ctime, so a
+file with the same key is assumed to have the same contents.
+
+This is not safe for files modified very shortly after they are hashed,
+since the timestamps have a limited resolution. Like git, the cache
+therefore ignores files modified less than _RACY_SECONDS before hashing.
+"""
+
+from typing import Optional
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from boyleworkflow.util import PathLike
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+create table if not exists digest (
+  device integer not null,
+  inode integer not null,
+  algorithm text not null,
+  size integer not null,
+  mtime_ns integer not null,
+  ctime_ns integer not null,
+  digest text not null,
+  primary key (device, inode, algorithm)
+);
+"""
+
+# Enough for file systems with coarse timestamps, such as FAT.
+_RACY_SECONDS = 2
+
+
+def _get_key(stat: os.stat_result):
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class DigestCache:
+    """
+    A cache of file digests in an SQLite database.
+
+    The cache can be used from several threads and processes. Errors in
+    the database are logged and treated as cache misses, so a broken
+    cache only makes hashing slower.
+
+    Args:
+        path: The SQLite database file, created if needed.
+
+    Attributes:
+        hits: The number of digests found in the cache.
+        misses: The number of lookups without a usable digest.
+    """
+
+    def __init__(self, path: PathLike):
+        self.path = path
+        self._init_state()
+
+    def _init_state(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Connections cannot be pickled, e.g., to send a Storage to
+        # worker processes, which open their own.
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._init_state()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        try:
+            return self._local.conn
+        except AttributeError:
+            pass
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=10)
+        # Losing the latest entries on a crash is harmless.
+        conn.execute("PRAGMA synchronous = OFF")
+        with conn:
+            conn.executescript(_SCHEMA)
+        self._local.conn = conn
+        return conn
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, stat: os.stat_result, algorithm: str) -> Optional[str]:
+        """
+        Look up the digest of a file.
+
+        Args:
+            stat: The current stat of the file.
+            algorithm: The digest algorithm.
+
+        Returns:
+            The digest, or None if it is not known.
+        """
+        try:
+            row = (
+                self._get_conn()
+                .execute(
+                    "SELECT size, mtime_ns, ctime_ns, digest FROM digest "
+                    "WHERE device = ? AND inode = ? AND algorithm = ?",
+                    (stat.st_dev, stat.st_ino, algorithm),
+                )
+                .fetchone()
+            )
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Cannot read digest cache {self.path}: {e}")
+            row = None
+
+        hit = row is not None and tuple(row[:3]) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ctime_ns,
+        )
+        self._count(hit)
+        return row[3] if hit else None
+
+    def put(
+        self,
+        path: PathLike,
+        hashed_stat: os.stat_result,
+        algorithm: str,
+        digest: str,
+    ):
+        """
+        Remember the digest of a file.
+
+        Args:
+            path: The file.
+            hashed_stat: The stat of the file taken before it was hashed.
+            algorithm: The digest algorithm.
+            digest: The digest.
+        """
+        racy_limit = (time.time() - _RACY_SECONDS) * 10 ** 9
+        if max(hashed_stat.st_mtime_ns, hashed_stat.st_ctime_ns) > racy_limit:
+            return
+
+        # The file may have been modified while it was hashed. Otherwise,
+        # only the ctime has changed (e.g., by linking it to the storage),
+        # so record the current stat.
+        stat = os.stat(path)
+        if _get_key(stat) != _get_key(hashed_stat):
+            return
+
+        try:
+            conn = self._get_conn()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO digest "
+                    "(device, inode, algorithm, size, mtime_ns, ctime_ns, "
+                    "digest) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        stat.st_dev,
+                        stat.st_ino,
+                        algorithm,
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                        stat.st_ctime_ns,
+                        digest,
+                    ),
+                )
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Cannot write digest cache {self.path}: {e}")
@@ -0,0 +1,337 @@
+"""
+Run ops in worker processes, possibly on other machines.
+
+The coordinator (the process calling make()) and the workers share a job
+table in an SQLite database, for example the log database. The coordinator
+puts jobs in the table through a QueueExecutor, and each worker, started
+with run_worker() or `boyle worker`, takes one job at a time, runs it and
+puts back the outcome.
+
+While a worker runs a job, it keeps renewing a lease on it. If the lease
+runs out, e.g., because the worker died, the coordinator fails the job
+with WorkerLost. The clocks of the machines must agree to well within
+the lease time.
+
+The ops run by the workers store their results directly in the storage,
+so all workers must see the coordinator's Storage.storage_dir at the same
+path, for example on a shared file system.
+
+The jobs and their outcomes are pickled, so anyone who can write to the
+job table can run code as the workers and the coordinator. The database
+must be trusted: new ones are created readable and writable only by
+their owner, and both sides refuse a database that is owned by another
+user or writable by others. The directory it is in must not be writable
+by others either.
+"""
+
+from typing import Optional, Dict, Callable
+import os
+import time
+import uuid
+import socket
+import queue
+import pickle
+import sqlite3
+import logging
+import threading
+import concurrent.futures
+
+from boyleworkflow.util import PathLike
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+create table if not exists job (
+  job_id integer primary key autoincrement,
+  state text not null, -- queued, running, done or failed
+  task blob not null, -- pickled (fn, args, kwargs)
+  outcome blob, -- pickled return value or exception
+  worker text,
+  lease_expires real -- seconds since epoch, while running
+);
+create index if not exists job_state on job (state);
+"""
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+DEFAULT_POLL_INTERVAL = 0.1
+
+# Seconds that a job is leased to a worker at a time. The worker renews
+# the lease several times per lease time.
+DEFAULT_LEASE = 60.0
+
+
+class WorkerLost(Exception):
+    """The worker running a job stopped renewing its lease."""
+
+
+def _check_trusted(path: PathLike):
+    # Refuse job tables that others could put jobs in (see above).
+    if not hasattr(os, "getuid"):
+        return
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        raise PermissionError(
+            f"{path} is owned by another user or writable by others, "
+            "so its jobs cannot be trusted"
+        )
+
+
+def _connect(path: PathLike) -> sqlite3.Connection:
+    try:
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+    except FileExistsError:
+        pass
+    _check_trusted(path)
+    conn = sqlite3.connect(str(path), timeout=60)
+    with conn:
+        conn.executescript(_SCHEMA)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(job)")]
+        if "lease_expires" not in columns:
+            # A job table from before leases.
+            conn.execute("ALTER TABLE job ADD COLUMN lease_expires real")
+    return conn
+
+
+def _dump_exception(e: Exception) -> bytes:
+    try:
+        return pickle.dumps(e)
+    except Exception:
+        return pickle.dumps(RuntimeError(repr(e)))
+
+
+class QueueExecutor(concurrent.futures.Executor):
+    """
+    An executor that runs functions on workers through a job table.
+
+    The functions and their arguments are pickled, so they must be
+    importable by the workers. The jobs are run by worker processes
+    started separately with run_worker(). The database must only be
+    writable by its owner (see the module docs).
+
+    Args:
+        path: The SQLite database holding the job table.
+        poll_interval: Seconds between checks for finished jobs.
+    """
+
+    def __init__(
+        self, path: PathLike, poll_interval: float = DEFAULT_POLL_INTERVAL
+    ):
+        self.path = path
+        self.poll_interval = poll_interval
+
+        self._submitted: queue.Queue = queue.Queue()
+        self._shutdown = threading.Event()
+
+        # Fail here if the job table cannot be trusted.
+        _connect(path).close()
+
+        # All database access happens in this thread.
+        self._thread = threading.Thread(target=self._coordinate, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        if self._shutdown.is_set():
+            raise RuntimeError("cannot submit after shutdown")
+
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        task = pickle.dumps((fn, args, kwargs))
+        self._submitted.put((future, task))
+        return future
+
+    def shutdown(self, wait=True):
+        self._shutdown.set()
+        if wait:
+            self._thread.join()
+
+    def _coordinate(self):
+        conn = _connect(self.path)
+        pending: Dict[int, concurrent.futures.Future] = {}
+
+        try:
+            while True:
+                self._put_submitted(conn, pending)
+                if pending:
+                    self._collect_finished(conn, pending)
+                elif self._shutdown.is_set() and self._submitted.empty():
+                    break
+
+                time.sleep(self.poll_interval)
+        except Exception as e:
+            # Do not leave anyone waiting for futures that never finish.
+            self._shutdown.set()
+            for future in pending.values():
+                future.set_exception(e)
+            while not self._submitted.empty():
+                future, _ = self._submitted.get_nowait()
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            raise
+        finally:
+            conn.close()
+
+    def _put_submitted(self, conn, pending):
+        while True:
+            try:
+                future, task = self._submitted.get_nowait()
+            except queue.Empty:
+                return
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO job (state, task) VALUES (?, ?)",
+                    (QUEUED, task),
+                )
+            pending[cursor.lastrowid] = future
+
+    def _collect_finished(self, conn, pending):
+        job_ids = list(pending)
+        placeholders = ", ".join("?" * len(job_ids))
+
+        # Fail the jobs of workers that are gone.
+        lost = pickle.dumps(WorkerLost("the worker lease ran out"))
+        with conn:
+            conn.execute(
+                "UPDATE job SET state = ?, outcome = ? "
+                "WHERE state = ? AND lease_expires < ? "
+                f"AND job_id IN ({placeholders})",
+                [FAILED, lost, RUNNING, time.time()] + job_ids,
+            )
+
+        finished = conn.execute(
+            "SELECT job_id, state, outcome FROM job "
+            f"WHERE state IN (?, ?) AND job_id IN ({placeholders})",
+            [DONE, FAILED] + job_ids,
+        ).fetchall()
+
+        for job_id, state, outcome in finished:
+            future = pending.pop(job_id)
+            try:
+                value = pickle.loads(outcome)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            if state == DONE:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+        with conn:
+            conn.executemany(
+                "DELETE FROM job WHERE job_id = ?",
+                [(job_id,) for job_id, _, _ in finished],
+            )
+
+
+def _take_job(conn: sqlite3.Connection, worker_id: str, lease: float):
+    # Claim the oldest queued job in a single statement, so that two
+    # workers can never claim the same job.
+    with conn:
+        conn.execute(
+            "UPDATE job SET state = ?, worker = ?, lease_expires = ? "
+            "WHERE job_id = ("
+            "SELECT job_id FROM job WHERE state = ? "
+            "ORDER BY job_id LIMIT 1)",
+            (RUNNING, worker_id, time.time() + lease, QUEUED),
+        )
+
+    return conn.execute(
+        "SELECT job_id, task FROM job WHERE state = ? AND worker = ?",
+        (RUNNING, worker_id),
+    ).fetchone()
+
+
+def _renew_leases(
+    path: PathLike, worker_id: str, lease: float, stop: threading.Event
+):
+    # Run in a thread of the worker, so that the leases are renewed also
+    # while the jobs run.
+    conn = _connect(path)
+    try:
+        while not stop.wait(lease / 4):
+            with conn:
+                conn.execute(
+                    "UPDATE job SET lease_expires = ? "
+                    "WHERE state = ? AND worker = ?",
+                    (time.time() + lease, RUNNING, worker_id),
+                )
+    finally:
+        conn.close()
+
+
+def run_worker(
+    path: PathLike,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    idle_timeout: Optional[float] = None,
+    lease: float = DEFAULT_LEASE,
+):
+    """
+    Run jobs from a job table, one at a time.
+
+    The jobs are unpickled, i.e., they can run any code as this process,
+    so the database must be owned by the same user and only be writable
+    by them. Otherwise, PermissionError is raised.
+
+    Args:
+        path: The SQLite database holding the job table.
+        poll_interval: Seconds to wait before checking again for jobs
+            when there are none.
+        idle_timeout: Stop after having found no jobs for this many
+            seconds. By default, never stop.
+        lease: Seconds after which the job of this worker is failed,
+            if the worker stops renewing its lease.
+    """
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}"
+    logger.info(f"Worker {worker_id} waiting for jobs in {path}")
+
+    conn = _connect(path)
+    idle_since = time.monotonic()
+
+    stop = threading.Event()
+    renewer = threading.Thread(
+        target=_renew_leases,
+        args=(path, worker_id, lease, stop),
+        daemon=True,
+    )
+    renewer.start()
+
+    try:
+        while True:
+            job = _take_job(conn, worker_id, lease)
+
+            if job is None:
+                idle_time = time.monotonic() - idle_since
+                if idle_timeout is not None and idle_time > idle_timeout:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            job_id, task = job
+            logger.debug(f"Worker {worker_id} running job {job_id}")
+
+            try:
+                fn, args, kwargs = pickle.loads(task)
+                state, outcome = DONE, pickle.dumps(fn(*args, **kwargs))
+            except Exception as e:
+                state, outcome = FAILED, _dump_exception(e)
+
+            # Unless the coordinator gave up on the job meanwhile.
+            with conn:
+                conn.execute(
+                    "UPDATE job SET state = ?, outcome = ? "
+                    "WHERE job_id = ? AND state = ? AND worker = ?",
+                    (state, outcome, job_id, RUNNING, worker_id),
+                )
+
+            idle_since = time.monotonic()
+    finally:
+        stop.set()
+        renewer.join()
+        conn.close()
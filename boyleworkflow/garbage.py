@@ -0,0 +1,57 @@
+"""
+Remove objects from a Storage that a Log no longer refers to.
+"""
+
+from typing import Optional
+import logging
+import datetime
+
+from boyleworkflow.log import Log, _QUERY_BATCH_SIZE
+from boyleworkflow.storage import Storage, SweepReport
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_IDLE = datetime.timedelta(days=1)
+
+
+def collect_garbage(
+    log: Log,
+    storage: Storage,
+    keep_last: Optional[int] = None,
+    min_idle: datetime.timedelta = DEFAULT_MIN_IDLE,
+    batch_size: int = _QUERY_BATCH_SIZE,
+    dry_run: bool = False,
+) -> SweepReport:
+    """
+    Remove the objects in the storage that are not reachable from the log.
+
+    The reachable digests are read first (see Log.get_reachable_digests),
+    including the contents of reachable trees and chunked files, and then
+    the other objects are swept (see Storage.sweep). Both are
+    done in batches, so this can run while makes are in progress, as long
+    as no run takes longer than min_idle.
+
+    Args:
+        log: The Log.
+        storage: The Storage.
+        keep_last: If given, only keep the last keep_last responses to
+            each comp (and objects used within min_idle).
+        min_idle: Keep all objects used (stored or restored) more recently.
+        batch_size: The number of rows to read and objects to remove at
+            a time.
+        dry_run: Only report what would be removed.
+
+    Returns:
+        A SweepReport.
+    """
+    reachable = log.get_reachable_digests(keep_last, batch_size)
+    reachable = storage.get_closure(reachable)
+    logger.info(f"Found {len(reachable)} reachable digests")
+
+    report = storage.sweep(reachable, min_idle, batch_size, dry_run)
+    logger.info(
+        f"{'Would remove' if dry_run else 'Removed'} "
+        f"{report.objects_removed} objects ({report.bytes_removed} bytes), "
+        f"kept {report.objects_kept}"
+    )
+    return report
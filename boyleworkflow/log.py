@@ -1,9 +1,23 @@
-from typing import Optional, Mapping, Iterable
+from typing import (
+    Container,
+    Optional,
+    Mapping,
+    Iterable,
+    Dict,
+    List,
+    Set,
+    Tuple,
+    Union,
+)
 import os
 import sqlite3
 import logging
+import threading
+import time
 import datetime
 import uuid
+import contextlib
+from collections import defaultdict
 import attr
 
 try:
@@ -18,11 +32,67 @@ from boyleworkflow.storage import Digest
 
 logger = logging.getLogger(__name__)
 
-SCHEMA_VERSION = "v0.1.0"
+# The schema, and the user_version of the databases with it, which are
+# changed together. Logs from before v0.2.0 have 0, and their calc ids do
+# not depend on the input digests, so none of their calcs are found any
+# more (see Log.__init__). Logs with v0.2.0 (2) have no source of trust
+# opinions.
+SCHEMA_VERSION = "v0.3.0"
 SCHEMA_PATH = f"schema-{SCHEMA_VERSION}.sql"
+USER_VERSION = 3
+
+# The source of the opinions set by verify_storage(), which a run that
+# reproduces the result overrides (see Log.set_trust).
+VERIFY_SOURCE = "verify"
 
 sqlite3.register_adapter(datetime.datetime, lambda dt: dt.isoformat())
 
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER, which may be as low as 999.
+_QUERY_BATCH_SIZE = 500
+
+# Seconds to wait for other connections (threads or processes) to finish
+# writing, before failing with "database is locked".
+DEFAULT_BUSY_TIMEOUT = 60.0
+
+# Writes buffered by Log.batching() are committed when there are this
+# many rows, or this many seconds after the first.
+DEFAULT_BATCH_ROWS = 10000
+DEFAULT_BATCH_SECONDS = 1.0
+
+# Forget the comps known to be saved when there are more than this, so
+# that a long-lived log does not keep every comp in memory.
+_MAX_SAVED_COMPS = 100000
+
+# The statements that write to the log, by name, in an order where each
+# table comes after those it refers to. A batch of writes can then write
+# each table at once.
+_WRITES = {
+    "op": "INSERT OR IGNORE INTO op (op_id, definition) VALUES (?, ?)",
+    "calc": "INSERT OR IGNORE INTO calc (calc_id, op_id) VALUES (?, ?)",
+    "input": (
+        "INSERT OR IGNORE INTO input (calc_id, loc, digest) VALUES (?, ?, ?)"
+    ),
+    "run": (
+        "INSERT INTO run (run_id, calc_id, start_time, end_time) "
+        "VALUES (?, ?, ?, ?)"
+    ),
+    "result": "INSERT INTO result (run_id, loc, digest) VALUES (?, ?, ?)",
+    "vouch": (
+        "DELETE FROM trust WHERE calc_id = ? AND loc = ? AND digest = ? "
+        "AND NOT opinion AND source = ?"
+    ),
+    "comp": (
+        "INSERT OR IGNORE INTO comp (comp_id, op_id, loc) VALUES (?, ?, ?)"
+    ),
+    "parent": (
+        "INSERT OR IGNORE INTO parent (comp_id, parent_comp_id) VALUES (?, ?)"
+    ),
+    "response": (
+        "INSERT OR IGNORE INTO response (comp_id, digest, first_time) "
+        "VALUES (?, ?, ?)"
+    ),
+}
+
 
 Opinion = Optional[bool]
 
@@ -35,7 +105,108 @@ class ConflictException(Exception):
     pass
 
 
+class _ResolutionCache:
+    """
+    Resolved calcs (per comp) and results (per calc_id and loc).
+
+    Each cached calc depends on the results of its parents' calcs.
+    Invalidating the results of a calc therefore also invalidates the
+    calcs of comps resolved from those results, and so on downstream.
+    """
+
+    def __init__(self):
+        self.calcs: Dict[Comp, Calc] = {}
+        self.results: Dict[Tuple[str, Loc], Union[Result, Exception]] = {}
+        self._locs: Dict[str, Set[Loc]] = defaultdict(set)
+        self._dependents: Dict[str, Set[Comp]] = defaultdict(set)
+
+    def add_calc(self, comp: Comp, calc: Calc, parent_calcs: Iterable[Calc]):
+        self.calcs[comp] = calc
+        for parent_calc in parent_calcs:
+            self._dependents[parent_calc.calc_id].add(comp)
+
+    def add_result(self, calc_id: str, loc: Loc, value):
+        self.results[(calc_id, loc)] = value
+        self._locs[calc_id].add(loc)
+
+    def invalidate(self, calc_id: str):
+        for loc in self._locs.pop(calc_id, ()):
+            del self.results[(calc_id, loc)]
+
+        stale = list(self._dependents.pop(calc_id, ()))
+        while stale:
+            calc = self.calcs.pop(stale.pop(), None)
+            if calc is not None:
+                stale.extend(self._dependents.pop(calc.calc_id, ()))
+
+
+class _WriteBatch:
+    """
+    Rows to write in one transaction (see Log.batching()).
+    """
+
+    def __init__(self, max_rows: int, max_seconds: float):
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.clear()
+
+    def clear(self):
+        self.rows: Dict[str, List[Tuple]] = {name: [] for name in _WRITES}
+        # The calcs with buffered runs, and the buffered comps.
+        self.calc_ids: Set[str] = set()
+        self.comps: Set[Comp] = set()
+        self.size = 0
+        self._started: Optional[float] = None
+
+    def add(self, rows: Mapping[str, List[Tuple]], comps: Iterable[Comp]):
+        if self._started is None:
+            self._started = time.monotonic()
+        for name, table_rows in rows.items():
+            self.rows[name].extend(table_rows)
+            self.size += len(table_rows)
+        self.calc_ids.update(row[1] for row in rows.get("run", ()))
+        self.comps.update(comps)
+
+    def seconds_left(self) -> float:
+        if self._started is None:
+            return self.max_seconds
+        return max(0.0, self._started + self.max_seconds - time.monotonic())
+
+    def is_due(self) -> bool:
+        return self.size >= self.max_rows or not self.seconds_left()
+
+
+class _Either:
+    """
+    The items in either of two containers.
+    """
+
+    def __init__(self, first: Container, second: Container):
+        self.first = first
+        self.second = second
+
+    def __contains__(self, item) -> bool:
+        return item in self.first or item in self.second
+
+
 class Log:
+    """
+    A record of calcs, runs and their results, in an SQLite database.
+
+    The database is in WAL mode, so reads do not wait for writes, and
+    several threads and processes can use the same log. Each thread gets
+    a connection of its own when it first uses the log. Writes are
+    serialized by SQLite, and wait up to busy_timeout for each other.
+
+    Args:
+        path: The database file, created if needed.
+        busy_timeout: Seconds to wait for the writes of other threads or
+            processes.
+        batch_rows: The number of rows at which to commit buffered writes
+            (see batching()).
+        batch_seconds: The time after which to commit buffered writes.
+    """
+
     @staticmethod
     def create(path: PathLike):
         """
@@ -57,32 +228,280 @@ class Log:
 
         conn.close()
 
-    def __init__(self, path: PathLike):
+    def __init__(
+        self,
+        path: PathLike,
+        busy_timeout: float = DEFAULT_BUSY_TIMEOUT,
+        batch_rows: int = DEFAULT_BATCH_ROWS,
+        batch_seconds: float = DEFAULT_BATCH_SECONDS,
+    ):
         if not os.path.exists(path):
             Log.create(path)
-        self.conn = sqlite3.connect(str(path), isolation_level="IMMEDIATE")
-        self.conn.execute("PRAGMA foreign_keys = ON;")
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._saved_comps: Set[Comp] = set()
+
+        # The journal mode is kept in the database, so this is only
+        # needed once, but it is cheap.
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        try:
+            self._check_version()
+        except ValueError:
+            self.close()
+            raise
+
+    def _check_version(self):
+        (version,) = self.conn.execute("PRAGMA user_version").fetchone()
+        if version > USER_VERSION:
+            raise ValueError(
+                f"{self.path} has a newer schema ({version}) than this "
+                f"version of boyle ({USER_VERSION})"
+            )
+        if version == USER_VERSION:
+            return
+
+        # Upgrade once, even if other processes open the log meanwhile.
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            (version,) = self.conn.execute("PRAGMA user_version").fetchone()
+            if version >= USER_VERSION:
+                return
+            if version < 2:
+                # The tables are the same, but the calc ids have changed.
+                logger.warning(
+                    f"{self.path} is from before schema v0.2.0, when "
+                    "calc ids changed. The earlier results are not reused, "
+                    "and the calcs are run again when needed."
+                )
+            if version < 3:
+                # The earlier opinions were all set by the user.
+                self.conn.execute("ALTER TABLE trust ADD COLUMN source text")
+            self.conn.execute(f"PRAGMA user_version = {USER_VERSION}")
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """
+        The connection of the current thread.
+        """
+        try:
+            return self._local.conn
+        except AttributeError:
+            pass
+
+        # Only used by this thread, but closed by close().
+        conn = sqlite3.connect(
+            str(self.path),
+            timeout=self.busy_timeout,
+            isolation_level="IMMEDIATE",
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA foreign_keys = ON;")
+        with self._lock:
+            self._conns.append(conn)
+        self._local.conn = conn
+        return conn
+
+    @property
+    def _cache(self) -> Optional[_ResolutionCache]:
+        # Each thread caches separately (see caching()).
+        return getattr(self._local, "cache", None)
+
+    @_cache.setter
+    def _cache(self, cache: Optional[_ResolutionCache]):
+        self._local.cache = cache
+
+    @contextlib.contextmanager
+    def caching(self):
+        """
+        Cache the resolution of calcs and results within a block.
+
+        While the cache is active, get_calc() and get_result() look up
+        each comp and each (calc, loc) pair at most once. Recording a run
+        or a trust opinion invalidates only the entries that depend on
+        the affected calc. Nested blocks share the outermost cache.
+
+        The cache belongs to the current thread, and does not notice the
+        runs that other threads or processes record meanwhile.
+        """
+        if self._cache is not None:
+            yield
+            return
+
+        self._cache = _ResolutionCache()
+        try:
+            yield
+        finally:
+            self._cache = None
+
+    def _invalidate(self, calc_id: str):
+        if self._cache is not None:
+            self._cache.invalidate(calc_id)
 
     def close(self):
-        self.conn.close()
+        """
+        Close the connections of all threads.
+        """
+        with self._lock:
+            conns = self._conns
+            self._conns = []
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+
+    def close_thread(self):
+        """
+        Close the connection of the current thread, e.g., before the
+        thread ends. The thread opens a new one if it uses the log again.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        del self._local.conn
+        with self._lock:
+            if conn in self._conns:
+                self._conns.remove(conn)
+        conn.close()
 
-    def save_calc(self, calc: Calc):
-        with self.conn:
-            self.conn.execute(
-                "INSERT OR IGNORE INTO op(op_id, definition) VALUES (?, ?)",
-                (calc.op.op_id, calc.op.definition),
-            )
+    @property
+    def _batch(self) -> Optional["_WriteBatch"]:
+        # Each thread batches separately (see batching()).
+        return getattr(self._local, "batch", None)
 
-            self.conn.execute(
-                "INSERT OR IGNORE INTO calc(calc_id, op_id) VALUES (?, ?)",
-                (calc.calc_id, calc.op.op_id),
-            )
+    @contextlib.contextmanager
+    def batching(self):
+        """
+        Buffer the writes within a block, to commit them together.
+
+        Runs, calcs, comps and responses recorded in the block are
+        committed in one transaction when batch_rows rows are buffered,
+        when a write comes batch_seconds after the first buffered one,
+        and at the end of the block. Queries in the same thread first
+        commit the writes they depend on. Other threads and processes
+        see the writes when committed. Nested blocks share the outermost
+        batch. See also flush() and flush_due().
+
+        Each batch is committed atomically, so the log never has part of
+        a run. If the process dies, the writes of the last batch are
+        lost, i.e., runs of at most about batch_seconds before, which are
+        then run again. Their outputs are in the storage already.
+        """
+        if self._batch is not None:
+            yield
+            return
+
+        self._local.batch = _WriteBatch(self.batch_rows, self.batch_seconds)
+        try:
+            yield
+        finally:
+            try:
+                self.flush()
+            finally:
+                self._local.batch = None
+
+    def flush(self):
+        """
+        Commit the writes buffered by batching() in this thread, if any.
+        """
+        batch = self._batch
+        if batch is None or not batch.size:
+            return
+        try:
+            self._commit(batch.rows, batch.comps)
+        finally:
+            batch.clear()
+
+    def flush_due(self) -> Optional[float]:
+        """
+        Commit the buffered writes, if the time window has passed.
 
-            self.conn.executemany(
-                "INSERT OR IGNORE INTO input (calc_id, loc, digest) "
-                "VALUES (?, ?, ?)",
-                [(calc.calc_id, inp.loc, inp.digest) for inp in calc.inputs],
-            )
+        Call this while waiting for more writes, so that buffered writes
+        are not held for long.
+
+        Returns:
+            The seconds until the buffered writes are due, or None if
+            there are none.
+        """
+        batch = self._batch
+        if batch is None or not batch.size:
+            return None
+        if batch.is_due():
+            self.flush()
+            return None
+        return batch.seconds_left()
+
+    def _flush_for(self, calc_ids: Optional[Iterable[str]] = None):
+        # Commit the buffered writes before a query that depends on them,
+        # i.e., on runs of the calcs, or by default on anything.
+        batch = self._batch
+        if batch is None or not batch.size:
+            return
+        if calc_ids is None or not batch.calc_ids.isdisjoint(calc_ids):
+            self.flush()
+
+    def _write(
+        self, rows: Mapping[str, List[Tuple]], comps: Iterable[Comp] = ()
+    ):
+        # Write rows to tables (see _WRITES), now or in the batch, with
+        # the comps that they save.
+        batch = self._batch
+        if batch is None:
+            self._commit(rows, comps)
+            return
+
+        batch.add(rows, comps)
+        if batch.is_due():
+            self.flush()
+
+    def _commit(self, rows: Mapping[str, List[Tuple]], comps: Iterable[Comp]):
+        with self.conn:
+            for name, statement in _WRITES.items():
+                if rows.get(name):
+                    self.conn.executemany(statement, rows[name])
+
+        # Only now can other threads rely on the comps.
+        with self._lock:
+            if len(self._saved_comps) > _MAX_SAVED_COMPS:
+                self._saved_comps.clear()
+            self._saved_comps.update(comps)
+
+    def _calc_rows(self, calc: Calc) -> Dict[str, List[Tuple]]:
+        return {
+            "op": [(calc.op.op_id, calc.op.definition)],
+            "calc": [(calc.calc_id, calc.op.op_id)],
+            "input": [
+                (calc.calc_id, inp.loc, inp.digest) for inp in calc.inputs
+            ],
+        }
+
+    def _comp_rows(
+        self, leaf_comps: Iterable[Comp]
+    ) -> Tuple[List[Comp], Dict[str, List]]:
+        # The comps not saved before by this log, nor buffered in the
+        # batch of this thread, with their ancestors, and their rows.
+        batch = self._batch
+        with self._lock:
+            exclude = self._saved_comps
+            if batch is not None:
+                exclude = _Either(exclude, batch.comps)
+            comps = list(get_upstream_sorted(leaf_comps, exclude))
+        return comps, {
+            "comp": [
+                (comp.comp_id, comp.op.op_id, comp.loc) for comp in comps
+            ],
+            "parent": [
+                (comp.comp_id, parent.comp_id)
+                for comp in comps
+                for parent in comp.parents
+            ],
+        }
+
+    def save_calc(self, calc: Calc):
+        self._write(self._calc_rows(calc))
 
     def save_run(
         self,
@@ -92,61 +511,170 @@ class Log:
         end_time: datetime.datetime,
     ):
         run_id = str(uuid.uuid4())
+        results = list(results)
 
-        self.save_calc(calc)
-
-        with self.conn:
-            self.conn.execute(
-                "INSERT INTO run "
-                "(run_id, calc_id, start_time, end_time) "
-                "VALUES (?, ?, ?, ?)",
-                (run_id, calc.calc_id, start_time, end_time),
-            )
+        rows = self._calc_rows(calc)
+        rows["run"] = [(run_id, calc.calc_id, start_time, end_time)]
+        rows["result"] = [
+            (run_id, result.loc, result.digest) for result in results
+        ]
+        # A run that reproduces a result distrusted by verify_storage()
+        # vouches for it, as the corrupt object was quarantined.
+        rows["vouch"] = [
+            (calc.calc_id, result.loc, result.digest, VERIFY_SOURCE)
+            for result in results
+        ]
+        self._write(rows)
 
-            self.conn.executemany(
-                "INSERT INTO result (run_id, loc, digest) VALUES (?, ?, ?)",
-                [(run_id, result.loc, result.digest) for result in results],
-            )
+        self._invalidate(calc.calc_id)
 
     def save_comp(self, leaf_comp: Comp):
-        with self.conn:
-            for comp in get_upstream_sorted([leaf_comp]):
-                self.conn.execute(
-                    "INSERT OR IGNORE INTO comp (comp_id, op_id, loc) "
-                    "VALUES (?, ?, ?)",
-                    (comp.comp_id, comp.op.op_id, comp.loc),
-                )
-
-                self.conn.executemany(
-                    "INSERT OR IGNORE INTO parent "
-                    "(comp_id, parent_comp_id) "
-                    "VALUES (?, ?)",
-                    [(comp.comp_id, parent.comp_id) for parent in comp.parents],
-                )
+        comps, rows = self._comp_rows([leaf_comp])
+        self._write(rows, comps)
 
     def save_response(
         self, comp: Comp, digest: Digest, time: datetime.datetime
     ):
-        self.save_comp(comp)
+        self.save_responses([(comp, digest)], time)
 
-        with self.conn:
-            self.conn.execute(
-                "INSERT OR IGNORE INTO response "
-                "(comp_id, digest, first_time) "
-                "VALUES (?, ?, ?)",
-                (comp.comp_id, digest, time),
-            )
+    def save_responses(
+        self,
+        responses: Iterable[Tuple[Comp, Digest]],
+        time: datetime.datetime,
+    ):
+        """
+        Record the responses to several requested comps at once.
 
-    def set_trust(self, calc_id: str, loc: Loc, digest: Digest, opinion: bool):
+        Args:
+            responses: Pairs of (comp, digest).
+            time: When the comps were requested.
+        """
+        responses = list(responses)
+        comps, rows = self._comp_rows(comp for comp, _ in responses)
+        rows["response"] = [
+            (comp.comp_id, digest, time) for comp, digest in responses
+        ]
+        self._write(rows, comps)
+
+    def set_trust(
+        self,
+        calc_id: str,
+        loc: Loc,
+        digest: Digest,
+        opinion: bool,
+        source: Optional[str] = None,
+    ):
+        """
+        Trust or distrust a result.
+
+        Args:
+            calc_id: The calc of the result.
+            loc: The loc of the result.
+            digest: The digest of the result.
+            opinion: Whether to trust the result.
+            source: What set the opinion, e.g., VERIFY_SOURCE, or None
+                for the user. The opinions of the user replace any other,
+                but other sources do not replace a distrust by the user.
+        """
+        # Buffered runs may vouch for the result, so keep the order.
+        self.flush()
         with self.conn:
             self.conn.execute(
                 "INSERT OR REPLACE INTO trust "
-                "(calc_id, loc, digest, opinion) "
-                "VALUES (?, ?, ?, ?) ",
-                (calc_id, loc, digest, opinion),
+                "(calc_id, loc, digest, opinion, source) "
+                "SELECT ?, ?, ?, ?, ? WHERE ? IS NULL OR NOT EXISTS ("
+                "SELECT * FROM trust "
+                "WHERE calc_id = ? AND loc = ? AND digest = ? "
+                "AND NOT opinion AND source IS NULL)",
+                (calc_id, loc, digest, opinion, source, source)
+                + (calc_id, loc, digest),
             )
 
+        self._invalidate(calc_id)
+
+    def get_reachable_digests(
+        self,
+        keep_last: Optional[int] = None,
+        batch_size: int = _QUERY_BATCH_SIZE,
+    ) -> Set[Digest]:
+        """
+        Find the digests that the log refers to.
+
+        The tables are read in batches, each in a short read transaction,
+        so that concurrent writers are not blocked for long.
+
+        Args:
+            keep_last: If given, only include the last keep_last responses
+                to each comp, and not the inputs and results of calcs.
+                Then the other results may have to be made again.
+            batch_size: The number of rows to read at a time.
+
+        Returns:
+            A set of digests.
+        """
+        if keep_last is None:
+            queries = [
+                "SELECT rowid, digest FROM response WHERE rowid > ?",
+                "SELECT rowid, digest FROM result WHERE rowid > ?",
+                "SELECT rowid, digest FROM input WHERE rowid > ?",
+            ]
+            params: Tuple = ()
+        else:
+            # Count the later responses with the primary key index.
+            queries = [
+                "SELECT rowid, digest FROM response AS r WHERE rowid > ? "
+                "AND (SELECT COUNT(*) FROM response AS later "
+                "WHERE later.comp_id = r.comp_id "
+                "AND later.first_time > r.first_time) < ?"
+            ]
+            params = (keep_last,)
+
+        self._flush_for()
+        digests: Set[Digest] = set()
+        for query in queries:
+            last_rowid = 0
+            while True:
+                rows = self.conn.execute(
+                    f"{query} ORDER BY rowid LIMIT ?",
+                    (last_rowid,) + params + (batch_size,),
+                ).fetchall()
+                if not rows:
+                    break
+                digests.update(digest for _, digest in rows)
+                last_rowid = rows[-1][0]
+
+        return digests
+
+    def get_results_with_digests(
+        self, digests: Iterable[Digest]
+    ) -> Set[Tuple[str, Loc, Digest]]:
+        """
+        Find the results that have any of some digests.
+
+        Args:
+            digests: The digests.
+
+        Returns:
+            A set of (calc_id, loc, digest) for the results.
+        """
+        self._flush_for()
+        digests = list(digests)
+        found: Set[Tuple[str, Loc, Digest]] = set()
+        for i in range(0, len(digests), _QUERY_BATCH_SIZE):
+            batch = digests[i : i + _QUERY_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            found.update(
+                self.conn.execute(
+                    "SELECT calc_id, loc, digest FROM result "
+                    "INNER JOIN run USING (run_id) "
+                    f"WHERE digest IN ({placeholders})",
+                    batch,
+                )
+            )
+        return found
+
     def get_opinions(self, calc: Calc, loc: Loc) -> Mapping[Digest, Opinion]:
+        self._flush_for([calc.calc_id])
         query = self.conn.execute(
             "SELECT digest, opinion FROM result "
             "INNER JOIN run USING (run_id) "
@@ -157,9 +685,34 @@ class Log:
 
         return {digest: opinion for digest, opinion in query}
 
-    def get_result(self, calc: Calc, loc: Loc) -> Result:
-        opinions = self.get_opinions(calc, loc)
+    def _get_many_opinions(
+        self, calc_ids: Iterable[str]
+    ) -> Mapping[Tuple[str, Loc], Mapping[Digest, Opinion]]:
+        calc_ids = list(calc_ids)
+        self._flush_for(calc_ids)
+        opinions: Dict[Tuple[str, Loc], Dict[Digest, Opinion]] = defaultdict(
+            dict
+        )
 
+        for i in range(0, len(calc_ids), _QUERY_BATCH_SIZE):
+            batch = calc_ids[i : i + _QUERY_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            query = self.conn.execute(
+                "SELECT calc_id, loc, digest, opinion FROM result "
+                "INNER JOIN run USING (run_id) "
+                "LEFT OUTER JOIN trust USING (calc_id, loc, digest) "
+                f"WHERE calc_id IN ({placeholders})",
+                batch,
+            )
+
+            for calc_id, loc, digest, opinion in query:
+                opinions[(calc_id, loc)][digest] = opinion
+
+        return opinions
+
+    def _select_result(
+        self, calc: Calc, loc: Loc, opinions: Mapping[Digest, Opinion]
+    ) -> Result:
         candidates = [
             digest
             for digest, opinion in opinions.items()
@@ -178,12 +731,141 @@ class Log:
         else:
             raise ConflictException(opinions)
 
-    def get_calc(self, comp: Comp) -> Calc:
-        def get_comp_result(input_comp: Comp) -> Result:
-            calc = self.get_calc(input_comp)
-            return self.get_result(calc, input_comp.loc)
+    def _get_result(self, calc: Calc, loc: Loc) -> Result:
+        return self._select_result(calc, loc, self.get_opinions(calc, loc))
+
+    def _get_result_cached(
+        self, cache: _ResolutionCache, calc: Calc, loc: Loc
+    ) -> Result:
+        key = (calc.calc_id, loc)
+        if key not in cache.results:
+            try:
+                value = self._get_result(calc, loc)
+            except (NotFoundException, ConflictException) as e:
+                value = e
+            cache.add_result(calc.calc_id, loc, value)
+
+        value = cache.results[key]
+        if isinstance(value, Exception):
+            raise type(value)(*value.args)
+        return value
+
+    def get_result(self, calc: Calc, loc: Loc) -> Result:
+        if self._cache is None:
+            return self._get_result(calc, loc)
+        return self._get_result_cached(self._cache, calc, loc)
+
+    def get_results(
+        self, pairs: Iterable[Tuple[Calc, Loc]]
+    ) -> Mapping[Tuple[Calc, Loc], Result]:
+        """
+        Get the results of many (calc, loc) pairs at once.
+
+        This is equivalent to calling get_result() for each pair, but the
+        log is queried in a few batches instead of once per pair.
+
+        Args:
+            pairs: The (calc, loc) pairs to look up.
+
+        Returns:
+            A dict with the result of each pair that has one. Pairs for
+            which get_result() would raise NotFoundException are left out.
 
-        return Calc(
-            inputs=tuple(get_comp_result(parent) for parent in comp.parents),
-            op=comp.op,
+        Raises:
+            ConflictException: If any pair has conflicting results.
+        """
+        cache = self._cache
+        pairs = list(pairs)
+
+        if cache is None:
+            uncached = pairs
+        else:
+            uncached = [
+                (calc, loc)
+                for calc, loc in pairs
+                if (calc.calc_id, loc) not in cache.results
+            ]
+
+        opinions = self._get_many_opinions(
+            set(calc.calc_id for calc, loc in uncached)
         )
+
+        values = {}
+        for calc, loc in uncached:
+            try:
+                value = self._select_result(
+                    calc, loc, opinions.get((calc.calc_id, loc), {})
+                )
+            except (NotFoundException, ConflictException) as e:
+                value = e
+            values[(calc, loc)] = value
+            if cache is not None:
+                cache.add_result(calc.calc_id, loc, value)
+
+        results = {}
+        for calc, loc in pairs:
+            if (calc, loc) in values:
+                value = values[(calc, loc)]
+            else:
+                value = cache.results[(calc.calc_id, loc)]
+
+            if isinstance(value, ConflictException):
+                raise type(value)(*value.args)
+            elif isinstance(value, Result):
+                results[(calc, loc)] = value
+
+        return results
+
+    def get_mean_durations(
+        self, op_ids: Iterable[str]
+    ) -> Mapping[str, datetime.timedelta]:
+        """
+        Get the mean duration of previous runs of some ops.
+
+        Args:
+            op_ids: The ops to look up.
+
+        Returns:
+            A dict with the mean run duration of each op that has been run.
+        """
+        self._flush_for()
+        op_ids = list(set(op_ids))
+        durations = {}
+
+        for i in range(0, len(op_ids), _QUERY_BATCH_SIZE):
+            batch = op_ids[i : i + _QUERY_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            query = self.conn.execute(
+                "SELECT op_id, "
+                "AVG(julianday(end_time) - julianday(start_time)) "
+                "FROM run INNER JOIN calc USING (calc_id) "
+                f"WHERE op_id IN ({placeholders}) "
+                "GROUP BY op_id",
+                batch,
+            )
+
+            for op_id, days in query:
+                if days is not None:
+                    # julianday() is only precise to about a millisecond.
+                    seconds = round(days * 24 * 60 * 60, 3)
+                    durations[op_id] = datetime.timedelta(seconds=seconds)
+
+        return durations
+
+    def get_calc(self, comp: Comp) -> Calc:
+        # Without an active cache, use one for this call only. Either way,
+        # each ancestor is resolved once, parents before children.
+        cache = self._cache if self._cache is not None else _ResolutionCache()
+
+        for upstream_comp in get_upstream_sorted([comp], cache.calcs):
+            parent_calcs = [cache.calcs[p] for p in upstream_comp.parents]
+            inputs = [
+                self._get_result_cached(cache, parent_calc, parent.loc)
+                for parent, parent_calc in zip(
+                    upstream_comp.parents, parent_calcs
+                )
+            ]
+            calc = Calc(inputs=tuple(inputs), op=upstream_comp.op)
+            cache.add_calc(upstream_comp, calc, parent_calcs)
+
+        return cache.calcs[comp]
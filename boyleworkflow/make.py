@@ -1,7 +1,24 @@
-from typing import Iterable, Sequence, Mapping, Callable, List, Set
+from typing import (
+    Iterable,
+    Sequence,
+    Mapping,
+    Callable,
+    List,
+    Set,
+    Dict,
+    Tuple,
+    Optional,
+    FrozenSet,
+)
 import datetime
+import asyncio
+import contextlib
+import concurrent.futures
+import heapq
+import itertools
 from collections import defaultdict
 
+import attr
 
 from boyleworkflow.core import (
     Loc,
@@ -9,15 +26,36 @@ from boyleworkflow.core import (
     Op,
     Calc,
     Comp,
+    Result,
     get_upstream_sorted,
-    get_parents,
 )
 from boyleworkflow.log import Log, NotFoundException
 from boyleworkflow.storage import Storage
 
 
-def _determine_sets(comps: Iterable[Comp], log: Log, storage: Storage):
-    sets: Mapping[str, set] = {
+def _get_calc(comp: Comp, digests: Mapping[Comp, Digest]) -> Calc:
+    inputs = [Result(parent.loc, digests[parent]) for parent in comp.parents]
+    return Calc(op=comp.op, inputs=inputs)
+
+
+def _group_by_level(comps: Iterable[Comp]) -> List[List[Comp]]:
+    # Expects the comps in topological order.
+    levels: List[List[Comp]] = []
+    level_by_comp: Dict[Comp, int] = {}
+    for comp in comps:
+        level = max((level_by_comp[p] + 1 for p in comp.parents), default=0)
+        level_by_comp[comp] = level
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(comp)
+
+    return levels
+
+
+def _determine_sets(
+    comps: Iterable[Comp], log: Log, storage: Storage
+) -> Tuple[Mapping[str, Set[Comp]], Dict[Comp, Calc], Dict[Comp, Digest]]:
+    sets: Mapping[str, Set[Comp]] = {
         name: set()
         for name in (
             "Abstract",  # input digests unknown
@@ -29,98 +67,659 @@ def _determine_sets(comps: Iterable[Comp], log: Log, storage: Storage):
         )
     }
 
-    for comp in comps:
-        parents = set(comp.parents)
-        if parents <= sets["Known"]:
-            sets["Concrete"].add(comp)
-        else:
-            sets["Abstract"].add(comp)
-            continue
+    calcs: Dict[Comp, Calc] = {}
+    digests: Dict[Comp, Digest] = {}
 
-        if parents <= sets["Restorable"]:
-            sets["Runnable"].add(comp)
+    # All comps on a level have their parents on earlier levels,
+    # so the results of each level can be looked up in one go.
+    for level in _group_by_level(comps):
+        for comp in level:
+            parents = set(comp.parents)
+            if parents <= sets["Known"]:
+                sets["Concrete"].add(comp)
+            else:
+                sets["Abstract"].add(comp)
+                continue
 
-        calc = log.get_calc(comp)
-        try:
-            digest = log.get_result(calc, comp.loc).digest
+            if parents <= sets["Restorable"]:
+                sets["Runnable"].add(comp)
+
+            # The parents' digests are already known, so the calc can be
+            # constructed directly instead of resolving it through the log.
+            calcs[comp] = _get_calc(comp, digests)
+
+        concrete = [comp for comp in level if comp in calcs]
+        results = log.get_results((calcs[comp], comp.loc) for comp in concrete)
+
+        for comp in concrete:
+            result = results.get((calcs[comp], comp.loc))
+            if result is None:
+                sets["Unknown"].add(comp)
+                continue
+
+            digests[comp] = result.digest
             sets["Known"].add(comp)
-            if storage.can_restore(digest):
+
+        # Likewise for checking the storage.
+        known = [comp for comp in concrete if comp in digests]
+        restorable = storage.can_restore_many(digests[c] for c in known)
+        for comp in known:
+            if restorable[digests[comp]]:
                 sets["Restorable"].add(comp)
-        except NotFoundException as e:
-            sets["Unknown"].add(comp)
 
-    return sets
+    return sets, calcs, digests
+
 
+DEFAULT_DURATION = datetime.timedelta(seconds=1)
 
-def _get_ready_and_needed(requested, log, storage) -> Iterable[Comp]:
-    requested = set(requested)
-    assert len(requested) > 0
 
-    comps = get_upstream_sorted(requested)
-    sets = _determine_sets(comps, log, storage)
+class Scheduler:
+    """
+    Keep track of which calcs to run to make some requested comps.
 
-    if requested <= sets["Restorable"]:
-        return set()
+    The whole graph is classified once, when the scheduler is created.
+    After that, each finished run only updates the comps it affects,
+    i.e., the comps of the calc that was run and, if their digests lead
+    to results that are already in the log, the comps downstream of them.
 
-    candidates: Set[Comp] = set()
+    A comp is needed if it cannot be restored, and it is either requested
+    or a parent of a needed comp. A needed comp is ready to run when its
+    calc is known and all its parents can be restored.
 
-    # First set of candidates is the union of
-    #  (1) requested outputs that are not restorable, and
-    #  (2) all unknown outputs upstream of the requested outputs
-    additional = (requested - sets["Restorable"]) | sets["Unknown"]
+    Ready calcs are handed out in order of their remaining critical path,
+    i.e., the longest chain of needed runs that starts with them. The run
+    durations are estimated from earlier runs of the same ops, falling
+    back to default_duration for ops that have never been run. Without
+    prioritize, ready calcs are handed out in the order they became ready.
+    """
 
-    while additional:
-        candidates.update(additional)
+    def __init__(
+        self,
+        requested: Iterable[Comp],
+        log: Log,
+        storage: Storage,
+        prioritize: bool = True,
+        default_duration: datetime.timedelta = DEFAULT_DURATION,
+    ):
+        self.requested = set(requested)
+        self.log = log
+        self.storage = storage
 
-        # Furthermore we need to run parents to the previous candidates,
-        # if those parents are not restorable.
-        additional = set(get_parents(additional)) - sets["Restorable"]
+        self.comps = get_upstream_sorted(self.requested)
+        sets, self.calcs, self.digests = _determine_sets(
+            self.comps, log, storage
+        )
+        self.restorable = sets["Restorable"]
 
-    final = candidates.intersection(sets["Runnable"])
-    assert len(final) > 0, len(sets["Runnable"])
+        self._children: Dict[Comp, List[Comp]] = defaultdict(list)
+        self._comps_by_calc: Dict[Calc, Set[Comp]] = defaultdict(set)
+        for comp in self.comps:
+            for parent in comp.parents:
+                self._children[parent].append(comp)
+            if comp in self.calcs:
+                self._comps_by_calc[self.calcs[comp]].add(comp)
 
-    return final
+        self.needed: Set[Comp] = set()
+        self._needed_children: Dict[Comp, int] = defaultdict(int)
+        for comp in reversed(self.comps):
+            if comp in self.restorable:
+                continue
+            if comp in self.requested or self._needed_children[comp]:
+                self.needed.add(comp)
+                for parent in comp.parents:
+                    self._needed_children[parent] += 1
 
+        self.priorities: Dict[Comp, float] = {}
+        if prioritize:
+            self._set_priorities(default_duration)
 
-def _run_calc(calc: Calc, out_locs: Iterable[Loc], log: Log, storage: Storage):
+        self._running: Set[Calc] = set()
+        self._ready: Dict[Calc, Set[Comp]] = {}
+        self._queue: List[Tuple[float, int, Calc]] = []
+        self._counter = itertools.count()
+        self._deferred: Dict[Calc, Set[Comp]] = defaultdict(set)
+        for comp in self.comps:
+            self._check_ready(comp)
 
-    start_time = datetime.datetime.utcnow()
-    results = calc.op.run(calc.inputs, out_locs, storage)
-    end_time = datetime.datetime.utcnow()
+    @property
+    def done(self) -> bool:
+        return not self.needed
+
+    def pop_ready(self) -> Optional[Tuple[Calc, Set[Loc]]]:
+        """
+        Take the next calc that is ready to run.
+
+        Returns:
+            A tuple (calc, out_locs), or None if no calc is ready.
+        """
+        # The queue may contain calcs that are no longer ready,
+        # or are queued more than once. Skip those.
+        while self._queue:
+            _, _, calc = heapq.heappop(self._queue)
+            comps = self._ready.pop(calc, None)
+            if comps:
+                self._running.add(calc)
+                return calc, set(comp.loc for comp in comps)
+
+        return None
+
+    def _set_priorities(self, default_duration: datetime.timedelta):
+        ops = set(comp.op for comp in self.needed)
+        durations = self.log.get_mean_durations(op.op_id for op in ops)
+        default = default_duration.total_seconds()
+
+        for comp in reversed(self.comps):
+            if comp not in self.needed:
+                continue
+            duration = durations.get(comp.op.op_id)
+            seconds = default if duration is None else duration.total_seconds()
+            downstream = max(
+                (self.priorities.get(c, 0) for c in self._children[comp]),
+                default=0,
+            )
+            self.priorities[comp] = seconds + downstream
+
+    def finish(self, calc: Calc, results: Iterable[Result]):
+        """
+        Update the state after a run of the calc has been saved.
+        """
+        self._running.remove(calc)
+
+        digests = {result.loc: result.digest for result in results}
+        for comp in list(self._comps_by_calc[calc]):
+            if comp.loc in digests:
+                self._add_known(comp, digests[comp.loc])
+
+        # Needed comps of this calc that came up while it was running.
+        for comp in self._deferred.pop(calc, ()):
+            self._check_ready(comp)
+
+    def _check_ready(self, comp: Comp):
+        if comp not in self.needed or comp not in self.calcs:
+            return
+
+        if not all(parent in self.restorable for parent in comp.parents):
+            return
+
+        calc = self.calcs[comp]
+        if calc in self._running:
+            self._deferred[calc].add(comp)
+        else:
+            self._ready.setdefault(calc, set()).add(comp)
+            priority = self.priorities.get(comp, 0)
+            entry = (-priority, next(self._counter), calc)
+            heapq.heappush(self._queue, entry)
 
+    def _add_known(self, comp: Comp, digest: Digest):
+        pending = [(comp, digest)]
+        while pending:
+            comp, digest = pending.pop()
+            self.digests[comp] = digest
+            if self.storage.can_restore(digest):
+                self._add_restorable(comp)
+            else:
+                self._check_ready(comp)
+
+            for child in self._children[comp]:
+                if child in self.calcs:
+                    continue
+                if not all(p in self.digests for p in child.parents):
+                    continue
+
+                calc = self.calcs[child] = _get_calc(child, self.digests)
+                self._comps_by_calc[calc].add(child)
+                try:
+                    result = self.log.get_result(calc, child.loc)
+                except NotFoundException:
+                    self._check_ready(child)
+                    continue
+
+                pending.append((child, result.digest))
+
+    def _add_restorable(self, comp: Comp):
+        self.restorable.add(comp)
+
+        # Remove the comp from the needed ones, along with any ancestors
+        # that were only needed to produce it.
+        unneeded = [comp] if comp in self.needed else []
+        while unneeded:
+            unneeded_comp = unneeded.pop()
+            self.needed.remove(unneeded_comp)
+
+            calc = self.calcs.get(unneeded_comp)
+            if calc in self._ready:
+                self._ready[calc].discard(unneeded_comp)
+                if not self._ready[calc]:
+                    del self._ready[calc]
+
+            for parent in unneeded_comp.parents:
+                self._needed_children[parent] -= 1
+                if (
+                    parent in self.needed
+                    and not self._needed_children[parent]
+                    and parent not in self.requested
+                ):
+                    unneeded.append(parent)
+
+        for child in self._children[comp]:
+            self._check_ready(child)
+
+
+def _get_run(calc, results, start_time, end_time, storage: Storage):
     for result in results:
         assert storage.can_restore(result.digest), result
 
-    log.save_run(
+    return dict(
         calc=calc, results=results, start_time=start_time, end_time=end_time
     )
 
 
-def _ensure_available(requested: Iterable[Comp], log: Log, storage: Storage):
+def _run_calc(calc: Calc, out_locs: Iterable[Loc], storage: Storage):
+
+    start_time = datetime.datetime.utcnow()
+    results = calc.op.run(calc.inputs, out_locs, storage)
+    end_time = datetime.datetime.utcnow()
+
+    return _get_run(calc, results, start_time, end_time, storage)
+
+
+async def _run_calc_async(
+    calc: Calc, out_locs: Iterable[Loc], storage: Storage
+):
+
+    start_time = datetime.datetime.utcnow()
+    results = await calc.op.run_async(calc.inputs, out_locs, storage)
+    end_time = datetime.datetime.utcnow()
+
+    return _get_run(calc, results, start_time, end_time, storage)
+
+
+def _prefetch_inputs(scheduler: Scheduler, storage: Storage):
+    # Download the inputs of the calcs to run, if they are only in the
+    # remote of the storage, all at once instead of one run at a time.
+    digests = {
+        scheduler.digests[parent]
+        for comp in scheduler.needed
+        for parent in comp.parents
+        if parent in scheduler.restorable
+    }
+    storage.prefetch(digests)
+
+
+def _finish_run(run, scheduler: Scheduler, log: Log, storage: Storage):
+    log.save_run(**run)
+    storage.upload_async(r.digest for r in run["results"])
+    scheduler.finish(run["calc"], run["results"])
+
+
+def _ensure_available(
+    requested: Iterable[Comp],
+    log: Log,
+    storage: Storage,
+    jobs: int,
+    executor: concurrent.futures.Executor,
+) -> Scheduler:
+    # The ops run in the executor, but all runs are recorded in the
+    # log from this thread, as soon as each of them finishes. After each
+    # finished run, newly runnable calcs are started right away to keep
+    # all the workers busy.
+
+    scheduler = Scheduler(requested, log, storage)
+    _prefetch_inputs(scheduler, storage)
+    running: Dict[concurrent.futures.Future, Calc] = {}
+    error = None
+
     while True:
-        comps_to_run = _get_ready_and_needed(requested, log, storage)
-        if not comps_to_run:
+        while error is None and len(running) < jobs:
+            ready = scheduler.pop_ready()
+            if ready is None:
+                break
+            calc, out_locs = ready
+            future = executor.submit(_run_calc, calc, out_locs, storage)
+            running[future] = calc
+
+        if not running:
             break
 
-        comps_by_calc: Mapping[Calc, Set[Comp]] = defaultdict(set)
-        for comp in comps_to_run:
-            calc = log.get_calc(comp)
-            comps_by_calc[calc].add(comp)
+        # Commit the recorded runs if they have waited long enough, or
+        # wake up when they have.
+        done, _ = concurrent.futures.wait(
+            running,
+            timeout=log.flush_due(),
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
 
-        for calc, comps in comps_by_calc.items():
-            out_locs = set(comp.loc for comp in comps)
-            _run_calc(calc, out_locs, log, storage)
+        for future in done:
+            calc = running.pop(future)
+            try:
+                _finish_run(future.result(), scheduler, log, storage)
+            except Exception as e:
+                # Stop starting new runs, but let the running ones
+                # finish and record them before raising.
+                if error is None:
+                    error = e
 
+    if error is not None:
+        raise error
 
-def make(requested: Sequence[Comp], log: Log, storage: Storage):
-    time = datetime.datetime.utcnow()
-    _ensure_available(requested, log, storage)
+    assert scheduler.done, scheduler.needed
+
+    return scheduler
+
+
+async def _ensure_available_async(
+    requested: Iterable[Comp],
+    log: Log,
+    storage: Storage,
+    jobs: int,
+    log_executor: concurrent.futures.Executor,
+) -> Scheduler:
+    # Like _ensure_available(), but the ops run as tasks on the event loop.
+    # The planning and the log writes are done in log_executor, to keep
+    # them off the loop.
+
+    loop = asyncio.get_event_loop()
+    scheduler = await loop.run_in_executor(
+        log_executor, Scheduler, requested, log, storage
+    )
+    await loop.run_in_executor(None, _prefetch_inputs, scheduler, storage)
+    running: Dict[asyncio.Future, Calc] = {}
+    error = None
+
+    try:
+        while True:
+            while error is None and len(running) < jobs:
+                ready = scheduler.pop_ready()
+                if ready is None:
+                    break
+                calc, out_locs = ready
+                task = asyncio.ensure_future(
+                    _run_calc_async(calc, out_locs, storage)
+                )
+                running[task] = calc
+
+            if not running:
+                break
+
+            timeout = await loop.run_in_executor(log_executor, log.flush_due)
+            done, _ = await asyncio.wait(
+                running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for task in done:
+                calc = running.pop(task)
+                try:
+                    await loop.run_in_executor(
+                        log_executor,
+                        _finish_run,
+                        task.result(),
+                        scheduler,
+                        log,
+                        storage,
+                    )
+                except Exception as e:
+                    # Stop starting new runs, but let the running ones
+                    # finish and record them before raising.
+                    if error is None:
+                        error = e
+    finally:
+        # If we leave early, e.g. because this task was cancelled,
+        # do not leave the runs behind, but wait for them to clean up.
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    if error is not None:
+        raise error
+
+    assert scheduler.done, scheduler.needed
+
+    return scheduler
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class Plan:
+    """
+    What make() would do to make some requested comps.
 
-    results = {}
-    for comp in requested:
-        calc = log.get_calc(comp)
-        digest = log.get_result(calc, comp.loc).digest
-        log.save_response(comp, digest, time)
-        results[comp] = digest
+    Attributes:
+        restorable: The upstream comps that can already be restored.
+        calcs: The known calcs that will be run.
+        pending: Comps that will be run too, but whose calcs are not known
+            until some of the other calcs have been run.
+        estimated_duration: The expected wall time of the make, with the
+            given number of jobs. The durations of the runs are estimated
+            from earlier runs of the same ops.
+        total_duration: The expected time of all the runs, one after the
+            other.
+        critical_path: The expected time of the longest chain of runs
+            that depend on each other, i.e., the least wall time with any
+            number of jobs.
+        unestimated_runs: The number of runs left out of the estimates,
+            because their ops have never been run before.
+    """
 
+    restorable: FrozenSet[Comp]
+    calcs: FrozenSet[Calc]
+    pending: FrozenSet[Comp]
+    estimated_duration: datetime.timedelta
+    total_duration: datetime.timedelta
+    critical_path: datetime.timedelta
+    unestimated_runs: int
+
+
+_Run = Tuple[Op, Tuple[Comp, ...]]
+
+
+def _estimate_makespan(
+    durations: Mapping[_Run, float],
+    parents: Mapping[_Run, Set[_Run]],
+    priorities: Mapping[_Run, float],
+    jobs: int,
+) -> float:
+    # Simulate the runs as make() starts them: at most jobs at a time,
+    # and of the ready ones those with the longest critical path first.
+    counter = itertools.count()
+    children: Dict[_Run, List[_Run]] = defaultdict(list)
+    waiting: Dict[_Run, int] = {}
+    ready: List[Tuple[float, int, _Run]] = []
+    for run, run_parents in parents.items():
+        waiting[run] = len(run_parents)
+        for parent in run_parents:
+            children[parent].append(run)
+        if not run_parents:
+            ready.append((-priorities[run], next(counter), run))
+    heapq.heapify(ready)
+
+    running: List[Tuple[float, int, _Run]] = []
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < jobs:
+            _, _, run = heapq.heappop(ready)
+            entry = (now + durations[run], next(counter), run)
+            heapq.heappush(running, entry)
+
+        now, _, run = heapq.heappop(running)
+        for child in children[run]:
+            waiting[child] -= 1
+            if not waiting[child]:
+                entry = (-priorities[child], next(counter), child)
+                heapq.heappush(ready, entry)
+
+    return now
+
+
+def plan(
+    requested: Sequence[Comp], log: Log, storage: Storage, jobs: int = 1
+) -> Plan:
+    """
+    Find out what make() would do, without running anything.
+
+    Args:
+        requested: The comps to make.
+        log: The log of previous runs.
+        storage: The storage where results are kept.
+        jobs: The number of calcs that make() would run concurrently.
+
+    Returns:
+        A Plan.
+    """
+    if jobs < 1:
+        raise ValueError(f"jobs must be at least 1, got {jobs}")
+
+    # Ops that have never been run are left out of the estimates, also
+    # of the critical paths.
+    with log.caching():
+        scheduler = Scheduler(
+            requested, log, storage, default_duration=datetime.timedelta()
+        )
+
+    needed = scheduler.needed
+    concrete = needed & scheduler.calcs.keys()
+    calcs = frozenset(scheduler.calcs[comp] for comp in concrete)
+    pending = frozenset(needed - concrete)
+
+    # Comps with the same op and parents are always made by the same run.
+    runs: Dict[_Run, Set[_Run]] = {}
+    priorities: Dict[_Run, float] = {}
+    for comp in needed:
+        run = (comp.op, comp.parents)
+        runs[run] = set(
+            (parent.op, parent.parents)
+            for parent in comp.parents
+            if parent in needed
+        )
+        priorities[run] = scheduler.priorities[comp]
+
+    mean_durations = log.get_mean_durations(op.op_id for op, _ in runs)
+    durations: Dict[_Run, float] = {}
+    unestimated_runs = 0
+    for run in runs:
+        op, _ = run
+        if op.op_id in mean_durations:
+            durations[run] = mean_durations[op.op_id].total_seconds()
+        else:
+            durations[run] = 0.0
+            unestimated_runs += 1
+
+    makespan = _estimate_makespan(durations, runs, priorities, jobs)
+
+    return Plan(
+        restorable=frozenset(scheduler.restorable),
+        calcs=calcs,
+        pending=pending,
+        estimated_duration=datetime.timedelta(seconds=makespan),
+        total_duration=datetime.timedelta(seconds=sum(durations.values())),
+        critical_path=datetime.timedelta(
+            seconds=max(priorities.values(), default=0)
+        ),
+        unestimated_runs=unestimated_runs,
+    )
+
+
+def _save_responses(
+    requested: Sequence[Comp],
+    scheduler: Scheduler,
+    log: Log,
+    time: datetime.datetime,
+) -> Mapping[Comp, Digest]:
+    results = {comp: scheduler.digests[comp] for comp in requested}
+    log.save_responses(results.items(), time)
     return results
+
+
+def make(
+    requested: Sequence[Comp],
+    log: Log,
+    storage: Storage,
+    jobs: int = 1,
+    executor: Optional[concurrent.futures.Executor] = None,
+):
+    """
+    Make the requested comps available in the storage.
+
+    Args:
+        requested: The comps to make.
+        log: The log of previous runs, where new runs are recorded.
+        storage: The storage where results are kept.
+        jobs: The maximum number of calcs to run concurrently.
+        executor: Where to run the ops. By default, a thread pool with
+            one thread per job. The executor must be able to reach the
+            storage; see boyleworkflow.distributed.QueueExecutor for
+            running ops in other processes or on other machines.
+
+    Returns:
+        A dict mapping each requested comp to the digest of its result.
+    """
+    if jobs < 1:
+        raise ValueError(f"jobs must be at least 1, got {jobs}")
+
+    time = datetime.datetime.utcnow()
+
+    with contextlib.ExitStack() as stack:
+        # Runs after the others, so that all the runs are done.
+        stack.callback(storage.wait_for_uploads)
+
+        if executor is None:
+            executor = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+            )
+
+        stack.enter_context(log.caching())
+        stack.enter_context(log.batching())
+
+        scheduler = _ensure_available(
+            requested, log, storage, jobs, executor
+        )
+        return _save_responses(requested, scheduler, log, time)
+
+
+async def make_async(
+    requested: Sequence[Comp], log: Log, storage: Storage, jobs: int = 1
+):
+    """
+    Make the requested comps available in the storage, asynchronously.
+
+    This is like make(), but the ops are run with Op.run_async() as tasks
+    on the running event loop, so that many ops that mostly wait (such as
+    shell commands) can be in progress without a thread for each of them.
+
+    Args:
+        requested: The comps to make.
+        log: The log of previous runs, where new runs are recorded.
+        storage: The storage where results are kept.
+        jobs: The maximum number of calcs to run concurrently.
+
+    Returns:
+        A dict mapping each requested comp to the digest of its result.
+    """
+    if jobs < 1:
+        raise ValueError(f"jobs must be at least 1, got {jobs}")
+
+    time = datetime.datetime.utcnow()
+    loop = asyncio.get_event_loop()
+
+    # The log caches and batches per thread, so it is only used from one
+    # thread, which also closes its connection at the end.
+    log_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    log_contexts = contextlib.ExitStack()
+    log_contexts.callback(log.close_thread)
+
+    def enter_log_contexts():
+        log_contexts.enter_context(log.caching())
+        log_contexts.enter_context(log.batching())
+
+    try:
+        await loop.run_in_executor(log_executor, enter_log_contexts)
+        scheduler = await _ensure_available_async(
+            requested, log, storage, jobs, log_executor
+        )
+        return await loop.run_in_executor(
+            log_executor, _save_responses, requested, scheduler, log, time
+        )
+    finally:
+        try:
+            await loop.run_in_executor(log_executor, log_contexts.close)
+        finally:
+            log_executor.shutdown(wait=False)
+            await loop.run_in_executor(None, storage.wait_for_uploads)
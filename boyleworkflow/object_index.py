@@ -0,0 +1,354 @@
+"""
+An index of the files in a Storage, to detect modified objects.
+
+Objects are hardlinked out of the store, so they can be modified through
+the restored files. Each file in the store is therefore recorded with its
+(size, mtime_ns, inode) when it is written, and only used while its stat
+still matches. The index also records when each object was last used.
+
+Small objects may instead be packed (see packs), and the index then
+records where in which pack each is.
+
+The entries are kept in memory once read, so each is read from the
+database about once per process. Entries written by other processes are
+found by reading again when an entry is missing or does not match.
+"""
+
+from typing import Dict, Iterable, Iterator, List, Tuple
+import os
+import sqlite3
+import threading
+
+from boyleworkflow.util import PathLike
+
+_SCHEMA = """
+create table if not exists file (
+  name text primary key,
+  size integer not null,
+  mtime_ns integer not null,
+  inode integer not null
+);
+
+create table if not exists object (
+  digest text primary key,
+  last_used_ns integer not null
+);
+
+create table if not exists packed (
+  digest text primary key,
+  pack text not null,
+  offset integer not null,
+  size integer not null
+);
+
+create index if not exists packed_by_pack on packed (pack);
+"""
+
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER, which may be as low as 999.
+_QUERY_BATCH_SIZE = 500
+
+FileKey = Tuple[int, int, int]
+
+# The (pack, offset, size) of a packed object.
+PackedKey = Tuple[str, int, int]
+
+
+def get_file_key(stat: os.stat_result) -> FileKey:
+    """The part of a stat that the index records, to compare with."""
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def _batches(items: List, size: int = _QUERY_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class ObjectIndex:
+    """
+    An index of files and object usage in an SQLite database.
+
+    The index can be used from several threads and processes. The files
+    are identified by their names (not paths), so that they can be moved
+    within the store.
+
+    Args:
+        path: The SQLite database file, created if needed.
+    """
+
+    def __init__(self, path: PathLike):
+        self.path = path
+        self._init_state()
+
+    def _init_state(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._files: Dict[str, FileKey] = {}
+        self._packed: Dict[str, PackedKey] = {}
+
+    def __getstate__(self):
+        # Connections cannot be pickled, e.g., to send a Storage to
+        # worker processes, which open their own.
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._init_state()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        try:
+            return self._local.conn
+        except AttributeError:
+            pass
+
+        conn = sqlite3.connect(str(self.path), timeout=10)
+        # Readers do not block the writer. A crash may lose the latest
+        # entries, which only makes the objects unusable. Switching needs
+        # the database to itself, so the threads do not try at once.
+        with self._lock:
+            (journal_mode,) = conn.execute("PRAGMA journal_mode").fetchone()
+            if journal_mode != "wal":
+                conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        with conn:
+            conn.executescript(_SCHEMA)
+        self._local.conn = conn
+        return conn
+
+    def get_files(
+        self, names: Iterable[str], refresh: bool = False
+    ) -> Dict[str, FileKey]:
+        """
+        Look up files.
+
+        Args:
+            names: The file names.
+            refresh: Read the entries from the database even if they are
+                in memory, e.g., because they do not match.
+
+        Returns:
+            A dict mapping the names of the recorded files to their keys.
+        """
+        names = list(names)
+        found: Dict[str, FileKey] = {}
+        with self._lock:
+            if not refresh:
+                for name in names:
+                    key = self._files.get(name)
+                    if key is not None:
+                        found[name] = key
+
+        missing = [name for name in names if name not in found]
+        loaded: Dict[str, FileKey] = {}
+        conn = self._get_conn()
+        for batch in _batches(missing):
+            placeholders = ", ".join("?" * len(batch))
+            for name, size, mtime_ns, inode in conn.execute(
+                "SELECT name, size, mtime_ns, inode FROM file "
+                f"WHERE name IN ({placeholders})",
+                batch,
+            ):
+                loaded[name] = (size, mtime_ns, inode)
+
+        with self._lock:
+            self._files.update(loaded)
+        found.update(loaded)
+        return found
+
+    def put_files(self, files: Iterable[Tuple[str, os.stat_result]]):
+        """
+        Record files as they are now.
+
+        Args:
+            files: Pairs of (name, stat).
+        """
+        entries = {name: get_file_key(stat) for name, stat in files}
+        conn = self._get_conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO file (name, size, mtime_ns, inode) "
+                "VALUES (?, ?, ?, ?)",
+                [(name,) + key for name, key in entries.items()],
+            )
+        with self._lock:
+            self._files.update(entries)
+
+    def remove_files(self, names: Iterable[str]):
+        names = list(names)
+        conn = self._get_conn()
+        with conn:
+            conn.executemany(
+                "DELETE FROM file WHERE name = ?", [(n,) for n in names]
+            )
+        with self._lock:
+            for name in names:
+                self._files.pop(name, None)
+
+    def set_last_used(self, last_used: Dict[str, int]):
+        """
+        Record when objects were last used.
+
+        Args:
+            last_used: A dict mapping digests to times in ns since epoch.
+        """
+        conn = self._get_conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO object (digest, last_used_ns) "
+                "VALUES (?, ?)",
+                list(last_used.items()),
+            )
+
+    def get_last_used(self, digests: Iterable[str]) -> Dict[str, int]:
+        """
+        Look up when objects were last used.
+
+        Args:
+            digests: The digests of the objects.
+
+        Returns:
+            A dict mapping the digests of the used objects to times in ns
+            since epoch. Objects never used are left out.
+        """
+        last_used: Dict[str, int] = {}
+        conn = self._get_conn()
+        for batch in _batches(list(digests)):
+            placeholders = ", ".join("?" * len(batch))
+            last_used.update(
+                conn.execute(
+                    "SELECT digest, last_used_ns FROM object "
+                    f"WHERE digest IN ({placeholders})",
+                    batch,
+                )
+            )
+        return last_used
+
+    def remove_objects(self, digests: Iterable[str]):
+        conn = self._get_conn()
+        with conn:
+            conn.executemany(
+                "DELETE FROM object WHERE digest = ?",
+                [(d,) for d in digests],
+            )
+
+    def get_packed(
+        self, digests: Iterable[str], refresh: bool = False
+    ) -> Dict[str, PackedKey]:
+        """
+        Look up packed objects.
+
+        Args:
+            digests: The digests of the objects.
+            refresh: Read the entries from the database even if they are
+                in memory, e.g., because the pack was removed.
+
+        Returns:
+            A dict mapping the digests of the packed objects to their
+            (pack, offset, size).
+        """
+        digests = list(digests)
+        found: Dict[str, PackedKey] = {}
+        with self._lock:
+            if not refresh:
+                for digest in digests:
+                    key = self._packed.get(digest)
+                    if key is not None:
+                        found[digest] = key
+
+        missing = [digest for digest in digests if digest not in found]
+        loaded: Dict[str, PackedKey] = {}
+        conn = self._get_conn()
+        for batch in _batches(missing):
+            placeholders = ", ".join("?" * len(batch))
+            for digest, pack, offset, size in conn.execute(
+                "SELECT digest, pack, offset, size FROM packed "
+                f"WHERE digest IN ({placeholders})",
+                batch,
+            ):
+                loaded[digest] = (pack, offset, size)
+
+        with self._lock:
+            self._packed.update(loaded)
+        found.update(loaded)
+        return found
+
+    def put_packed(self, entries: Iterable[Tuple[str, str, int, int]]):
+        """
+        Record packed objects.
+
+        Args:
+            entries: Tuples of (digest, pack, offset, size).
+        """
+        entries = list(entries)
+        conn = self._get_conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO packed (digest, pack, offset, size) "
+                "VALUES (?, ?, ?, ?)",
+                entries,
+            )
+        with self._lock:
+            for digest, pack, offset, size in entries:
+                self._packed[digest] = (pack, offset, size)
+
+    def remove_packed(self, digests: Iterable[str]):
+        digests = list(digests)
+        conn = self._get_conn()
+        with conn:
+            conn.executemany(
+                "DELETE FROM packed WHERE digest = ?", [(d,) for d in digests]
+            )
+        with self._lock:
+            for digest in digests:
+                self._packed.pop(digest, None)
+
+    def iter_packed(
+        self, batch_size: int = _QUERY_BATCH_SIZE
+    ) -> Iterator[Tuple[str, str, int, int]]:
+        """
+        List the packed objects, a batch at a time.
+
+        Returns:
+            An iterator of (digest, pack, offset, size).
+        """
+        last = ""
+        while True:
+            rows = (
+                self._get_conn()
+                .execute(
+                    "SELECT digest, pack, offset, size FROM packed "
+                    "WHERE digest > ? ORDER BY digest LIMIT ?",
+                    (last, batch_size),
+                )
+                .fetchall()
+            )
+            if not rows:
+                return
+            yield from rows
+            last = rows[-1][0]
+
+    def get_pack_usage(self) -> Dict[str, int]:
+        """
+        Sum up the sizes of the objects in each pack.
+
+        Returns:
+            A dict mapping the names of the packs to the bytes in use.
+        """
+        return dict(
+            self._get_conn().execute(
+                "SELECT pack, SUM(size) FROM packed GROUP BY pack"
+            )
+        )
+
+    def get_pack_entries(self, pack: str) -> List[Tuple[str, int, int]]:
+        """
+        List the objects in a pack, as (digest, offset, size).
+        """
+        return (
+            self._get_conn()
+            .execute(
+                "SELECT digest, offset, size FROM packed WHERE pack = ? "
+                "ORDER BY offset",
+                (pack,),
+            )
+            .fetchall()
+        )
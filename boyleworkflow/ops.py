@@ -1,7 +1,10 @@
-from typing import Iterable, Mapping, cast
+from typing import Iterable, Mapping, List, Dict, cast
 import os
 import tempfile
 import subprocess
+import asyncio
+import threading
+import contextlib
 from pathlib import Path
 
 import attr
@@ -11,7 +14,7 @@ from boyleworkflow.loc import Loc, is_valid_loc, SpecialFilePath, BASE_DIR
 from boyleworkflow.storage import Digest
 from boyleworkflow.util import PathLike, id_property, unique_json
 from boyleworkflow.log import Log
-from boyleworkflow.storage import Storage
+from boyleworkflow.storage import Storage, ObjectWriter
 
 
 class RunError(Exception):
@@ -24,6 +27,43 @@ _SPECIAL_FILE_MODES = {
     SpecialFilePath.STDERR: "wb",
 }
 
+_PIPE_BUFFER_SIZE = 1 << 16
+
+
+def _capture(pipe, writer: ObjectWriter, errors: List[Exception]):
+    # After an error, keep reading so that the process does not block.
+    with pipe:
+        while True:
+            data = pipe.read(_PIPE_BUFFER_SIZE)
+            if not data:
+                break
+            if errors:
+                continue
+            try:
+                writer.write(data)
+            except Exception as e:
+                errors.append(e)
+
+
+async def _capture_async(stream: asyncio.StreamReader, writer: ObjectWriter):
+    while True:
+        data = await stream.read(_PIPE_BUFFER_SIZE)
+        if not data:
+            break
+        writer.write(data)
+
+
+async def _run_in_executor(func, *args):
+    # Like loop.run_in_executor(), but if cancelled, wait for func to
+    # return before raising, e.g., so that it is not left writing to a
+    # temporary directory that is being removed.
+    future = asyncio.get_event_loop().run_in_executor(None, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
 
 def is_inside(path, parent):
     try:
@@ -61,13 +101,10 @@ class ShellOp(Op):
     def op_id(self):
         return attr.asdict(self)
 
-    def run(
-        self,
-        inputs: Iterable[Result],
-        out_locs: Iterable[Loc],
-        storage: Storage,
-    ) -> Iterable[Result]:
-
+    @contextlib.contextmanager
+    def _make_dirs(self):
+        # Set up a temporary directory, and yield (container_dir,
+        # base_dir, work_dir). The inputs are to be placed in base_dir.
         with tempfile.TemporaryDirectory() as td:
             container_dir = Path(td).resolve()
 
@@ -78,48 +115,188 @@ class ShellOp(Op):
 
             work_dir.mkdir(parents=True)
 
-            place_inputs(inputs, base_dir, storage)
-
-            devnull = cast(PathLike, os.devnull)
+            yield container_dir, base_dir, work_dir
 
-            def open_special_file(file, activated):
-                if activated:
-                    path = (base_dir / file.value).resolve()
-                    assert is_inside(path, container_dir), (path, container_dir)
-                    assert not is_inside(path, base_dir), (path, base_dir)
+    @contextlib.contextmanager
+    def _open_special_files(
+        self,
+        container_dir: Path,
+        base_dir: Path,
+        out_locs: List[Loc],
+        storage: Storage,
+    ):
+        # Open the special files, once the inputs are placed, and yield
+        # (special_files, writers). The special files that are outputs
+        # are pipes, to be written to the storage with the writers, by
+        # loc.
+        devnull = cast(PathLike, os.devnull)
+
+        def open_special_file(file, activated):
+            if activated:
+                path = (base_dir / file.value).resolve()
+                assert is_inside(path, container_dir), (path, container_dir)
+                assert not is_inside(path, base_dir), (path, base_dir)
+            else:
+                path = devnull
+
+            return open(path, _SPECIAL_FILE_MODES[file])
+
+        special_files = {}
+        writers: Dict[Loc, ObjectWriter] = {}
+        try:
+            for name, file, activated in [
+                ("stdin", SpecialFilePath.STDIN, self.stdin),
+                ("stdout", SpecialFilePath.STDOUT, self.stdout),
+                ("stderr", SpecialFilePath.STDERR, self.stderr),
+            ]:
+                loc = Loc(file.value)
+                if activated and name != "stdin" and loc in out_locs:
+                    special_files[name] = subprocess.PIPE
+                    writers[loc] = storage.open_writer()
                 else:
-                    path = devnull
+                    special_files[name] = open_special_file(file, activated)
+
+            yield special_files, writers
+        finally:
+            for file in special_files.values():
+                if file != subprocess.PIPE:
+                    file.close()
+            # Only stored if closed.
+            for writer in writers.values():
+                writer.discard()
 
-                return open(path, _SPECIAL_FILE_MODES[file])
+    def _check_returncode(self, returncode: int, inputs: Iterable[Result]):
+        if returncode != 0:
+            e = subprocess.CalledProcessError(returncode, self.cmd)
+            info = {"op": self, "inputs": inputs, "message": str(e)}
+            raise RunError(info) from e
 
-            special_files = dict(
-                stdin=open_special_file(SpecialFilePath.STDIN, self.stdin),
-                stdout=open_special_file(SpecialFilePath.STDOUT, self.stdout),
-                stderr=open_special_file(SpecialFilePath.STDERR, self.stderr),
+    def _store_outputs(
+        self,
+        work_dir: PathLike,
+        out_locs: List[Loc],
+        writers: Mapping[Loc, ObjectWriter],
+        storage: Storage,
+    ) -> List[Result]:
+        # The captured outputs are already hashed, so only the other
+        # outputs need to be read.
+        file_locs = [loc for loc in out_locs if loc not in writers]
+        digests = dict(
+            zip(
+                file_locs,
+                storage.store_many(
+                    os.path.join(work_dir, loc) for loc in file_locs
+                ),
             )
+        )
+        for loc, writer in writers.items():
+            digests[loc] = writer.close()
 
-            try:
-                proc = subprocess.run(
+        return [Result(loc, digests[loc]) for loc in out_locs]
+
+    def run(
+        self,
+        inputs: Iterable[Result],
+        out_locs: Iterable[Loc],
+        storage: Storage,
+    ) -> Iterable[Result]:
+
+        out_locs = list(out_locs)
+        with self._make_dirs() as (container_dir, base_dir, work_dir):
+            place_inputs(inputs, base_dir, storage)
+            with self._open_special_files(
+                container_dir, base_dir, out_locs, storage
+            ) as (special_files, writers):
+                proc = subprocess.Popen(
                     self.cmd, cwd=work_dir, shell=self.shell, **special_files
                 )
-            finally:
-                for file in special_files.values():
-                    file.close()
 
-            try:
-                proc.check_returncode()
-            except subprocess.CalledProcessError as e:
-                info = {"op": self, "inputs": inputs, "message": str(e)}
-                raise RunError(info) from e
+                # Read stdout and stderr at the same time, so that the
+                # process never blocks on a full pipe.
+                errors: List[Exception] = []
+                threads = [
+                    threading.Thread(
+                        target=_capture,
+                        args=(getattr(proc, name), writers[loc], errors),
+                    )
+                    for name, loc in [
+                        ("stdout", SpecialFilePath.STDOUT.value),
+                        ("stderr", SpecialFilePath.STDERR.value),
+                    ]
+                    if loc in writers
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                returncode = proc.wait()
+                if errors:
+                    raise errors[0]
+
+                self._check_returncode(returncode, inputs)
+
+                return self._store_outputs(
+                    work_dir, out_locs, writers, storage
+                )
 
-            return [
-                Result(loc, storage.store(os.path.join(work_dir, loc)))
-                for loc in out_locs
-            ]
+    async def _run_process(self, work_dir: Path, special_files, writers):
+        if self.shell:
+            proc = await asyncio.create_subprocess_shell(
+                self.cmd, cwd=work_dir, **special_files
+            )
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                self.cmd, cwd=work_dir, **special_files
+            )
+
+        # If anything goes wrong, e.g., the run is cancelled, do not leave
+        # the process running in the work dir that is about to be removed.
+        try:
+            await asyncio.gather(
+                *(
+                    _capture_async(getattr(proc, name), writers[loc])
+                    for name, loc in [
+                        ("stdout", SpecialFilePath.STDOUT.value),
+                        ("stderr", SpecialFilePath.STDERR.value),
+                    ]
+                    if loc in writers
+                )
+            )
+            return await proc.wait()
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+
+    async def run_async(
+        self,
+        inputs: Iterable[Result],
+        out_locs: Iterable[Loc],
+        storage: Storage,
+    ) -> Iterable[Result]:
+
+        # Restoring the inputs and hashing the outputs may take a while,
+        # so keep them off the loop.
+        out_locs = list(out_locs)
+        with self._make_dirs() as (container_dir, base_dir, work_dir):
+            await _run_in_executor(place_inputs, inputs, base_dir, storage)
+            with self._open_special_files(
+                container_dir, base_dir, out_locs, storage
+            ) as (special_files, writers):
+                returncode = await self._run_process(
+                    work_dir, special_files, writers
+                )
+
+                self._check_returncode(returncode, inputs)
+
+                return await _run_in_executor(
+                    self._store_outputs, work_dir, out_locs, writers, storage
+                )
 
 
 @attr.s(auto_attribs=True, frozen=True)
-class RenameOp:
+class RenameOp(Op):
     inp_loc: Loc
     out_loc: Loc
 
@@ -142,3 +319,11 @@ class RenameOp:
         inp_digest = digests[self.inp_loc]
 
         return [Result(self.out_loc, inp_digest)]
+
+    async def run_async(
+        self,
+        inputs: Iterable[Result],
+        out_locs: Iterable[Loc],
+        storage: Storage,
+    ) -> Iterable[Result]:
+        return self.run(inputs, out_locs, storage)
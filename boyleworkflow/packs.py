@@ -0,0 +1,166 @@
+"""
+Packfiles, which keep many small objects in one file.
+
+Small objects cost a file (and an inode) each in the store, which makes
+listing, syncing and removing them slow. Instead they can be appended to
+a pack, with the (pack, offset, size) of each recorded in the
+ObjectIndex.
+
+Each process appends to packs of its own, and holds an exclusive lock on
+the pack it writes to, so that repacking skips it. New packs are locked
+before they get their name, and each object is recorded in the index
+before the pack is unlocked. Packs are never modified otherwise: objects
+are removed from the index, and the packs compacted later (see
+Storage.repack()).
+"""
+
+from typing import BinaryIO, Callable, Optional, Tuple
+import os
+import datetime
+import uuid
+import threading
+
+from boyleworkflow.util import PathLike
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+PACK_SUFFIX = ".pack"
+
+# New packs are created under another name, until they are locked.
+NEW_PACK_SUFFIX = ".pack-new"
+
+# Start a new pack when the current one would grow larger than this.
+MAX_PACK_SIZE = 1 << 26
+
+# Empty or unindexed packs younger than this may be about to be written
+# to, e.g., without locks, so they are not removed.
+MIN_PACK_AGE = datetime.timedelta(hours=1)
+
+
+def _lock(f: BinaryIO, block: bool = True) -> bool:
+    if fcntl is None:
+        # Without locks, no pack is known to be unused.
+        return False
+    flags = fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB
+    try:
+        fcntl.flock(f.fileno(), flags)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def open_unused(path: PathLike) -> Optional[BinaryIO]:
+    """
+    Open a pack that no process writes to.
+
+    The pack stays locked while the returned file is open.
+
+    Returns:
+        The pack opened for reading, or None if it is in use.
+    """
+    f = open(path, "rb")
+    if not _lock(f, block=False):
+        f.close()
+        return None
+    return f
+
+
+class PackWriter:
+    """
+    Append objects to packs in a directory.
+
+    Args:
+        pack_dir: The directory of the packs, created if needed.
+        max_size: The size at which to start a new pack.
+
+    Attributes:
+        current: The name of the pack written to, if any.
+    """
+
+    def __init__(self, pack_dir: PathLike, max_size: int = MAX_PACK_SIZE):
+        self.pack_dir = pack_dir
+        self.max_size = max_size
+        self._init_state()
+
+    def _init_state(self):
+        self.current: Optional[str] = None
+        self._lock = threading.Lock()
+        self._file: Optional[BinaryIO] = None
+        self._size = 0
+
+    def __getstate__(self):
+        # Each process writes to packs of its own.
+        return {"pack_dir": self.pack_dir, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.pack_dir = state["pack_dir"]
+        self.max_size = state["max_size"]
+        self._init_state()
+
+    def _open_new(self):
+        self._close()
+        os.makedirs(self.pack_dir, exist_ok=True)
+        stem = os.path.join(self.pack_dir, f"pack-{uuid.uuid4().hex}")
+        path = stem + PACK_SUFFIX
+        new_path = stem + NEW_PACK_SUFFIX
+        # Lock the pack before repacking can find it.
+        f = open(new_path, "xb")
+        try:
+            _lock(f)
+            os.rename(new_path, path)
+        except BaseException:
+            f.close()
+            os.remove(new_path)
+            raise
+        self._file = f
+        self._size = 0
+        self.current = os.path.basename(path)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self.current = None
+
+    def append(
+        self,
+        data: bytes,
+        record: Optional[Callable[[str, int], None]] = None,
+    ) -> Tuple[str, int]:
+        """
+        Append an object to the current pack.
+
+        The data is flushed to the operating system, so that other
+        processes can read it once it is recorded in the index.
+
+        Args:
+            data: The object.
+            record: Called with (pack, offset) while the pack is still
+                locked, to record the object in the index before the
+                pack can be repacked.
+
+        Returns:
+            The (pack, offset) of the object.
+        """
+        with self._lock:
+            if self._file is None or (
+                self._size and self._size + len(data) > self.max_size
+            ):
+                self._open_new()
+            offset = self._size
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            if record is not None:
+                record(self.current, offset)
+            return self.current, offset
+
+    def close(self):
+        """
+        Close the current pack, so that it can be repacked.
+        """
+        with self._lock:
+            self._close()
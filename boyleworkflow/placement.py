@@ -0,0 +1,206 @@
+"""
+Place files in and out of a Storage, also across file systems.
+
+Hardlinks are the cheapest way, but only work within a file system. The
+Placer tries a chain of strategies, from hardlinks to plain copies, and
+remembers the first one that works for each pair of file systems.
+"""
+
+from typing import Callable, Dict, List, Tuple
+import os
+import sys
+import errno
+import shutil
+import logging
+import threading
+from collections import Counter
+
+from boyleworkflow.util import PathLike
+
+logger = logging.getLogger(__name__)
+
+HARDLINK = "hardlink"
+REFLINK = "reflink"
+COPY_FILE_RANGE = "copy_file_range"
+SENDFILE = "sendfile"
+COPY = "copy"
+
+# Errors meaning that a strategy does not work between two file systems.
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+}
+
+# Errors meaning that a strategy does not work for this file only, e.g.,
+# too many links to it, or a hardlink to a file of another user with
+# fs.protected_hardlinks.
+_TRANSIENT_ERRNOS = {errno.EMLINK, errno.EPERM}
+
+# From linux/fs.h.
+_FICLONE = 0x40049409
+
+_BUFFER_SIZE = 1 << 20
+
+
+def _unsupported():
+    return OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+
+def _hardlink(src_path: PathLike, dst_path: PathLike):
+    os.link(src_path, dst_path)
+
+
+def _copy_with(copy_func: Callable[[int, int, int], None]):
+    # Make a strategy that creates the file and copies the contents with
+    # copy_func(src_fd, dst_fd, size).
+    def strategy(src_path: PathLike, dst_path: PathLike):
+        with open(src_path, "rb") as src, open(dst_path, "xb") as dst:
+            try:
+                size = os.fstat(src.fileno()).st_size
+                copy_func(src.fileno(), dst.fileno(), size)
+            except BaseException:
+                os.remove(dst_path)
+                raise
+        shutil.copymode(src_path, dst_path)
+
+    return strategy
+
+
+def _reflink_fds(src_fd: int, dst_fd: int, size: int):
+    if not sys.platform.startswith("linux"):
+        raise _unsupported()
+    import fcntl
+
+    fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+
+
+def _copy_file_range_fds(src_fd: int, dst_fd: int, size: int):
+    try:
+        copy_file_range = os.copy_file_range  # type: ignore
+    except AttributeError:
+        # Python < 3.8 or not Linux.
+        raise _unsupported()
+
+    copied = 0
+    while copied < size:
+        n = copy_file_range(src_fd, dst_fd, size - copied)
+        if not n:
+            break
+        copied += n
+
+
+def _sendfile_fds(src_fd: int, dst_fd: int, size: int):
+    if not sys.platform.startswith("linux"):
+        # Elsewhere, sendfile() may only send to sockets.
+        raise _unsupported()
+
+    copied = 0
+    while copied < size:
+        n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if not n:
+            break
+        copied += n
+
+
+def _copy_fds(src_fd: int, dst_fd: int, size: int):
+    while True:
+        data = os.read(src_fd, _BUFFER_SIZE)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            n = os.write(dst_fd, view)
+            view = view[n:]
+
+
+STRATEGIES: List[Tuple[str, Callable[[PathLike, PathLike], None]]] = [
+    (HARDLINK, _hardlink),
+    (REFLINK, _copy_with(_reflink_fds)),
+    (COPY_FILE_RANGE, _copy_with(_copy_file_range_fds)),
+    (SENDFILE, _copy_with(_sendfile_fds)),
+    (COPY, _copy_with(_copy_fds)),
+]
+
+
+def _get_device(path: PathLike) -> int:
+    return os.stat(path).st_dev
+
+
+class Placer:
+    """
+    Create files as hardlinks or copies of other files.
+
+    The first strategy in STRATEGIES that works between two file systems
+    is remembered, so the ones before it are only tried once.
+
+    Attributes:
+        counts: A Counter of (operation, strategy) for each placed file.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._choices: Dict[Tuple[int, int], int] = {}
+        self.counts: Counter = Counter()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def place(
+        self, src_path: PathLike, dst_path: PathLike, operation: str
+    ) -> str:
+        """
+        Create dst_path with the same contents as src_path.
+
+        Copies get the same mode as the original file.
+
+        Args:
+            src_path: An existing file.
+            dst_path: The new file, which must not exist.
+            operation: A name to count the placement under, e.g., "store".
+
+        Returns:
+            The name of the strategy used.
+        """
+        dst_dir = os.path.dirname(os.path.abspath(dst_path))
+        key = (_get_device(src_path), _get_device(dst_dir))
+
+        with self._lock:
+            first = self._choices.get(key, 0)
+
+        # The first strategy not known to be unsupported for this pair.
+        supported = first
+        for i in range(first, len(STRATEGIES)):
+            name, strategy = STRATEGIES[i]
+            try:
+                strategy(src_path, dst_path)
+            except OSError as e:
+                if e.errno in _TRANSIENT_ERRNOS and i + 1 < len(STRATEGIES):
+                    # Try the next strategy for this file only.
+                    continue
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                logger.debug(f"Cannot use {name} for {key}: {e}")
+                if supported == i:
+                    # Not after a strategy that failed for this file only.
+                    supported = i + 1
+                continue
+
+            with self._lock:
+                if self._choices.get(key, 0) < supported:
+                    self._choices[key] = supported
+                    logger.info(
+                        f"Using {STRATEGIES[supported][0]} or later for "
+                        f"file systems {key}"
+                    )
+                self.counts[(operation, name)] += 1
+            return name
+
+        # The plain copy only fails for other reasons.
+        raise AssertionError("no placement strategy worked")
@@ -0,0 +1,161 @@
+"""
+Remote caches of objects, shared between several Storages.
+
+A Storage with a remote falls back to it for objects it does not have,
+and can upload the objects it makes, so that teammates and CI can reuse
+each other's results (given a shared Log).
+"""
+
+from typing import BinaryIO, Callable, Iterable, List, Set
+import os
+import uuid
+import shutil
+import logging
+import threading
+import concurrent.futures
+
+import attr
+
+from boyleworkflow.util import PathLike, set_file_permissions, split_digest
+
+logger = logging.getLogger(__name__)
+
+
+class Remote:
+    """
+    A remote cache of objects, identified by digest.
+
+    Objects are transferred whole: chunked files as their contents and
+    trees as their listings, with the entries as objects of their own.
+    The Storage checks the digest of everything it downloads.
+    """
+
+    def has_many(self, digests: Iterable[str]) -> Set[str]:
+        """
+        Check which objects the remote has.
+
+        Args:
+            digests: The digests of the objects.
+
+        Returns:
+            The digests of the objects that the remote has.
+        """
+        raise NotImplementedError
+
+    def open(self, digest: str) -> BinaryIO:
+        """
+        Open an object for reading.
+
+        Raises:
+            FileNotFoundError: If the remote does not have the object.
+        """
+        raise NotImplementedError
+
+    def put(self, digest: str, f: BinaryIO):
+        """
+        Upload an object, read from a file opened in binary mode.
+        """
+        raise NotImplementedError
+
+
+@attr.s(auto_attribs=True)
+class DirectoryRemote(Remote):
+    """
+    A remote in a directory, e.g., on a network file system.
+
+    Each object is kept at remote_dir/ab/<digest>.
+
+    Args:
+        remote_dir: The directory, created if needed.
+    """
+
+    remote_dir: PathLike
+
+    def _get_path(self, digest: str) -> PathLike:
+        _, hex_digest = split_digest(digest)
+        return os.path.join(self.remote_dir, hex_digest[:2], digest)
+
+    def has_many(self, digests: Iterable[str]) -> Set[str]:
+        return {d for d in digests if os.path.exists(self._get_path(d))}
+
+    def open(self, digest: str) -> BinaryIO:
+        return open(self._get_path(digest), "rb")
+
+    def put(self, digest: str, f: BinaryIO):
+        path = self._get_path(digest)
+        if os.path.exists(path):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "xb") as dst:
+                shutil.copyfileobj(f, dst, 1 << 20)
+            set_file_permissions(temp_path, write=False, read=True)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class UploadQueue:
+    """
+    Run uploads in background threads.
+
+    Failed uploads are logged, as the objects are still in the Storage.
+
+    Args:
+        max_workers: The number of uploads at a time.
+
+    Attributes:
+        uploaded: The number of uploads finished.
+        failed: The number of uploads failed.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max_workers
+        self._init_state()
+
+    def _init_state(self):
+        self.uploaded = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._futures: List[concurrent.futures.Future] = []
+
+    def __getstate__(self):
+        # Pending uploads stay with the original.
+        return {"max_workers": self.max_workers}
+
+    def __setstate__(self, state):
+        self.max_workers = state["max_workers"]
+        self._init_state()
+
+    def _run(self, func: Callable, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            logger.warning(f"Upload failed: {e}")
+            with self._lock:
+                self.failed += 1
+        else:
+            with self._lock:
+                self.uploaded += 1
+
+    def submit(self, func: Callable, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers
+                )
+            self._futures.append(self._executor.submit(self._run, func, *args))
+
+    def wait(self):
+        """
+        Wait until all uploads submitted so far are done.
+        """
+        with self._lock:
+            futures = self._futures
+            self._futures = []
+        concurrent.futures.wait(futures)
@@ -1,4 +1,5 @@
 PRAGMA foreign_keys = ON;
+PRAGMA user_version = 3;
 
 create table op (
   op_id text primary key, -- id based on definition
@@ -42,6 +43,7 @@ create table trust (
   loc text,
   digest text,
   opinion boolean,
+  source text, -- null if set by the user
   foreign key(calc_id) references calc(calc_id),
   primary key (calc_id, loc, digest) --, time)
 );
@@ -1,11 +1,57 @@
-from typing import NewType
+from typing import (
+    NewType,
+    Optional,
+    Iterator,
+    Iterable,
+    Container,
+    Set,
+    Tuple,
+    List,
+    Dict,
+    Mapping,
+    BinaryIO,
+)
+import io
 import os
+import bz2
+import gzip
+import lzma
+import zlib
+import json
+import time
 import shutil
 import logging
+import threading
+import uuid
+import datetime
+import concurrent.futures
 
 import attr
 
-from boyleworkflow.util import set_file_permissions, PathLike, digest_file
+from boyleworkflow.util import (
+    set_file_permissions,
+    PathLike,
+    digest_file,
+    get_hasher,
+    make_digest,
+    split_digest,
+    is_tree_digest,
+    unique_json,
+    DEFAULT_ALGORITHM,
+    TREE_PREFIX,
+)
+from boyleworkflow.digest_cache import DigestCache
+from boyleworkflow.chunking import iter_chunks
+from boyleworkflow.placement import Placer
+from boyleworkflow.object_index import ObjectIndex, FileKey, get_file_key
+from boyleworkflow.packs import (
+    MIN_PACK_AGE,
+    NEW_PACK_SUFFIX,
+    PACK_SUFFIX,
+    PackWriter,
+    open_unused,
+)
+from boyleworkflow.remote import Remote, UploadQueue
 
 logger = logging.getLogger(__name__)
 
@@ -16,84 +62,1798 @@ class RestoreError(Exception):
 
 Digest = NewType("Digest", str)
 
+LAYOUT_FILE = "layout.json"
+
+# Compressed objects are kept in the cold tier as <digest><suffix>.
+CODECS = {
+    "gzip": (gzip.open, ".gz"),
+    "bz2": (bz2.open, ".bz2"),
+    "lzma": (lzma.open, ".xz"),
+}
+
+# Large files may be stored as a list of chunks, in <digest><suffix>.
+CHUNKS_SUFFIX = ".chunks"
+
+# Files stored as chunks must be at least this many times the chunk size.
+_MIN_CHUNKS = 4
+
+HOT = "hot"
+COLD = "cold"
+PACKED = "packed"
+CHUNKED = "chunked"
+TIERS = (HOT, COLD, PACKED, CHUNKED)
+
+# The kinds of files an object may have, in order of preference, and the
+# suffixes of their names.
+_FILE_KINDS = (HOT,) + tuple(CODECS) + (CHUNKED,)
+_FILE_SUFFIXES = dict(
+    [(HOT, "")]
+    + [(codec, suffix) for codec, (_, suffix) in CODECS.items()]
+    + [(CHUNKED, CHUNKS_SUFFIX)]
+)
+
+# The kinds of objects, in order of preference: files, or PACKED.
+_OBJECT_KINDS = (HOT,) + tuple(CODECS) + (PACKED, CHUNKED)
+
+# Directories in the storage_dir that do not hold objects.
+META_DIR = "meta"
+CACHE_DIR = "cache"
+PACK_DIR = "packs"
+
+# Corrupt objects are moved here by quarantine(), for inspection.
+QUARANTINE_DIR = "quarantine"
+
+# The ObjectIndex, in the META_DIR.
+INDEX_FILE = "index.db"
+
+# Characters of the digest used for each level of subdirectories.
+SHARD_WIDTH = 2
+
+# With two levels, a store of 100 million objects has about 1500
+# entries per directory.
+DEFAULT_SHARD_DEPTH = 2
+
+
+def _read_shard_depth(storage_dir: PathLike) -> Optional[int]:
+    try:
+        with open(os.path.join(storage_dir, LAYOUT_FILE), "r") as f:
+            return json.load(f)["shard_depth"]
+    except FileNotFoundError:
+        return None
+
+
+def _write_shard_depth(storage_dir: PathLike, shard_depth: int):
+    path = os.path.join(storage_dir, LAYOUT_FILE)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"shard_depth": shard_depth}, f)
+    os.replace(temp_path, path)
+
+
+def _now_ns() -> int:
+    return int(time.time() * 10 ** 9)
+
+
+def _get_stat_key(path: PathLike) -> Optional[FileKey]:
+    try:
+        return get_file_key(os.stat(path))
+    except FileNotFoundError:
+        return None
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class CompressionReport:
+    """
+    The outcome of Storage.compress_cold().
+
+    Attributes:
+        objects: The number of objects moved to the cold tier.
+        bytes_before: Their total size before compression.
+        bytes_after: Their total size after compression.
+    """
+
+    objects: int = 0
+    bytes_before: int = 0
+    bytes_after: int = 0
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class SweepReport:
+    """
+    The outcome of Storage.sweep().
+
+    Attributes:
+        objects_kept: The number of objects kept.
+        objects_removed: The number of objects removed.
+        bytes_removed: Their total size (compressed for the cold tier).
+    """
+
+    objects_kept: int = 0
+    objects_removed: int = 0
+    bytes_removed: int = 0
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class RepackReport:
+    """
+    The outcome of Storage.repack().
+
+    Attributes:
+        packs: The number of packs removed.
+        objects: The number of objects copied to new packs.
+        bytes_freed: The space freed.
+    """
+
+    packs: int = 0
+    objects: int = 0
+    bytes_freed: int = 0
+
+
+class ObjectWriter:
+    """
+    A new object, hashed while it is written. See Storage.open_writer().
+
+    The contents are written to a temporary file in the store, which is
+    moved into place when the writer is closed. A writer that is not
+    closed can be discarded instead.
+
+    Attributes:
+        digest: The digest of the object, once closed.
+    """
+
+    def __init__(self, storage: "Storage"):
+        self._storage = storage
+        self._temp_path = storage._get_temp_path(
+            os.path.join(storage.storage_dir, "stream")
+        )
+        self._hasher = get_hasher(storage.digest_algorithm)
+        self._file = open(self._temp_path, "xb")
+        self.digest: Optional[Digest] = None
+
+    def write(self, data: bytes) -> int:
+        self._hasher.update(data)
+        return self._file.write(data)
+
+    def close(self) -> Digest:
+        """
+        Store the object, if not done already.
+
+        Returns:
+            The digest of the object.
+        """
+        if self.digest is None:
+            self._file.close()
+            digest = Digest(
+                make_digest(
+                    self._storage.digest_algorithm, self._hasher.hexdigest()
+                )
+            )
+            try:
+                self._storage._store_temp(self._temp_path, digest)
+            finally:
+                self.discard()
+            self.digest = digest
+        return self.digest
+
+    def discard(self):
+        """
+        Remove the temporary file, unless the object is stored.
+        """
+        self._file.close()
+        try:
+            os.remove(self._temp_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class RestoreStats:
+    """
+    The number of restores and the time they took, for each tier.
+
+    Restores from the cold tier include the decompression, restores of
+    packed objects the copying out of the pack, and restores of chunked
+    files the reassembly.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {tier: 0 for tier in TIERS}
+        self.seconds: Dict[str, float] = {tier: 0.0 for tier in TIERS}
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def add(self, tier: str, seconds: float):
+        with self._lock:
+            self.counts[tier] += 1
+            self.seconds[tier] += seconds
+
+    def mean_seconds(self, tier: str) -> Optional[float]:
+        with self._lock:
+            if not self.counts[tier]:
+                return None
+            return self.seconds[tier] / self.counts[tier]
+
 
 @attr.s(auto_attribs=True)
 class Storage:
+    """
+    A content-addressed store of files.
+
+    Each object is kept at storage_dir/ab/cd/<digest>, with as many levels
+    of subdirectories as the shard depth, and recorded in an ObjectIndex
+    in storage_dir/meta. The shard depth is recorded in the storage_dir
+    when it is created. Stores created before sharding existed have no
+    record and use the flat layout (shard depth 0) until migrated with
+    migrate_layout().
+
+    The digest algorithm is part of each digest (see util.make_digest),
+    so a store can hold digests made with different algorithms.
+
+    Directories are stored as trees: each file is stored as an object,
+    and each directory as a listing of the digests of its entries. A
+    directory is restored by hardlinking each file.
+
+    Files are hardlinked into and out of the store where possible. Across
+    file systems, they are copied instead, as cheaply as possible (see
+    placement.Placer).
+
+    Large files can be stored as content-defined chunks (see chunking),
+    so that similar versions of a file share most of their chunks. The
+    chunks are stored as objects, and a chunked file is restored by
+    writing the chunks to a new file instead of hardlinking.
+
+    Small files can be packed together into packfiles in
+    storage_dir/packs (see packs), instead of a file each. A packed
+    object is restored by writing it to a new file, and its contents can
+    be read directly with read_bytes(). Packs are compacted with repack().
+
+    Objects that have not been used for a while can be moved to a
+    compressed cold tier with compress_cold(). They are decompressed into
+    the (hot) object path when restored again.
+
+    With a Remote, objects that are not in the store are looked up in the
+    remote, and downloaded when restored or prefetched. New objects are
+    only uploaded on request, with upload_async().
+
+    Args:
+        storage_dir: The directory of the store.
+        shard_depth: The number of levels of subdirectories. By default,
+            use the depth of the existing store, or DEFAULT_SHARD_DEPTH
+            for a new store.
+        digest_algorithm: The hashlib algorithm for new digests.
+        use_digest_cache: Whether to remember the digests of stored files
+            in a DigestCache, to avoid hashing them again while unchanged.
+        chunk_size: If given, store files of at least four times this size
+            as chunks of about this size. By default, do not chunk.
+        remote: A Remote to fall back to, if any.
+        pack_threshold: If given, pack objects smaller than this many
+            bytes. By default, do not pack.
+
+    Attributes:
+        digest_cache: The DigestCache, or None if not used.
+        index: The ObjectIndex.
+        restore_stats: The RestoreStats of this Storage object.
+        placer: The Placer of this Storage object, which counts how each
+            file was stored and restored.
+        uploads: The UploadQueue of this Storage object.
+        packs: The PackWriter of this Storage object.
+    """
+
     storage_dir: PathLike
+    shard_depth: Optional[int] = None
+    digest_algorithm: str = DEFAULT_ALGORITHM
+    use_digest_cache: bool = True
+    chunk_size: Optional[int] = None
+    remote: Optional[Remote] = None
+    pack_threshold: Optional[int] = None
+    digest_cache: Optional[DigestCache] = attr.ib(
+        init=False, default=None, eq=False, repr=False
+    )
+    index: ObjectIndex = attr.ib(
+        init=False, default=None, eq=False, repr=False
+    )
+    restore_stats: RestoreStats = attr.ib(
+        init=False, factory=RestoreStats, eq=False, repr=False
+    )
+    placer: Placer = attr.ib(init=False, factory=Placer, eq=False, repr=False)
+    uploads: UploadQueue = attr.ib(
+        init=False, factory=UploadQueue, eq=False, repr=False
+    )
+    packs: PackWriter = attr.ib(
+        init=False, default=None, eq=False, repr=False
+    )
 
     def __attrs_post_init__(self):
-        os.makedirs(self.storage_dir, exist_ok=True)
-        os.makedirs(os.path.join(self.storage_dir, "meta"), exist_ok=True)
+        # Fail early on unknown algorithms.
+        get_hasher(self.digest_algorithm)
+
+        recorded_depth = _read_shard_depth(self.storage_dir)
+        if recorded_depth is None:
+            if os.path.isdir(os.path.join(self.storage_dir, META_DIR)):
+                # Created before sharding existed.
+                recorded_depth = 0
+            else:
+                recorded_depth = self.shard_depth
+                if recorded_depth is None:
+                    recorded_depth = DEFAULT_SHARD_DEPTH
+                os.makedirs(self.storage_dir, exist_ok=True)
+                _write_shard_depth(self.storage_dir, recorded_depth)
+
+        if self.shard_depth is None:
+            self.shard_depth = recorded_depth
+        elif self.shard_depth != recorded_depth:
+            raise ValueError(
+                f"{self.storage_dir} has shard depth {recorded_depth}, "
+                f"not {self.shard_depth}; see Storage.migrate_layout()"
+            )
+
+        meta_dir = os.path.join(self.storage_dir, META_DIR)
+        os.makedirs(meta_dir, exist_ok=True)
+        self.index = ObjectIndex(os.path.join(meta_dir, INDEX_FILE))
+        self._import_markers()
+        self.packs = PackWriter(os.path.join(self.storage_dir, PACK_DIR))
+
+        if self.use_digest_cache:
+            self.digest_cache = DigestCache(
+                os.path.join(self.storage_dir, CACHE_DIR, "digests.db")
+            )
+
+    def _get_shard(self, digest: Digest) -> Tuple[str, ...]:
+        _, hex_digest = split_digest(digest)
+        return tuple(
+            hex_digest[i * SHARD_WIDTH : (i + 1) * SHARD_WIDTH]
+            for i in range(self.shard_depth)
+        )
 
     def _get_store_path(self, digest: Digest) -> PathLike:
-        return os.path.join(self.storage_dir, digest)
+        return os.path.join(self.storage_dir, *self._get_shard(digest), digest)
 
-    def _get_meta_path(self, digest: Digest) -> PathLike:
-        return os.path.join(self.storage_dir, "meta", digest)
+    def _make_dirs(self, digest: Digest):
+        if self.shard_depth:
+            shard = self._get_shard(digest)
+            os.makedirs(os.path.join(self.storage_dir, *shard), exist_ok=True)
 
-    def _appears_unchanged(self, digest: Digest):
-        src_path = self._get_store_path(digest)
-        meta_path = self._get_meta_path(digest)
+    def _get_chunks_path(self, digest: Digest) -> PathLike:
+        return f"{self._get_store_path(digest)}{CHUNKS_SUFFIX}"
 
-        src_mtime = os.path.getmtime(src_path)
-        meta_mtime = os.path.getmtime(meta_path)
+    def _get_compressed_path(self, digest: Digest, codec: str) -> PathLike:
+        _, suffix = CODECS[codec]
+        return f"{self._get_store_path(digest)}{suffix}"
 
-        if meta_mtime != src_mtime:
-            return False
+    def _get_file_path(self, digest: Digest, kind: str) -> PathLike:
+        # The path of the HOT, compressed (by codec) or CHUNKED file.
+        return f"{self._get_store_path(digest)}{_FILE_SUFFIXES[kind]}"
 
-        return True
+    def _get_temp_path(self, path: PathLike) -> PathLike:
+        return f"{path}.{uuid.uuid4().hex}.tmp"
+
+    def _record(self, digest: Digest, kind: str):
+        # Record a file in the index as it is now. Another thread or
+        # process may store the object again meanwhile, and record it
+        # before this, so check that the entry still matches the file.
+        path = self._get_file_path(digest, kind)
+        stat = os.stat(path)
+        while True:
+            self.index.put_files([(os.path.basename(path), stat)])
+            current = os.stat(path)
+            if get_file_key(current) == get_file_key(stat):
+                return
+            stat = current
 
-    def _set_meta(self, digest: Digest):
-        src_path = self._get_store_path(digest)
-        meta_path = self._get_meta_path(digest)
+    def _touch(self, digest: Digest):
+        # Record that the object is used now, e.g., for sweep().
+        self.index.set_last_used({digest: _now_ns()})
 
+    def _find_files(self, digests: Iterable[Digest]) -> Dict[Digest, List]:
+        """
+        Find the files of some objects that are unmodified since stored,
+        and the packed objects.
+
+        Returns:
+            A dict mapping each digest to a list of the kinds of objects
+            found (HOT, a codec, PACKED or CHUNKED), in the order of
+            _OBJECT_KINDS.
+        """
+        names = {
+            (digest, kind): f"{digest}{_FILE_SUFFIXES[kind]}"
+            for digest in set(digests)
+            for kind in _FILE_KINDS
+        }
+        found: Dict[Digest, Set[str]] = {digest: set() for digest, _ in names}
+
+        # Only files in the index need to be checked on disk.
+        entries = self.index.get_files(names.values())
+        mismatched = {}
+        for key, name in names.items():
+            entry = entries.get(name)
+            if entry is None:
+                continue
+            stat_key = _get_stat_key(self._get_file_path(*key))
+            if stat_key == entry:
+                found[key[0]].add(key[1])
+            elif stat_key is not None:
+                mismatched[key] = stat_key
+
+        # Another process may have stored the file again since the entry
+        # was read.
+        if mismatched:
+            entries = self.index.get_files(
+                (names[key] for key in mismatched), refresh=True
+            )
+            for key, stat_key in mismatched.items():
+                if entries.get(names[key]) == stat_key:
+                    found[key[0]].add(key[1])
+
+        # Packed objects are checked when read instead.
+        for digest in self.index.get_packed(found):
+            found[digest].add(PACKED)
+
+        return {
+            digest: [kind for kind in _OBJECT_KINDS if kind in kinds]
+            for digest, kinds in found.items()
+        }
+
+    def _get_kinds(self, digest: Digest) -> List[str]:
+        return self._find_files([digest])[digest]
+
+    def _find_cold(self, digest: Digest) -> Optional[str]:
+        # Return the codec of the compressed object, if any.
+        for kind in self._get_kinds(digest):
+            if kind in CODECS:
+                return kind
+        return None
+
+    def _is_hot(self, digest: Digest) -> bool:
+        return HOT in self._get_kinds(digest)
+
+    def _read_chunk_index(
+        self, digest: Digest, kinds: List[str] = None
+    ) -> Optional[List[Digest]]:
+        # Return the chunks of a chunked file, if it is stored as chunks.
+        if kinds is None:
+            kinds = self._get_kinds(digest)
+        if CHUNKED not in kinds:
+            return None
         try:
-            os.remove(meta_path)
+            with open(self._get_chunks_path(digest), "r") as f:
+                return json.load(f)["chunks"]
         except FileNotFoundError:
-            pass
+            return None
 
-        with open(meta_path, "w"):
-            pass
+    def _open_object(self, digest: Digest) -> BinaryIO:
+        # Open a (hot, cold or packed, but not chunked) object for reading.
+        for kind in self._get_kinds(digest):
+            if kind == HOT:
+                return open(self._get_store_path(digest), "rb")
+            if kind in CODECS:
+                open_func, _ = CODECS[kind]
+                return open_func(self._get_compressed_path(digest, kind), "rb")
+            if kind == PACKED:
+                return io.BytesIO(self._read_packed(digest))
+
+        raise RestoreError(f"error restoring {digest}")
+
+    def _check_bytes(self, data: bytes, digest: Digest) -> bool:
+        algorithm, hex_digest = split_digest(digest)
+        hasher = get_hasher(algorithm)
+        hasher.update(data)
+        return hasher.hexdigest() == hex_digest
+
+    def _read_pack_entry(self, digest: Digest) -> Optional[bytes]:
+        # Read a packed object without checking it, or return None if it
+        # is not packed.
+        for refresh in (False, True):
+            entry = self.index.get_packed([digest], refresh).get(digest)
+            if entry is None:
+                return None
+            pack, offset, size = entry
+            try:
+                with open(os.path.join(self._pack_dir, pack), "rb") as f:
+                    f.seek(offset)
+                    return f.read(size)
+            except FileNotFoundError:
+                # Moved to another pack by repack().
+                continue
+        return None
+
+    def _read_packed(self, digest: Digest) -> bytes:
+        # Read a packed object, checking its digest, as packs are not
+        # synced to disk before the index.
+        data = self._read_pack_entry(digest)
+        if data is not None and self._check_bytes(data, digest):
+            return data
+        if data is not None:
+            logger.warning(f"Wrong contents of packed {digest}")
+        raise RestoreError(f"error restoring {digest}")
+
+    @property
+    def _pack_dir(self) -> PathLike:
+        return os.path.join(self.storage_dir, PACK_DIR)
+
+    def read_bytes(self, digest: Digest) -> bytes:
+        """
+        Read the contents of a stored file into memory.
+
+        This avoids restoring small objects to files only to read them,
+        e.g., to load values.
+
+        Args:
+            digest: The digest of the file.
 
-        shutil.copystat(src_path, meta_path)
+        Returns:
+            The contents.
+        """
+        kinds = self._get_kinds(digest)
+        if not kinds and self._fetch(digest):
+            kinds = [HOT]
+        if kinds[:1] != [CHUNKED]:
+            with self._open_object(digest) as f:
+                data = f.read()
+        else:
+            chunks = self._read_chunk_index(digest, kinds) or []
+            data = b"".join(self.read_bytes(chunk) for chunk in chunks)
+
+        if not self._check_bytes(data, digest):
+            raise RestoreError(f"error restoring {digest}")
+        self._touch(digest)
+        return data
+
+    def _read_tree(self, digest: Digest) -> Dict[str, Digest]:
+        # Return the entries of a tree, as {name: digest}.
+        with self._open_object(digest) as f:
+            data = f.read()
+
+        return json.loads(data.decode("utf-8"))["entries"]
 
     def can_restore(self, digest: Digest) -> bool:
-        if not os.path.exists(self._get_store_path(digest)):
+        return self.can_restore_many([digest])[digest]
+
+    def _is_stored(self, digest: Digest) -> bool:
+        # Whether the object can be restored without the remote.
+        return self.can_restore_many([digest], local_only=True)[digest]
+
+    def can_restore_many(
+        self, digests: Iterable[Digest], local_only: bool = False
+    ) -> Dict[Digest, bool]:
+        """
+        Check which of several objects can be restored.
+
+        The objects are looked up together, and then their chunks and the
+        contents of trees, a level at a time. Objects that are not in the
+        store are looked up in the remote, if any. The listings of trees
+        found there are downloaded, to look up their contents.
+
+        Args:
+            digests: The digests of the objects.
+            local_only: Only check the store, not the remote.
+
+        Returns:
+            A dict mapping each digest to whether it can be restored.
+        """
+        # The digests each object needs, if it is stored, else None.
+        digests = set(digests)
+        needs: Dict[Digest, Optional[List[Digest]]] = {}
+        level = digests
+        while level:
+            kinds = self._find_files(level)
+            in_remote: Set[Digest] = set()
+            if not local_only:
+                in_remote = self._find_remote(d for d in level if not kinds[d])
+            next_level = set()
+            for digest in level:
+                if not kinds[digest] and digest in in_remote:
+                    if not is_tree_digest(digest):
+                        needs[digest] = []
+                        continue
+                    if self._fetch(digest):
+                        kinds[digest] = [HOT]
+
+                if not kinds[digest]:
+                    needs[digest] = None
+                    continue
+
+                needed = []
+                if kinds[digest][0] == CHUNKED:
+                    needed = self._read_chunk_index(digest, kinds[digest])
+                if needed is not None and is_tree_digest(digest):
+                    try:
+                        needed = list(self._read_tree(digest).values())
+                    except (RestoreError, OSError, ValueError):
+                        needed = None
+
+                needs[digest] = needed
+                next_level.update(d for d in needed or [] if d not in needs)
+            level = next_level
+
+        # An object can be restored if everything it needs can.
+        restorable: Dict[Digest, bool] = {}
+        expanded = set()
+        for digest in needs:
+            stack = [digest]
+            while stack:
+                current = stack[-1]
+                needed = needs[current]
+                if current in restorable:
+                    stack.pop()
+                elif needed is None:
+                    restorable[current] = False
+                elif current not in expanded:
+                    expanded.add(current)
+                    stack.extend(d for d in needed if d not in restorable)
+                else:
+                    # Anything still unknown here is part of a cycle,
+                    # which only a corrupt store can have.
+                    restorable[current] = all(
+                        restorable.get(d, False) for d in needed
+                    )
+
+        return {digest: restorable[digest] for digest in digests}
+
+    def _find_remote(self, digests: Iterable[Digest]) -> Set[Digest]:
+        digests = list(digests)
+        if self.remote is None or not digests:
+            return set()
+        try:
+            return self.remote.has_many(digests)
+        except OSError as e:
+            logger.warning(f"Cannot look up objects in {self.remote}: {e}")
+            return set()
+
+    def _has_digest(self, path: PathLike, digest: Digest) -> bool:
+        algorithm, _ = split_digest(digest)
+        prefix = TREE_PREFIX if is_tree_digest(digest) else ""
+        return prefix + digest_file(path, algorithm) == digest
+
+    def _fetch(self, digest: Digest) -> bool:
+        # Download an object from the remote into the store. Return
+        # whether it was found (with the right contents).
+        if self.remote is None:
             return False
 
-        if not self._appears_unchanged(digest):
+        self._make_dirs(digest)
+        temp_path = self._get_temp_path(self._get_store_path(digest))
+        try:
+            with self.remote.open(digest) as src:
+                with open(temp_path, "xb") as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+
+            if not self._has_digest(temp_path, digest):
+                logger.warning(f"Wrong contents of {digest} in {self.remote}")
+                return False
+
+            self._put_object(temp_path, digest)
+        except OSError as e:
+            logger.warning(f"Cannot download {digest} from {self.remote}: {e}")
             return False
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
+        logger.debug(f"Downloaded {digest} from {self.remote}")
         return True
 
+    def prefetch(
+        self, digests: Iterable[Digest], max_workers: Optional[int] = None
+    ) -> int:
+        """
+        Download objects (and their contents) that are only in the remote.
+
+        Args:
+            digests: The digests of the objects.
+            max_workers: The maximum number of downloads at a time. By
+                default, one per object up to four times the number of
+                CPUs, as downloads mostly wait.
+
+        Returns:
+            The number of objects downloaded.
+        """
+        if self.remote is None:
+            return 0
+
+        # This downloads the listings of trees, so that the contents can
+        # be found.
+        digests = [d for d, ok in self.can_restore_many(digests).items() if ok]
+        closure = self.get_closure(digests)
+        kinds = self._find_files(closure)
+        missing = [d for d in closure if not kinds[d]]
+        if not missing:
+            return 0
+
+        if max_workers is None:
+            max_workers = min(len(missing), 4 * (os.cpu_count() or 1))
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            fetched = sum(executor.map(self._fetch, missing))
+
+        logger.info(f"Prefetched {fetched} objects from {self.remote}")
+        return fetched
+
+    def upload_async(self, digests: Iterable[Digest]):
+        """
+        Upload objects (and their contents) to the remote in the background.
+
+        Objects that the remote already has are skipped. Failed uploads
+        are logged. See wait_for_uploads().
+
+        Args:
+            digests: The digests of the objects.
+        """
+        if self.remote is None:
+            return
+
+        for digest in digests:
+            self.uploads.submit(self._upload_tree, digest)
+
+    def wait_for_uploads(self):
+        """
+        Wait until the uploads started with upload_async() are done.
+        """
+        self.uploads.wait()
+
+    def _upload_tree(self, digest: Digest):
+        # Upload the object, and all the contents of trees. The chunks of
+        # chunked files are not uploaded, only the files.
+        # List the contents of each tree before it, so that the trees in
+        # the remote can always be restored.
+        digests = []
+        seen = set()
+        stack = [(digest, False)]
+        while stack:
+            digest, listed = stack.pop()
+            if listed:
+                digests.append(digest)
+                continue
+            if digest in seen:
+                continue
+            seen.add(digest)
+            stack.append((digest, True))
+            if is_tree_digest(digest):
+                entries = self._read_tree(digest).values()
+                stack.extend((entry, False) for entry in entries)
+
+        present = self.remote.has_many(digests)
+        for digest in digests:
+            if digest not in present:
+                self._upload(digest)
+
+    def _upload(self, digest: Digest):
+        kinds = self._get_kinds(digest)
+        if not kinds or kinds[0] != CHUNKED:
+            with self._open_object(digest) as f:
+                self.remote.put(digest, f)
+            return
+
+        temp_path = self._get_temp_path(self._get_store_path(digest))
+        self._restore_chunked(digest, temp_path)
+        try:
+            with open(temp_path, "rb") as f:
+                self.remote.put(digest, f)
+        finally:
+            os.remove(temp_path)
+
+    def get_closure(self, digests: Iterable[Digest]) -> Set[Digest]:
+        """
+        Add the contents of trees and chunked files to a set of digests.
+
+        Trees that cannot be read are left as they are.
+
+        Args:
+            digests: Some digests.
+
+        Returns:
+            A set with the digests, all digests in the trees and all
+            chunks of chunked files.
+        """
+        closure: Set[Digest] = set()
+        stack = list(digests)
+        while stack:
+            digest = stack.pop()
+            if digest in closure:
+                continue
+            closure.add(digest)
+
+            if is_tree_digest(digest):
+                try:
+                    stack.extend(self._read_tree(digest).values())
+                except (RestoreError, OSError, ValueError):
+                    logger.warning(f"Cannot read tree {digest}")
+
+            chunks = self._read_chunk_index(digest)
+            if chunks is not None:
+                closure.update(chunks)
+
+        return closure
+
+    def find_containing(
+        self, digests: Iterable[Digest], targets: Container[Digest]
+    ) -> Set[Digest]:
+        """
+        Find the digests that are, or contain, any of some targets.
+
+        Trees contain their entries, and chunked files their chunks.
+        Trees that cannot be read are taken to contain nothing.
+
+        Args:
+            digests: The digests to check.
+            targets: The digests to look for.
+
+        Returns:
+            The digests that are targets or contain a target.
+        """
+        contains: Dict[Digest, bool] = {}
+        visiting: Set[Digest] = set()
+        for digest in digests:
+            stack: List[Tuple[Digest, Optional[List[Digest]]]] = [
+                (digest, None)
+            ]
+            while stack:
+                current, children = stack.pop()
+                if children is not None:
+                    # The children are done. Those still being visited
+                    # form a cycle, which only a corrupt store can have.
+                    contains[current] = any(
+                        contains.get(child, False) for child in children
+                    )
+                    continue
+                if current in contains or current in visiting:
+                    continue
+                if current in targets:
+                    contains[current] = True
+                    continue
+
+                children = []
+                if is_tree_digest(current):
+                    try:
+                        children = list(self._read_tree(current).values())
+                    except (RestoreError, OSError, ValueError):
+                        logger.warning(f"Cannot read tree {current}")
+                children += self._read_chunk_index(current) or []
+                visiting.add(current)
+                stack.append((current, children))
+                stack.extend((child, None) for child in children)
+
+        return {digest for digest, found in contains.items() if found}
+
+    def _decompress(self, digest: Digest, codec: str):
+        # Decompress into the object path, where it can be hardlinked.
+        # The compressed object is kept until the next compress_cold().
+        src_path = self._get_compressed_path(digest, codec)
+        dst_path = self._get_store_path(digest)
+        temp_path = self._get_temp_path(dst_path)
+        open_func, _ = CODECS[codec]
+
+        with open_func(src_path, "rb") as src, open(temp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+        set_file_permissions(temp_path, write=False, read=True)
+        os.replace(temp_path, dst_path)
+        self._record(digest, HOT)
+
     def restore(self, digest: Digest, dst_path: PathLike):
         logger.debug(f"Restoring {digest} to {dst_path}")
 
-        if not self.can_restore(digest):
+        if is_tree_digest(digest):
+            if not self.can_restore(digest):
+                raise RestoreError(f"error restoring {digest}")
+            self._restore_tree(digest, dst_path)
+        else:
+            self._restore_file(digest, dst_path)
+
+    def _restore_tree(self, digest: Digest, dst_path: PathLike):
+        os.mkdir(dst_path)
+        for name, entry_digest in sorted(self._read_tree(digest).items()):
+            if name in (os.curdir, os.pardir) or os.sep in name:
+                raise RestoreError(f"invalid name {name!r} in {digest}")
+
+            entry_path = os.path.join(dst_path, name)
+            if is_tree_digest(entry_digest):
+                self._restore_tree(entry_digest, entry_path)
+            else:
+                self._restore_file(entry_digest, entry_path)
+
+        self._touch(digest)
+
+    def _restore_file(self, digest: Digest, dst_path: PathLike):
+        start = time.perf_counter()
+        tier = HOT
+
+        # Retry once, in case compress_cold() removes the object from
+        # the hot tier between the checks and the linking.
+        for attempt in range(2):
+            kinds = self._get_kinds(digest)
+            if not kinds and self._fetch(digest):
+                kinds = [HOT]
+            if HOT not in kinds:
+                codecs = [kind for kind in kinds if kind in CODECS]
+                if not codecs and PACKED in kinds:
+                    self._restore_packed(digest, dst_path)
+                    tier = PACKED
+                    break
+                if not codecs:
+                    self._restore_chunked(digest, dst_path)
+                    tier = CHUNKED
+                    break
+
+                self._decompress(digest, codecs[0])
+                tier = COLD
+
+            src_path = self._get_store_path(digest)
+            try:
+                set_file_permissions(src_path, write=False, read=True)
+                self.placer.place(src_path, dst_path, "restore")
+                break
+            except FileNotFoundError:
+                if attempt:
+                    raise
+
+        self._touch(digest)
+        self.restore_stats.add(tier, time.perf_counter() - start)
+
+    def _restore_packed(self, digest: Digest, dst_path: PathLike):
+        data = self._read_packed(digest)
+        # Only remove the file if this created it.
+        dst = open(dst_path, "xb")
+        try:
+            with dst:
+                dst.write(data)
+        except BaseException:
+            os.remove(dst_path)
+            raise
+        set_file_permissions(dst_path, write=False, read=True)
+
+    def _restore_chunked(self, digest: Digest, dst_path: PathLike):
+        chunks = self._read_chunk_index(digest)
+        if chunks is None:
             raise RestoreError(f"error restoring {digest}")
 
-        src_path = self._get_store_path(digest)
-        set_file_permissions(src_path, write=False, read=True)
+        # Check the digest while writing, as the chunks are not linked.
+        algorithm, _ = split_digest(digest)
+        hasher = get_hasher(algorithm)
+        # Only remove the file if this created it.
+        dst = open(dst_path, "xb")
+        try:
+            with dst:
+                for chunk in chunks:
+                    with self._open_object(chunk) as src:
+                        while True:
+                            data = src.read(1 << 20)
+                            if not data:
+                                break
+                            hasher.update(data)
+                            dst.write(data)
+
+            if make_digest(algorithm, hasher.hexdigest()) != digest:
+                raise RestoreError(f"error restoring {digest}")
+        except BaseException:
+            os.remove(dst_path)
+            raise
+
+        set_file_permissions(dst_path, write=False, read=True)
+
+    def open_writer(self) -> ObjectWriter:
+        """
+        Store an object by writing its contents.
+
+        The contents are hashed as they are written, instead of read back
+        afterwards like with store(). Ops that produce outputs in Python
+        (rather than as files) should write them with this.
 
-        os.link(src_path, dst_path)
+        Use it as a context manager, or close() it, to store the object:
+
+            with storage.open_writer() as writer:
+                writer.write(data)
+            digest = writer.digest
+
+        Returns:
+            An ObjectWriter.
+        """
+        return ObjectWriter(self)
+
+    def store_stream(self, f: BinaryIO) -> Digest:
+        """
+        Store the contents read from a binary file object, e.g., a pipe.
+
+        Returns:
+            The digest.
+        """
+        with self.open_writer() as writer:
+            while True:
+                data = f.read(1 << 20)
+                if not data:
+                    break
+                writer.write(data)
+        return writer.digest
+
+    def _store_temp(self, temp_path: PathLike, digest: Digest):
+        # Move a new temporary file in the store into place. Objects
+        # that are only in the remote are kept here too.
+        if self._is_stored(digest):
+            self._touch(digest)
+            return
+
+        size = os.stat(temp_path).st_size
+        if self._should_pack(size):
+            with open(temp_path, "rb") as f:
+                self._put_packed(f.read(), digest)
+            return
+
+        if self.chunk_size and size >= _MIN_CHUNKS * self.chunk_size:
+            # This reads the file again, but only the chunks are kept.
+            self._put_chunked(temp_path, digest)
+            return
+
+        set_file_permissions(temp_path, write=False, read=True)
+        self._make_dirs(digest)
+        os.replace(temp_path, self._get_store_path(digest))
+        self._record(digest, HOT)
+        self._touch(digest)
 
     def store(self, src_path: PathLike) -> Digest:
         logger.debug(f"Storing {src_path}")
-        digest = Digest(digest_file(src_path))
-        if self.can_restore(digest):
+
+        if os.path.isdir(src_path):
+            return self._store_tree(src_path)
+
+        stat = os.stat(src_path)
+        digest = None
+        if self.digest_cache is not None:
+            digest = self.digest_cache.get(stat, self.digest_algorithm)
+
+        # Small files are packed, so they are read into memory anyway.
+        data = None
+        is_cached = digest is not None
+        if not is_cached:
+            if self._should_pack(stat.st_size):
+                with open(src_path, "rb") as f:
+                    data = f.read()
+                digest = self._digest_bytes(data)
+            else:
+                digest = Digest(digest_file(src_path, self.digest_algorithm))
+
+        if self._is_stored(digest):
+            if not is_cached:
+                self._cache_digest(src_path, stat, digest)
+            # Storing counts as using the object, e.g., for sweep().
+            self._touch(digest)
             return digest
 
+        if self._should_pack(stat.st_size):
+            if data is None:
+                with open(src_path, "rb") as f:
+                    data = f.read()
+                if not self._check_bytes(data, digest):
+                    # Modified since the stat, so the cache is not updated.
+                    digest = self._digest_bytes(data)
+            self._put_packed(data, digest)
+        elif self.chunk_size and stat.st_size >= _MIN_CHUNKS * self.chunk_size:
+            self._put_chunked(src_path, digest)
+        else:
+            self._put_object(src_path, digest)
+
+        # Linking the file changed its ctime, so update the cache entry.
+        self._cache_digest(src_path, stat, digest)
+        return digest
+
+    def _should_pack(self, size: int) -> bool:
+        return self.pack_threshold is not None and size < self.pack_threshold
+
+    def _put_packed(self, data: bytes, digest: Digest):
+        def record(pack, offset):
+            self.index.put_packed([(digest, pack, offset, len(data))])
+
+        self.packs.append(data, record)
+        self._touch(digest)
+
+    def _put_object(self, src_path: PathLike, digest: Digest):
+        # Link (or copy) the file into the storage as the object with the
+        # digest.
         dst_path = self._get_store_path(digest)
+        self._make_dirs(digest)
+
+        # It is possible that a file with the given name exists,
+        # although the file cannot be restored. This happens if
+        # can_restore() returns False due to a suspected modification.
+        # Another thread may also be storing the same digest right now.
+        # So link the file under a unique name and replace the old one.
+        set_file_permissions(src_path, write=False, read=True)
+        temp_path = self._get_temp_path(dst_path)
+        self.placer.place(src_path, temp_path, "store")
+        os.replace(temp_path, dst_path)
         try:
-            # It is possible that a file with the given name exists,
-            # although the file cannot be restored. This happens if
-            # can_restore() returns False due to a suspected modification.
-            # So try to remove the file before linking in the new one.
-            os.remove(dst_path)
+            # If dst_path already was a link to the same file,
+            # os.replace() does nothing and leaves temp_path behind.
+            os.remove(temp_path)
         except FileNotFoundError:
             pass
 
-        set_file_permissions(src_path, write=False, read=True)
-        os.link(src_path, dst_path)
-        self._set_meta(digest)
+        self._record(digest, HOT)
+        self._touch(digest)
+
+    def _store_tree(self, src_dir: PathLike) -> Digest:
+        # List the directories and files, parents first.
+        dir_paths = []
+        file_paths = []
+        entries: Dict[PathLike, List[Tuple[str, PathLike, bool]]] = {}
+
+        stack = [src_dir]
+        while stack:
+            dir_path = stack.pop()
+            dir_paths.append(dir_path)
+            entries[dir_path] = []
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if is_dir:
+                        stack.append(entry.path)
+                    elif entry.is_dir():
+                        raise ValueError(
+                            f"symlinks to directories not supported: "
+                            f"{entry.path}"
+                        )
+                    else:
+                        file_paths.append(entry.path)
+                    entries[dir_path].append((entry.name, entry.path, is_dir))
+
+        # The files are hashed in parallel.
+        digests = dict(zip(file_paths, self.store_many(file_paths)))
+
+        # Then the listings, children before parents.
+        for dir_path in reversed(dir_paths):
+            listing = {
+                name: digests[path] for name, path, _ in entries[dir_path]
+            }
+            digests[dir_path] = self._store_listing(listing)
+
+        return digests[src_dir]
+
+    def _store_listing(self, listing: Mapping[str, Digest]) -> Digest:
+        data = unique_json({"entries": listing}).encode("utf-8")
+        return self._store_bytes(data, prefix=TREE_PREFIX)
+
+    def _digest_bytes(self, data: bytes, prefix: str = "") -> Digest:
+        hasher = get_hasher(self.digest_algorithm)
+        hasher.update(data)
+        return Digest(
+            prefix + make_digest(self.digest_algorithm, hasher.hexdigest())
+        )
+
+    def _store_bytes(self, data: bytes, prefix: str = "") -> Digest:
+        digest = self._digest_bytes(data, prefix)
+
+        if self._get_kinds(digest):
+            self._touch(digest)
+            return digest
+
+        if self._should_pack(len(data)):
+            self._put_packed(data, digest)
+            return digest
+
+        self._make_dirs(digest)
+        temp_path = self._get_temp_path(self._get_store_path(digest))
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        try:
+            self._put_object(temp_path, digest)
+        finally:
+            os.remove(temp_path)
+
         return digest
+
+    def _put_chunked(self, src_path: PathLike, digest: Digest):
+        # Store the chunks, and then the list of them.
+        with open(src_path, "rb") as f:
+            chunks = [
+                self._store_bytes(chunk)
+                for chunk in iter_chunks(f, self.chunk_size)
+            ]
+
+        self._make_dirs(digest)
+        index_path = self._get_chunks_path(digest)
+        temp_path = self._get_temp_path(index_path)
+        with open(temp_path, "w") as f:
+            json.dump({"chunks": chunks}, f)
+        set_file_permissions(temp_path, write=False, read=True)
+        os.replace(temp_path, index_path)
+
+        self._record(digest, CHUNKED)
+        self._touch(digest)
+
+    def _cache_digest(
+        self, src_path: PathLike, stat: os.stat_result, digest: Digest
+    ):
+        if self.digest_cache is not None:
+            self.digest_cache.put(
+                src_path, stat, self.digest_algorithm, digest
+            )
+
+    def store_many(
+        self, src_paths: Iterable[PathLike], max_workers: Optional[int] = None
+    ) -> List[Digest]:
+        """
+        Store several files, hashing them concurrently in threads.
+
+        Args:
+            src_paths: The files to store.
+            max_workers: The maximum number of threads. By default, one
+                per file up to the number of CPUs.
+
+        Returns:
+            The digests of the files, in the same order.
+        """
+        src_paths = list(src_paths)
+        if max_workers is None:
+            max_workers = min(len(src_paths), os.cpu_count() or 1)
+
+        if max_workers <= 1:
+            return [self.store(path) for path in src_paths]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(self.store, src_paths))
+
+    def _iter_objects(self) -> Iterator[Tuple[Digest, PathLike]]:
+        """
+        Find the objects in the store, whatever their layout.
+
+        Returns:
+            An iterator of (digest, path) for each object. The path is
+            that of a compressed file for objects in the cold tier, and
+            that of the list of chunks for chunked files. Objects in
+            several tiers are listed once for each.
+        """
+        suffixes = tuple(suffix for _, suffix in CODECS.values())
+        suffixes += (CHUNKS_SUFFIX,)
+        for dir_path, dir_names, file_names in os.walk(self.storage_dir):
+            if dir_path == self.storage_dir:
+                for name in [META_DIR, CACHE_DIR, PACK_DIR, QUARANTINE_DIR]:
+                    if name in dir_names:
+                        dir_names.remove(name)
+            for name in file_names:
+                if name == LAYOUT_FILE or name.endswith(".tmp"):
+                    continue
+                digest = name
+                if name.endswith(suffixes):
+                    digest, _ = os.path.splitext(name)
+                yield Digest(digest), os.path.join(dir_path, name)
+
+    def _import_markers(self):
+        # Stores from before the index had a marker file for each object
+        # in the META_DIR, with the mtime of the object and the atime of
+        # its last use. Record the objects with matching markers.
+        meta_dir = os.path.join(self.storage_dir, META_DIR)
+        markers = [
+            name
+            for name in os.listdir(meta_dir)
+            if not name.startswith(INDEX_FILE)
+        ]
+        if not markers:
+            return
+
+        files = []
+        last_used = {}
+        for digest, path in self._iter_objects():
+            rel_dir = os.path.relpath(os.path.dirname(path), self.storage_dir)
+            meta_path = os.path.join(meta_dir, rel_dir, digest)
+            try:
+                stat = os.stat(path)
+                meta_stat = os.stat(meta_path)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime_ns == meta_stat.st_mtime_ns:
+                files.append((os.path.basename(path), stat))
+                last_used[digest] = meta_stat.st_atime_ns
+
+        self.index.put_files(files)
+        self.index.set_last_used(last_used)
+
+        for name in markers:
+            path = os.path.join(meta_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+        logger.info(f"Imported {len(files)} files from markers to the index")
+
+    def compress_cold(
+        self, min_idle: datetime.timedelta, codec: str = "lzma"
+    ) -> CompressionReport:
+        """
+        Move objects that have not been used for a while to the cold tier.
+
+        Objects are used when stored or restored. This can run while
+        other processes use the store, e.g., periodically in the
+        background with `boyle compress`.
+
+        Args:
+            min_idle: How long an object must have been unused.
+            codec: The compression to use, one of CODECS.
+
+        Returns:
+            A CompressionReport.
+        """
+        open_func, _ = CODECS[codec]
+        report = CompressionReport()
+        idle_limit_ns = _now_ns() - int(min_idle.total_seconds() * 10 ** 9)
+
+        for digest, path in self._iter_objects():
+            if path != self._get_store_path(digest):
+                # Compressed, or not in the current layout.
+                continue
+
+            kinds = self._get_kinds(digest)
+            if HOT not in kinds or not self._is_idle(digest, idle_limit_ns):
+                continue
+
+            codecs = [kind for kind in kinds if kind in CODECS]
+            if codecs:
+                cold_codec = codecs[0]
+            else:
+                cold_codec = codec
+                cold_path = self._get_compressed_path(digest, codec)
+                temp_path = self._get_temp_path(cold_path)
+                with open(path, "rb") as src:
+                    with open_func(temp_path, "wb") as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+
+                set_file_permissions(temp_path, write=False, read=True)
+                os.replace(temp_path, cold_path)
+                self._record(digest, codec)
+
+            # The object may have been restored while it was compressed.
+            if not self._is_idle(digest, idle_limit_ns):
+                continue
+
+            cold_path = self._get_compressed_path(digest, cold_codec)
+            size_before = os.stat(path).st_size
+            size_after = os.stat(cold_path).st_size
+            os.remove(path)
+            self.index.remove_files([os.path.basename(path)])
+
+            report = CompressionReport(
+                report.objects + 1,
+                report.bytes_before + size_before,
+                report.bytes_after + size_after,
+            )
+
+        logger.info(
+            f"Compressed {report.objects} objects, "
+            f"saving {report.bytes_saved} bytes"
+        )
+        return report
+
+    def _is_idle(self, digest: Digest, idle_limit_ns: int) -> bool:
+        # Objects never used (e.g., from interrupted stores) are idle.
+        last_used_ns = self.index.get_last_used([digest]).get(digest, 0)
+        return last_used_ns <= idle_limit_ns
+
+    def sweep(
+        self,
+        keep: Container[Digest],
+        min_idle: datetime.timedelta,
+        batch_size: int = 1000,
+        dry_run: bool = False,
+    ) -> SweepReport:
+        """
+        Remove objects except those to keep and those used recently.
+
+        Objects being made right now are stored before they are recorded
+        anywhere, so min_idle must be longer than any run that is in
+        progress while sweeping. The objects are listed in batches of
+        batch_size, and the last use of each batch is checked right
+        before it is removed.
+
+        Packed objects are only removed from the index. The space is
+        freed when the packs are compacted with repack().
+
+        Args:
+            keep: The digests to keep.
+            min_idle: Keep objects used (stored or restored) more recently.
+            batch_size: The number of objects to remove at a time.
+            dry_run: Only report what would be removed.
+
+        Returns:
+            A SweepReport.
+        """
+        idle_limit_ns = _now_ns() - int(min_idle.total_seconds() * 10 ** 9)
+        kept = removed = removed_bytes = 0
+        batch: List[Tuple[Digest, PathLike]] = []
+
+        def sweep_batch():
+            nonlocal kept, removed, removed_bytes
+            last_used = self.index.get_last_used({d for d, _ in batch})
+            removed_files = []
+            for digest, path in batch:
+                if digest in keep or last_used.get(digest, 0) > idle_limit_ns:
+                    kept += 1
+                    continue
+
+                try:
+                    size = os.stat(path).st_size
+                    if not dry_run:
+                        os.remove(path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                removed_bytes += size
+                removed_files.append((digest, path))
+
+            if removed_files and not dry_run:
+                self.index.remove_files(
+                    os.path.basename(path) for _, path in removed_files
+                )
+                # Objects in several tiers are all removed together.
+                self.index.remove_objects({d for d, _ in removed_files})
+                logger.debug(f"Removed {len(removed_files)} objects")
+            batch.clear()
+
+        for digest, path in self._iter_objects():
+            batch.append((digest, path))
+            if len(batch) >= batch_size:
+                sweep_batch()
+
+        if batch:
+            sweep_batch()
+
+        packed: List[Tuple[Digest, int]] = []
+
+        def sweep_packed():
+            nonlocal kept, removed, removed_bytes
+            last_used = self.index.get_last_used({d for d, _ in packed})
+            removed_digests = []
+            for digest, size in packed:
+                if digest in keep or last_used.get(digest, 0) > idle_limit_ns:
+                    kept += 1
+                    continue
+                removed += 1
+                removed_bytes += size
+                removed_digests.append(digest)
+
+            if removed_digests and not dry_run:
+                self.index.remove_packed(removed_digests)
+                self.index.remove_objects(removed_digests)
+                logger.debug(f"Removed {len(removed_digests)} packed objects")
+            packed.clear()
+
+        # Removing entries does not disturb the listing, which is ordered.
+        for digest, _, _, size in self.index.iter_packed(batch_size):
+            packed.append((digest, size))
+            if len(packed) >= batch_size:
+                sweep_packed()
+
+        if packed:
+            sweep_packed()
+
+        if not dry_run:
+            self._remove_empty_dirs()
+
+        return SweepReport(kept, removed, removed_bytes)
+
+    def get_usage(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Count the objects in each tier.
+
+        Returns:
+            A dict mapping the tier (HOT, COLD, PACKED or CHUNKED) to
+            (objects, bytes). The chunks are counted as objects of their
+            own. Only the live objects in packs are counted (see repack()).
+        """
+        usage = {tier: (0, 0) for tier in TIERS}
+        for _, _, _, size in self.index.iter_packed():
+            objects, total = usage[PACKED]
+            usage[PACKED] = (objects + 1, total + size)
+        for digest, path in self._iter_objects():
+            if os.path.basename(path) == digest:
+                tier = HOT
+            elif path.endswith(CHUNKS_SUFFIX):
+                tier = CHUNKED
+            else:
+                tier = COLD
+            objects, size = usage[tier]
+            usage[tier] = (objects + 1, size + os.stat(path).st_size)
+        return usage
+
+    def iter_stored_objects(self) -> Iterator[Tuple[Digest, str]]:
+        """
+        List the stored objects, e.g., to verify them.
+
+        Returns:
+            An iterator of (digest, kind) for each file or packed object,
+            where the kind is HOT, a codec, PACKED or CHUNKED. Objects in
+            several tiers are listed once for each.
+        """
+        for digest, path in self._iter_objects():
+            name = os.path.basename(path)
+            for kind in _FILE_KINDS:
+                if name == f"{digest}{_FILE_SUFFIXES[kind]}":
+                    yield digest, kind
+                    break
+
+        for digest, _, _, _ in self.index.iter_packed():
+            yield Digest(digest), PACKED
+
+    def verify_object(
+        self, digest: Digest, kind: str
+    ) -> Tuple[Optional[bool], int]:
+        """
+        Check that a stored object still has its digest.
+
+        Unlike can_restore(), this reads the whole object, so it notices
+        corruption that does not change the stat of the file. Chunked
+        files are read from their chunks, so a missing or corrupt chunk
+        makes them corrupt too.
+
+        Args:
+            digest: The digest of the object.
+            kind: The kind of object (see iter_stored_objects()).
+
+        Returns:
+            A tuple (ok, size) of whether the object is intact (or None
+            if it no longer exists) and the number of bytes read.
+        """
+        if kind == PACKED:
+            data = self._read_pack_entry(digest)
+            if data is None:
+                return None, 0
+            return self._check_bytes(data, digest), len(data)
+
+        path = self._get_file_path(digest, kind)
+        size = 0
+
+        def read(f):
+            nonlocal size
+            while True:
+                data = f.read(1 << 20)
+                if not data:
+                    break
+                size += len(data)
+                hasher.update(data)
+
+        try:
+            algorithm, hex_digest = split_digest(digest)
+            hasher = get_hasher(algorithm)
+            if kind == CHUNKED:
+                with open(path, "rb") as f:
+                    data = f.read()
+                size = len(data)
+                chunks = json.loads(data.decode("utf-8"))["chunks"]
+                for chunk in chunks:
+                    try:
+                        src = self._open_object(chunk)
+                    except (RestoreError, FileNotFoundError):
+                        logger.warning(f"Missing chunk {chunk} of {digest}")
+                        return False, size
+                    with src:
+                        read(src)
+            else:
+                open_func = open if kind == HOT else CODECS[kind][0]
+                with open_func(path, "rb") as f:
+                    read(f)
+            return hasher.hexdigest() == hex_digest, size
+        except FileNotFoundError:
+            return None, size
+        except (
+            OSError,
+            EOFError,
+            ValueError,
+            KeyError,
+            TypeError,
+            AttributeError,
+            lzma.LZMAError,
+            zlib.error,
+        ) as e:
+            # Unreadable, e.g., corrupt compressed data or chunk lists.
+            logger.warning(f"Cannot read {kind} {digest}: {e}")
+            return False, size
+
+    def quarantine(self, digest: Digest, kind: str):
+        """
+        Move a corrupt object out of the store, for inspection.
+
+        The file (or the packed data) is moved to storage_dir/quarantine,
+        and removed from the index, so the object can be stored again.
+
+        Args:
+            digest: The digest of the object.
+            kind: The kind of object (see iter_stored_objects()).
+        """
+        quarantine_dir = os.path.join(self.storage_dir, QUARANTINE_DIR)
+        os.makedirs(quarantine_dir, exist_ok=True)
+        if kind == PACKED:
+            name = f"{digest}.packed"
+        else:
+            name = os.path.basename(self._get_file_path(digest, kind))
+        dst_path = os.path.join(quarantine_dir, f"{name}.{uuid.uuid4().hex}")
+
+        if kind == PACKED:
+            data = self._read_pack_entry(digest)
+            if data is not None:
+                with open(dst_path, "xb") as f:
+                    f.write(data)
+            self.index.remove_packed([digest])
+        else:
+            try:
+                os.replace(self._get_file_path(digest, kind), dst_path)
+            except FileNotFoundError:
+                pass
+            self.index.remove_files([name])
+
+        logger.warning(f"Quarantined {kind} {digest} as {dst_path}")
+
+    def migrate_layout(self, shard_depth: int) -> int:
+        """
+        Move all objects to a layout with another shard depth.
+
+        This is safe to do while other processes use the store: the new
+        layout is recorded first, and each object is linked into its new
+        place before it is removed from the old one. Processes that
+        opened the store before the migration may fail to find objects
+        (and rerun the calculations), but never restore wrong contents.
+        An interrupted migration can be resumed by running it again.
+
+        Args:
+            shard_depth: The new number of levels of subdirectories.
+
+        Returns:
+            The number of objects moved.
+        """
+        _write_shard_depth(self.storage_dir, shard_depth)
+        self.shard_depth = shard_depth
+
+        # The index identifies files by name and inode, so the moved
+        # files need no new entries.
+        moved = 0
+        for digest, src_path in self._iter_objects():
+            dst_dir = os.path.dirname(self._get_store_path(digest))
+            dst_path = os.path.join(dst_dir, os.path.basename(src_path))
+            if src_path == dst_path:
+                continue
+
+            self._make_dirs(digest)
+            try:
+                os.link(src_path, dst_path)
+            except FileExistsError:
+                # Stored again in the new layout meanwhile.
+                pass
+            except FileNotFoundError:
+                # Removed meanwhile, e.g., by sweep().
+                continue
+
+            try:
+                os.remove(src_path)
+            except FileNotFoundError:
+                pass
+
+            moved += 1
+
+        self._remove_empty_dirs()
+        logger.info(f"Moved {moved} objects to shard depth {shard_depth}")
+        return moved
+
+    def repack(
+        self,
+        max_garbage: float = 0.5,
+        min_age: datetime.timedelta = MIN_PACK_AGE,
+    ) -> RepackReport:
+        """
+        Compact the packs with many removed objects.
+
+        The objects left in each pack where more than max_garbage of the
+        bytes belong to removed objects (see sweep()) are copied to a new
+        pack, and the old pack is removed. Packs that other processes
+        write to are skipped, so this is safe to do while the store is
+        used; processes that are reading from a removed pack look the
+        objects up again. Empty packs and packs with no objects in the
+        index are only removed once they are older than min_age.
+
+        Args:
+            max_garbage: The fraction of removed bytes above which a pack
+                is compacted. With 0, all packs with removed objects are.
+            min_age: Keep empty or unindexed packs modified more recently.
+
+        Returns:
+            A RepackReport.
+        """
+        report = RepackReport()
+        try:
+            names = sorted(os.listdir(self._pack_dir))
+        except FileNotFoundError:
+            return report
+
+        # Start a new pack, so that the current one can be compacted.
+        self.packs.close()
+        usage = self.index.get_pack_usage()
+        age_limit = time.time() - min_age.total_seconds()
+        for name in names:
+            path = os.path.join(self._pack_dir, name)
+            if name.endswith(NEW_PACK_SUFFIX):
+                # Left by a process that failed to create a pack.
+                self._remove_stale_pack(path, age_limit)
+                continue
+            if not name.endswith(PACK_SUFFIX):
+                continue
+            f = open_unused(path)
+            if f is None:
+                continue
+
+            with f:
+                stat = os.fstat(f.fileno())
+                size = stat.st_size
+                garbage = size - usage.get(name, 0)
+                if size and garbage <= max_garbage * size:
+                    continue
+                if garbage == size and stat.st_mtime > age_limit:
+                    continue
+
+                moved = 0
+                for digest, offset, length in self.index.get_pack_entries(
+                    name
+                ):
+                    f.seek(offset)
+                    data = f.read(length)
+                    if not self._check_bytes(data, digest):
+                        logger.warning(f"Wrong contents of {digest} in {name}")
+                        self.index.remove_packed([digest])
+                        continue
+
+                    def record(pack, new_offset):
+                        self.index.put_packed(
+                            [(digest, pack, new_offset, length)]
+                        )
+
+                    self.packs.append(data, record)
+                    moved += 1
+
+                os.remove(path)
+
+            report = RepackReport(
+                report.packs + 1,
+                report.objects + moved,
+                report.bytes_freed + garbage,
+            )
+
+        self.packs.close()
+        logger.info(
+            f"Compacted {report.packs} packs, "
+            f"freeing {report.bytes_freed} bytes"
+        )
+        return report
+
+    def _remove_stale_pack(self, path: PathLike, age_limit: float):
+        f = open_unused(path)
+        if f is None:
+            return
+        with f:
+            if os.fstat(f.fileno()).st_mtime <= age_limit:
+                os.remove(path)
+
+    def _remove_empty_dirs(self):
+        keep = {
+            os.path.normpath(self.storage_dir),
+            os.path.normpath(os.path.join(self.storage_dir, META_DIR)),
+            os.path.normpath(os.path.join(self.storage_dir, CACHE_DIR)),
+            os.path.normpath(self._pack_dir),
+        }
+        for dir_path, _, _ in os.walk(self.storage_dir, topdown=False):
+            if os.path.normpath(dir_path) in keep:
+                continue
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                # Not empty.
+                pass
@@ -1,6 +1,7 @@
-from typing import Union, Any
+from typing import Union, Any, Tuple
 import os
 import stat
+import mmap
 import hashlib
 import json
 from pathlib import Path
@@ -61,18 +62,96 @@ def digest_str(s: str) -> str:
     return digest_func(s.encode("utf-8")).hexdigest()
 
 
-_CHUNK_SIZE = 1024
+DEFAULT_ALGORITHM = "sha1"
 
+# Digests made with other algorithms than the default are written as
+# "<algorithm>-<hex digest>". Plain hex digests are SHA-1, as they were
+# before the algorithm was configurable.
+_ALGORITHM_SEP = "-"
 
-def digest_file(path: PathLike) -> str:
-    digest = digest_func()
+_BUFFER_SIZE = 1 << 20
+
+# Larger files are hashed from a memory map instead of read into a buffer.
+_MMAP_THRESHOLD = 1 << 26
+
+
+def get_hasher(algorithm: str):
+    """
+    Make a new hash object.
+
+    Args:
+        algorithm: The name of a hashlib algorithm with a fixed digest
+            size, e.g., "sha1", "sha256" or "blake2b".
+
+    Returns:
+        A hashlib hash object.
+
+    Raises:
+        ValueError: If the algorithm is not available.
+    """
+    if _ALGORITHM_SEP in algorithm:
+        raise ValueError(f"invalid algorithm name: {algorithm}")
+    hasher = hashlib.new(algorithm)
+    if not hasher.digest_size:
+        raise ValueError(f"variable digest size not supported: {algorithm}")
+    return hasher
+
+
+# Digests of directories (see Storage) are those of their tree listing,
+# with this prefix.
+TREE_PREFIX = "tree-"
+
+
+def make_digest(algorithm: str, hex_digest: str) -> str:
+    if algorithm == DEFAULT_ALGORITHM:
+        return hex_digest
+    return f"{algorithm}{_ALGORITHM_SEP}{hex_digest}"
+
+
+def is_tree_digest(digest: str) -> bool:
+    return digest.startswith(TREE_PREFIX)
+
+
+def split_digest(digest: str) -> Tuple[str, str]:
+    """
+    Split a digest into (algorithm, hex digest).
+    """
+    if is_tree_digest(digest):
+        digest = digest[len(TREE_PREFIX) :]
+    algorithm, _, hex_digest = digest.rpartition(_ALGORITHM_SEP)
+    return algorithm or DEFAULT_ALGORITHM, hex_digest
+
+
+def digest_file(path: PathLike, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """
+    Compute the digest of a file.
+
+    The hashing releases the GIL, so several files can be hashed at the
+    same time in threads.
+
+    Args:
+        path: The file to hash.
+        algorithm: The name of a hashlib algorithm (see get_hasher()).
+
+    Returns:
+        The digest, including the algorithm unless it is the default.
+    """
+    hasher = get_hasher(algorithm)
     with open(path, "rb") as f:
-        while True:
-            data = f.read(_CHUNK_SIZE)
-            if not data:
-                break
-            digest.update(data)
-        return digest.hexdigest()
+        size = os.fstat(f.fileno()).st_size
+        if size >= _MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                hasher.update(m)
+        else:
+            buffer = bytearray(min(size, _BUFFER_SIZE) or 1)
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                hasher.update(view[:n])
+
+    return make_digest(algorithm, hasher.hexdigest())
 
 
 def unique_json(obj: Any) -> str:
@@ -0,0 +1,231 @@
+"""
+Check the objects in a Storage against their digests.
+
+Stored files are only compared by their stat afterwards (see
+object_index), so corruption that keeps the stat, e.g., bit rot or a bad
+copy of the store, goes unnoticed until a restored file is used. A scrub
+hashes every object again and quarantines those whose digest no longer
+matches, so that they are made (or downloaded) again. The results in the
+Log that are or contain a corrupt object are distrusted, so that they
+are not reused.
+"""
+
+from typing import Iterator, List, Optional, Set, Tuple
+import os
+import json
+import time
+import uuid
+import logging
+import collections
+import concurrent.futures
+
+import attr
+
+from boyleworkflow.log import Log, VERIFY_SOURCE
+from boyleworkflow.storage import Storage, Digest, CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# The progress of a scrub, in the CACHE_DIR of the storage.
+CHECKPOINT_FILE = "verify.json"
+
+# The number of objects each worker process checks at a time.
+_BATCH_SIZE = 32
+
+# Save the checkpoint after about this many objects.
+_CHECKPOINT_INTERVAL = 1000
+
+_Key = Tuple[Digest, str]
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class VerifyReport:
+    """
+    The outcome of verify_storage().
+
+    Attributes:
+        objects: The number of objects checked.
+        bytes: The number of bytes read.
+        corrupt: The (digest, kind) of each object quarantined.
+        distrusted: The number of results distrusted in the log.
+        finished: Whether the scrub reached the end of the store, rather
+            than the limit.
+    """
+
+    objects: int = 0
+    bytes: int = 0
+    corrupt: Tuple[_Key, ...] = ()
+    distrusted: int = 0
+    finished: bool = True
+
+
+class _Throttle:
+    """Sleep as needed to keep to a number of bytes per second."""
+
+    def __init__(self, bytes_per_second: Optional[float]):
+        self.bytes_per_second = bytes_per_second
+        self._start = time.monotonic()
+        self._bytes = 0
+
+    def add(self, size: int):
+        self._bytes += size
+        if self.bytes_per_second:
+            delay = (
+                self._start
+                + self._bytes / self.bytes_per_second
+                - time.monotonic()
+            )
+            if delay > 0:
+                time.sleep(delay)
+
+
+def _verify_batch(
+    storage: Storage, keys: List[_Key], bytes_per_second: Optional[float]
+) -> List[Tuple[_Key, Optional[bool], int]]:
+    # Run in the worker processes, each reading at its share of the rate.
+    throttle = _Throttle(bytes_per_second)
+    results = []
+    for key in keys:
+        ok, size = storage.verify_object(*key)
+        throttle.add(size)
+        results.append((key, ok, size))
+    return results
+
+
+def _read_checkpoint(path: str) -> Optional[_Key]:
+    try:
+        with open(path, "r") as f:
+            digest, kind = json.load(f)["after"]
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError):
+        logger.warning(f"Ignoring invalid checkpoint {path}")
+        return None
+    return Digest(digest), kind
+
+
+def _write_checkpoint(path: str, after: _Key):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"after": list(after)}, f)
+    os.replace(temp_path, path)
+
+
+def verify_storage(
+    storage: Storage,
+    log: Optional[Log] = None,
+    bytes_per_second: Optional[float] = None,
+    max_workers: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> VerifyReport:
+    """
+    Hash the objects in a storage again and quarantine the corrupt ones.
+
+    The objects are checked in order of digest, in worker processes, and
+    the progress is saved in a checkpoint in the cache directory of the
+    storage. An interrupted or limited scrub continues from there, and
+    the next one after a full pass starts over. This can run while the
+    storage is in use.
+
+    Args:
+        storage: The Storage.
+        log: If given, distrust the results in this Log that are, or
+            contain, a corrupt object (see Log.set_trust).
+        bytes_per_second: If given, read at most about this many bytes
+            per second, to leave the disks to other work.
+        max_workers: The number of processes. By default, one per CPU.
+        limit: If given, check at most this many objects.
+
+    Returns:
+        A VerifyReport.
+    """
+    checkpoint_path = os.path.join(
+        storage.storage_dir, CACHE_DIR, CHECKPOINT_FILE
+    )
+    keys = sorted(set(storage.iter_stored_objects()))
+    after = _read_checkpoint(checkpoint_path)
+    if after is not None:
+        keys = [key for key in keys if key > after]
+        logger.info(f"Continuing after {after}")
+    finished = limit is None or len(keys) <= limit
+    keys = keys[:limit]
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    batches = [
+        keys[i : i + _BATCH_SIZE] for i in range(0, len(keys), _BATCH_SIZE)
+    ]
+    objects = size = 0
+    corrupt: List[_Key] = []
+    done: Optional[_Key] = None
+    unsaved = 0
+
+    def iter_results(executor) -> Iterator[List]:
+        if executor is None:
+            for batch in batches:
+                yield _verify_batch(storage, batch, bytes_per_second)
+            return
+
+        # Keep a few batches in flight, and take the results in order,
+        # so that everything before the checkpoint is done. At most
+        # max_workers batches are read at a time.
+        worker_rate = bytes_per_second and bytes_per_second / max_workers
+        pending: collections.deque = collections.deque()
+        for batch in batches:
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+            pending.append(
+                executor.submit(_verify_batch, storage, batch, worker_rate)
+            )
+        while pending:
+            yield pending.popleft().result()
+
+    executor = None
+    if max_workers > 1 and len(batches) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+    try:
+        for results in iter_results(executor):
+            for key, ok, key_size in results:
+                if ok is not None:
+                    objects += 1
+                    size += key_size
+                if ok is False:
+                    storage.quarantine(*key)
+                    corrupt.append(key)
+                done = key
+
+            unsaved += len(results)
+            if unsaved >= _CHECKPOINT_INTERVAL:
+                _write_checkpoint(checkpoint_path, done)
+                unsaved = 0
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if done is not None:
+            _write_checkpoint(checkpoint_path, done)
+
+    # The next scrub starts over.
+    if finished and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    distrusted = 0
+    if corrupt and log is not None:
+        distrusted = _distrust(log, storage, {digest for digest, _ in corrupt})
+
+    logger.info(
+        f"Checked {objects} objects ({size} bytes), "
+        f"quarantined {len(corrupt)}"
+    )
+    return VerifyReport(objects, size, tuple(corrupt), distrusted, finished)
+
+
+def _distrust(log: Log, storage: Storage, corrupt: Set[Digest]) -> int:
+    # Distrust the results that are, or contain, a corrupt object.
+    affected = storage.find_containing(log.get_reachable_digests(), corrupt)
+    results = log.get_results_with_digests(affected)
+    for calc_id, loc, digest in sorted(results):
+        log.set_trust(calc_id, loc, digest, False, VERIFY_SOURCE)
+        logger.warning(f"Distrusted {digest} at {loc} of calc {calc_id}")
+    return len(results)
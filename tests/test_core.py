@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `boyleworkflow` package."""
+
+import pytest
+
+from boyleworkflow.core import Comp, get_upstream_sorted
+from boyleworkflow.ops import ShellOp
+
+
+def build_diamond_chain(levels):
+    """
+    Build a chain of diamonds: on each level, two comps that both
+    depend on both comps of the previous level.
+    """
+    a = Comp(ShellOp("start a"), (), "a")
+    b = Comp(ShellOp("start b"), (), "b")
+    for i in range(levels):
+        op = ShellOp(f"level {i}")
+        a, b = Comp(op, (a, b), "a"), Comp(op, (a, b), "b")
+
+    return Comp(ShellOp("merge"), (a, b), "out")
+
+
+def test_upstream_sorted_is_topological():
+    leaf = build_diamond_chain(3)
+    comps = get_upstream_sorted([leaf])
+
+    assert len(comps) == len(set(comps))
+    assert comps[-1] == leaf
+
+    seen = set()
+    for comp in comps:
+        assert set(comp.parents) <= seen
+        seen.add(comp)
+
+
+def test_upstream_sorted_diamond_chain_is_linear():
+    # Without deduplication this would visit 2 ** 30 comps.
+    levels = 30
+    leaf = build_diamond_chain(levels)
+
+    comps = get_upstream_sorted([leaf, leaf.parents[0]])
+
+    assert len(comps) == 2 * (levels + 1) + 1
+    assert len(set(comp.comp_id for comp in comps)) == len(comps)
+
+
+def test_upstream_sorted_long_chain():
+    comp = Comp(ShellOp("start"), (), "x")
+    for i in range(5000):
+        comp = Comp(ShellOp(f"step {i}"), (comp,), "x")
+
+    comps = get_upstream_sorted([comp])
+
+    assert len(comps) == 5001
+    assert comps[-1] == comp
+    assert comps[0].parents == ()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `boyleworkflow` package."""
+
+import tempfile
+import shutil
+import os
+import time
+import sqlite3
+import multiprocessing
+
+import pytest
+
+from click.testing import CliRunner
+
+import boyleworkflow
+from boyleworkflow import cli
+from boyleworkflow.core import Comp
+from boyleworkflow.ops import ShellOp, RenameOp, RunError
+from boyleworkflow.distributed import (
+    QueueExecutor,
+    run_worker,
+    WorkerLost,
+    RUNNING,
+)
+
+
+@pytest.fixture
+def temp_dir(request):
+
+    temp_dir = tempfile.mkdtemp()
+
+    def fin():
+        shutil.rmtree(temp_dir)
+
+    request.addfinalizer(fin)
+
+    return temp_dir
+
+
+@pytest.fixture
+def workers(request, temp_dir):
+    # The job table is kept in the log database.
+    log_path = os.path.join(temp_dir, "log.db")
+    log = boyleworkflow.Log(log_path)
+
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(log_path,),
+            kwargs=dict(poll_interval=0.01, idle_timeout=30),
+        )
+        for _ in range(3)
+    ]
+
+    for process in processes:
+        process.start()
+
+    def fin():
+        for process in processes:
+            process.terminate()
+            process.join()
+        log.close()
+
+    request.addfinalizer(fin)
+
+    return log, log_path, len(processes)
+
+
+def shell_comp(cmd, parents=(), loc="out"):
+    return Comp(ShellOp(cmd, shell=True), parents, loc)
+
+
+def restore_and_read(digest, storage):
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "restored")
+        storage.restore(digest, path)
+        with open(path, "r") as f:
+            return f.read()
+
+
+def test_make_with_workers(temp_dir, workers):
+    log, log_path, n = workers
+    storage = boyleworkflow.Storage(os.path.join(temp_dir, "storage"))
+
+    barrier_dir = os.path.join(temp_dir, "barrier")
+    os.mkdir(barrier_dir)
+
+    # Only finishes if all the workers run a step at the same time.
+    wait_for_all = (
+        f"touch {barrier_dir}/$STEP && "
+        f"timeout 10 sh -c "
+        f"'until [ $(ls {barrier_dir} | wc -l) -ge {n} ]; "
+        f"do sleep 0.01; done'"
+    )
+
+    steps = [
+        shell_comp(f"STEP={i} && {wait_for_all} && echo {i} > out")
+        for i in range(n)
+    ]
+    merged = shell_comp(
+        "cat in* > out",
+        [
+            Comp(RenameOp("out", f"in{i}"), [step], f"in{i}")
+            for i, step in enumerate(steps)
+        ],
+    )
+
+    with QueueExecutor(log_path, poll_interval=0.01) as executor:
+        results = boyleworkflow.make(
+            [merged], log, storage, jobs=n, executor=executor
+        )
+
+    assert restore_and_read(results[merged], storage) == "0\n1\n2\n"
+
+
+def test_failure_with_workers(temp_dir, workers):
+    log, log_path, _ = workers
+    storage = boyleworkflow.Storage(os.path.join(temp_dir, "storage"))
+
+    with QueueExecutor(log_path, poll_interval=0.01) as executor:
+        with pytest.raises(RunError):
+            boyleworkflow.make(
+                [shell_comp("exit 1")], log, storage, executor=executor
+            )
+
+
+def test_worker_command(temp_dir):
+    queue_path = os.path.join(temp_dir, "queue.db")
+
+    with QueueExecutor(queue_path, poll_interval=0.01) as executor:
+        future = executor.submit(sum, [1, 2, 3])
+
+        runner = CliRunner()
+        result = runner.invoke(
+            cli.main, ["worker", queue_path, "--idle-timeout", "0.1"]
+        )
+        assert result.exit_code == 0
+
+        assert future.result() == 6
+
+
+def test_untrusted_queue(temp_dir):
+    queue_path = os.path.join(temp_dir, "queue.db")
+
+    # New job tables are only for the owner.
+    QueueExecutor(queue_path).shutdown()
+    assert os.stat(queue_path).st_mode & 0o777 == 0o600
+
+    # Others could put jobs (or outcomes) in this one.
+    os.chmod(queue_path, 0o666)
+    with pytest.raises(PermissionError):
+        run_worker(queue_path, idle_timeout=0)
+    with pytest.raises(PermissionError):
+        QueueExecutor(queue_path)
+
+
+def start_worker(path, **kwargs):
+    # Forks, so start before any threads, e.g., of a QueueExecutor.
+    process = multiprocessing.Process(
+        target=run_worker,
+        args=(path,),
+        kwargs=dict(poll_interval=0.01, idle_timeout=30, **kwargs),
+    )
+    process.start()
+    return process
+
+
+def wait_until_running(path):
+    conn = sqlite3.connect(path)
+    try:
+        for _ in range(1000):
+            try:
+                (running,) = conn.execute(
+                    "SELECT COUNT(*) FROM job WHERE state = ?", (RUNNING,)
+                ).fetchone()
+            except sqlite3.OperationalError:
+                # The job table is not created yet.
+                running = 0
+            if running:
+                return
+            time.sleep(0.01)
+        raise AssertionError("no job was taken")
+    finally:
+        conn.close()
+
+
+def test_worker_lost(temp_dir):
+    queue_path = os.path.join(temp_dir, "queue.db")
+
+    worker = start_worker(queue_path, lease=0.5)
+    with QueueExecutor(queue_path, poll_interval=0.01) as executor:
+        future = executor.submit(time.sleep, 30)
+
+        wait_until_running(queue_path)
+        worker.kill()
+        worker.join()
+
+        with pytest.raises(WorkerLost):
+            future.result(timeout=10)
+
+
+def test_worker_renews_lease(temp_dir):
+    queue_path = os.path.join(temp_dir, "queue.db")
+
+    worker = start_worker(queue_path, lease=0.2)
+    try:
+        with QueueExecutor(queue_path, poll_interval=0.01) as executor:
+            # Runs for many lease times.
+            assert executor.submit(time.sleep, 1).result(timeout=10) is None
+    finally:
+        worker.terminate()
+        worker.join()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `boyleworkflow` package."""
+
+import tempfile
+import shutil
+import os
+import datetime
+
+import pytest
+
+from click.testing import CliRunner
+
+import boyleworkflow
+from boyleworkflow import cli
+from boyleworkflow.core import Comp
+from boyleworkflow.ops import ShellOp, RenameOp
+from boyleworkflow.garbage import collect_garbage
+
+
+@pytest.fixture
+def temp_dir(request):
+
+    temp_dir = tempfile.mkdtemp()
+
+    def fin():
+        shutil.rmtree(temp_dir)
+
+    request.addfinalizer(fin)
+
+    return temp_dir
+
+
+@pytest.fixture
+def log_path(temp_dir):
+    return os.path.join(temp_dir, "log.db")
+
+
+@pytest.fixture
+def log(request, log_path):
+    log = boyleworkflow.Log(log_path)
+    request.addfinalizer(log.close)
+    return log
+
+
+@pytest.fixture
+def storage(temp_dir):
+    return boyleworkflow.Storage(os.path.join(temp_dir, "storage"))
+
+
+def shell_comp(cmd, parents=(), loc="out"):
+    return Comp(ShellOp(cmd, shell=True), parents, loc)
+
+
+def store_orphan(storage, content):
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "orphan")
+        with open(path, "w") as f:
+            f.write(content)
+        return storage.store(path)
+
+
+def build_comps():
+    a = shell_comp("echo a > out")
+    b = shell_comp(
+        "cat in > out && echo b >> out",
+        [Comp(RenameOp("out", "in"), [a], "in")],
+    )
+    return a, b
+
+
+def count_runs(log):
+    return log.conn.execute("SELECT COUNT(*) FROM run").fetchone()[0]
+
+
+def test_collect_garbage(log, storage):
+    a, b = build_comps()
+    results = boyleworkflow.make([b], log, storage)
+    orphan = store_orphan(storage, "orphan")
+
+    # Recently used objects are kept by default.
+    report = collect_garbage(log, storage)
+    assert report.objects_removed == 0
+    assert storage.can_restore(orphan)
+
+    report = collect_garbage(log, storage, min_idle=datetime.timedelta())
+    assert report.objects_removed == 1
+    assert report.bytes_removed == len("orphan")
+    assert report.objects_kept == 2
+    assert not storage.can_restore(orphan)
+
+    # Nothing needs to be made again.
+    runs = count_runs(log)
+    assert boyleworkflow.make([a, b], log, storage) == {
+        a: log.get_result(log.get_calc(a), a.loc).digest,
+        b: results[b],
+    }
+    assert count_runs(log) == runs
+
+
+def test_collect_garbage_keep_last(log, storage):
+    a, b = build_comps()
+    results = boyleworkflow.make([b], log, storage)
+
+    report = collect_garbage(
+        log, storage, keep_last=1, min_idle=datetime.timedelta(), batch_size=1
+    )
+    assert report.objects_removed == 1
+    assert report.objects_kept == 1
+
+    # The requested comp is still there, but the intermediate one is not.
+    runs = count_runs(log)
+    assert boyleworkflow.make([b], log, storage) == results
+    assert count_runs(log) == runs
+
+    boyleworkflow.make([a], log, storage)
+    assert count_runs(log) == runs + 1
+
+
+def test_gc_command(log, log_path, storage):
+    a, _ = build_comps()
+    boyleworkflow.make([a], log, storage)
+    orphan = store_orphan(storage, "orphan")
+
+    runner = CliRunner()
+    args = ["gc", log_path, storage.storage_dir, "--min-idle-hours", "0"]
+
+    result = runner.invoke(cli.main, args + ["--dry-run"])
+    assert result.exit_code == 0, result.output
+    assert "Would remove 1 objects" in result.output
+    assert storage.can_restore(orphan)
+
+    result = runner.invoke(cli.main, args)
+    assert result.exit_code == 0, result.output
+    assert "Removed 1 objects" in result.output
+    assert not storage.can_restore(orphan)
+
+
+def test_collect_garbage_keeps_tree_contents(log, storage):
+    tree = shell_comp("mkdir out && echo a > out/a && echo b > out/b")
+    results = boyleworkflow.make([tree], log, storage)
+
+    report = collect_garbage(log, storage, min_idle=datetime.timedelta())
+    assert report.objects_removed == 0
+    assert report.objects_kept == 3
+    assert storage.can_restore(results[tree])
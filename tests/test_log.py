@@ -7,6 +7,8 @@ import tempfile
 import shutil
 import os
 import datetime
+import sqlite3
+import concurrent.futures
 
 import pytest
 
@@ -129,3 +131,267 @@ def test_log_read_write_results(log):
         for result in results:
             logged_result = log.get_result(calc, result.loc)
             assert logged_result == result
+
+
+class CountingLog(boyleworkflow.Log):
+    lookups = 0
+
+    def get_opinions(self, calc, loc):
+        self.lookups += 1
+        return super().get_opinions(calc, loc)
+
+
+@pytest.fixture
+def counting_log(request):
+
+    temp_dir = tempfile.mkdtemp()
+
+    def fin():
+        shutil.rmtree(temp_dir)
+
+    request.addfinalizer(fin)
+
+    log_path = os.path.join(temp_dir, "log.db")
+    log = CountingLog(log_path)
+
+    return log
+
+
+def test_get_calc_caching(counting_log):
+    log = counting_log
+    t = datetime.datetime.utcnow()
+
+    n = 1000
+    comps = [Comp(ShellOp("start"), (), "x")]
+    for i in range(1, n):
+        comps.append(Comp(ShellOp(f"step {i % 2}"), (comps[-1],), "x"))
+
+    with log.caching():
+        for i, comp in enumerate(comps):
+            calc = log.get_calc(comp)
+            with pytest.raises(boyleworkflow.NotFoundException):
+                log.get_result(calc, comp.loc)
+            log.save_run(calc, [Result("x", f"digest {i}")], t, t)
+            assert log.get_result(calc, comp.loc).digest == f"digest {i}"
+
+        # One lookup per comp before and after its run, and no more.
+        assert log.lookups == 2 * n
+
+        log.lookups = 0
+        assert log.get_calc(comps[-1]) == calc
+        assert log.lookups == 0
+
+    # Outside the session, nothing is cached, but each ancestor is
+    # still looked up only once.
+    assert log.get_calc(comps[-1]) == calc
+    assert log.lookups == n - 1
+
+
+def test_caching_invalidates_dependents(log):
+    t = datetime.datetime.utcnow()
+
+    a = Comp(ShellOp("a"), (), "a")
+    b = Comp(ShellOp("b"), (a,), "b")
+
+    with log.caching():
+        calc_a = log.get_calc(a)
+        log.save_run(calc_a, [Result("a", "digest 1")], t, t)
+        assert log.get_calc(b).inputs == (Result("a", "digest 1"),)
+
+        # A conflicting result for a must reach the cached calc of b.
+        log.save_run(calc_a, [Result("a", "digest 2")], t, t)
+        with pytest.raises(boyleworkflow.ConflictException):
+            log.get_calc(b)
+
+        log.set_trust(calc_a.calc_id, "a", "digest 1", False)
+        assert log.get_calc(b).inputs == (Result("a", "digest 2"),)
+
+
+def test_trust_sources(log):
+    t = datetime.datetime.utcnow()
+    calc = Calc(ShellOp("command"), [])
+    results = [Result("a", "digest 1"), Result("b", "digest 2")]
+    log.save_run(calc, results, t, t)
+    verify = boyleworkflow.log.VERIFY_SOURCE
+
+    # The user distrusts a, and verify_storage() both.
+    log.set_trust(calc.calc_id, "a", "digest 1", False)
+    log.set_trust(calc.calc_id, "a", "digest 1", False, verify)
+    log.set_trust(calc.calc_id, "b", "digest 2", False, verify)
+    assert log.get_opinions(calc, "a") == {"digest 1": False}
+    assert log.get_opinions(calc, "b") == {"digest 2": False}
+
+    # A run that reproduces the results only vouches for b.
+    log.save_run(calc, results, t, t)
+    assert log.get_opinions(calc, "a") == {"digest 1": False}
+    assert log.get_opinions(calc, "b") == {"digest 2": None}
+
+
+def test_get_results_matches_get_result(log):
+    t = datetime.datetime.utcnow()
+
+    calcs = [Calc(ShellOp(f"command {i}"), []) for i in range(1200)]
+    for i, calc in enumerate(calcs):
+        if i % 3:
+            log.save_run(calc, [Result("x", f"digest {i}")], t, t)
+
+    pairs = [(calc, loc) for calc in calcs for loc in ("x", "y")]
+    results = log.get_results(pairs)
+
+    for calc, loc in pairs:
+        try:
+            expected = log.get_result(calc, loc)
+        except boyleworkflow.NotFoundException:
+            assert (calc, loc) not in results
+        else:
+            assert results[(calc, loc)] == expected
+
+    assert len(results) == 800
+
+    log.save_run(calcs[1], [Result("x", "another digest")], t, t)
+    with pytest.raises(boyleworkflow.ConflictException):
+        log.get_results(pairs)
+
+    with log.caching():
+        assert log.get_results(pairs[:2]) == {}
+        log.save_run(calcs[0], [Result("x", "digest 0")], t, t)
+        assert log.get_results(pairs[:2]) == {
+            (calcs[0], "x"): Result("x", "digest 0")
+        }
+
+
+def test_concurrent_use(log):
+    t = datetime.datetime.utcnow()
+    assert log.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    def save_and_get(i):
+        calc = Calc(ShellOp(f"command {i}"), [])
+        log.save_run(calc, [Result("x", f"digest {i}")], t, t)
+        with log.caching():
+            return log.get_result(calc, "x").digest
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        digests = list(executor.map(save_and_get, range(200)))
+    assert digests == [f"digest {i}" for i in range(200)]
+
+    # Another log on the same file sees the runs.
+    other = boyleworkflow.Log(log.path)
+    calc = Calc(ShellOp("command 3"), [])
+    assert other.get_result(calc, "x").digest == "digest 3"
+    other.close()
+
+    # Closing the log closes the connections of all threads.
+    conns = list(log._conns)
+    assert len(conns) > 1
+    log.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        conns[-1].execute("SELECT 1")
+
+
+def test_batching(log):
+    t = datetime.datetime.utcnow()
+    other = boyleworkflow.Log(log.path)
+    calcs = [Calc(ShellOp(f"command {i}"), []) for i in range(3)]
+
+    def count_runs(log):
+        return log.conn.execute("SELECT COUNT(*) FROM run").fetchone()[0]
+
+    with log.batching():
+        log.save_run(calcs[0], [Result("x", "digest 0")], t, t)
+        log.save_run(calcs[1], [Result("x", "digest 1")], t, t)
+        assert count_runs(other) == 0
+        assert log.flush_due() > 0
+
+        # Looking up the result commits the writes first.
+        assert log.get_result(calcs[0], "x").digest == "digest 0"
+        assert count_runs(other) == 2
+
+        log.save_run(calcs[2], [Result("x", "digest 2")], t, t)
+        assert count_runs(other) == 2
+    assert count_runs(other) == 3
+
+    # The time window is checked on writes, or with flush_due().
+    quick = boyleworkflow.Log(log.path, batch_seconds=0)
+    with quick.batching():
+        quick.save_run(calcs[0], [Result("x", "digest 0")], t, t)
+        assert count_runs(other) == 4
+    quick.close()
+
+    # Comps are saved once, however often they are responded to.
+    a = Comp(ShellOp("a"), (), "a")
+    b = Comp(ShellOp("b"), (a,), "b")
+    for comp in [a, b]:
+        log.save_calc(Calc(comp.op, []))
+    with log.batching():
+        log.save_responses([(a, "digest a"), (b, "digest b")], t)
+        log.save_response(b, "digest b", t)
+    assert other.conn.execute("SELECT COUNT(*) FROM comp").fetchone() == (2,)
+    assert log._saved_comps == {a, b}
+    other.close()
+
+
+def test_batching_threads(log, monkeypatch):
+    t = datetime.datetime.utcnow()
+    a = Comp(ShellOp("a"), (), "a")
+    b = Comp(ShellOp("b"), (a,), "b")
+    for comp in [a, b]:
+        log.save_calc(Calc(comp.op, []))
+
+    # A comp buffered in the batch of one thread is not yet saved for
+    # the others.
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        with log.batching():
+            log.save_response(b, "digest 1", t)
+            executor.submit(log.save_response, b, "digest 2", t).result()
+        assert log._saved_comps == {a, b}
+    responses = log.conn.execute("SELECT COUNT(*) FROM response").fetchone()
+    assert responses == (2,)
+
+    # The comps known to be saved are bounded.
+    c = Comp(ShellOp("b"), (a,), "c")
+    monkeypatch.setattr(boyleworkflow.log, "_MAX_SAVED_COMPS", 1)
+    log.save_response(c, "digest c", t)
+    assert log._saved_comps == {c}
+
+
+@pytest.mark.parametrize("old_version", [0, 2])
+def test_schema_version(log, caplog, old_version):
+    log.close()
+
+    # A log from before trust opinions had a source, and with 0, before
+    # calc ids depended on the input digests.
+    conn = sqlite3.connect(log.path)
+    conn.executescript(
+        "DROP TABLE trust;"
+        "CREATE TABLE trust (calc_id text, loc text, digest text, "
+        "opinion boolean, primary key (calc_id, loc, digest));"
+        "INSERT INTO trust VALUES ('calc', 'a', 'digest', 0);"
+        f"PRAGMA user_version = {old_version};"
+    )
+    conn.close()
+
+    boyleworkflow.Log(log.path).close()
+    assert ("calc ids changed" in caplog.text) == (old_version == 0)
+
+    caplog.clear()
+    upgraded = boyleworkflow.Log(log.path)
+    assert not caplog.text
+    (version,) = upgraded.conn.execute("PRAGMA user_version").fetchone()
+    assert version == boyleworkflow.log.USER_VERSION
+    schema_path = os.path.join(
+        os.path.dirname(boyleworkflow.log.__file__),
+        "resources",
+        boyleworkflow.log.SCHEMA_PATH,
+    )
+    with open(schema_path, "r") as f:
+        assert f"PRAGMA user_version = {version};" in f.read()
+    assert upgraded.conn.execute("SELECT * FROM trust").fetchall() == [
+        ("calc", "a", "digest", 0, None)
+    ]
+    upgraded.close()
+
+    conn = sqlite3.connect(log.path)
+    conn.execute(f"PRAGMA user_version = {version + 1}")
+    conn.close()
+    with pytest.raises(ValueError):
+        boyleworkflow.Log(log.path)
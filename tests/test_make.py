@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `boyleworkflow` package."""
+
+import tempfile
+import shutil
+import os
+import datetime
+import time
+import asyncio
+
+import attr
+import pytest
+
+import boyleworkflow
+from boyleworkflow.core import Comp, Calc, Op, Result, get_upstream_sorted
+from boyleworkflow.ops import ShellOp, RenameOp, RunError, place_inputs
+from boyleworkflow.make import Scheduler
+from boyleworkflow.util import id_property, unique_json
+
+from benchmarks.common import simulate_makespan
+
+
+@pytest.fixture
+def storage(request):
+
+    temp_dir = tempfile.mkdtemp()
+
+    def fin():
+        shutil.rmtree(temp_dir)
+
+    request.addfinalizer(fin)
+
+    storage = boyleworkflow.Storage(temp_dir)
+
+    return storage
+
+
+@pytest.fixture
+def log(request):
+
+    temp_dir = tempfile.mkdtemp()
+
+    def fin():
+        shutil.rmtree(temp_dir)
+
+    request.addfinalizer(fin)
+
+    log_path = os.path.join(temp_dir, "log.db")
+    log = boyleworkflow.Log(log_path)
+
+    return log
+
+
+def shell_comp(cmd, parents=(), loc="out"):
+    return Comp(ShellOp(cmd, shell=True), parents, loc)
+
+
+def restore_and_read(digest, storage):
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "restored")
+        storage.restore(digest, path)
+        with open(path, "r") as f:
+            return f.read()
+
+
+def test_parallel_make(log, storage):
+    n = 4
+
+    with tempfile.TemporaryDirectory() as barrier_dir:
+        # Each step waits until all steps have started,
+        # so this only finishes if they run concurrently.
+        wait_for_all = (
+            f"touch {barrier_dir}/$STEP && "
+            f"timeout 10 sh -c "
+            f"'until [ $(ls {barrier_dir} | wc -l) -ge {n} ]; "
+            f"do sleep 0.01; done'"
+        )
+
+        steps = [
+            shell_comp(f"STEP={i} && {wait_for_all} && echo {i} > out")
+            for i in range(n)
+        ]
+        merged = shell_comp("cat in* > out", [
+            Comp(RenameOp("out", f"in{i}"), [step], f"in{i}")
+            for i, step in enumerate(steps)
+        ])
+
+        results = boyleworkflow.make([merged], log, storage, jobs=n)
+
+    assert restore_and_read(results[merged], storage) == "0\n1\n2\n3\n"
+
+
+def test_parallel_make_same_as_serial(log, storage):
+    a = shell_comp("echo a > out")
+    b = shell_comp("echo b > out")
+    c = shell_comp("cat a b > out", [
+        Comp(RenameOp("out", "a"), [a], "a"),
+        Comp(RenameOp("out", "b"), [b], "b"),
+    ])
+
+    parallel = boyleworkflow.make([a, b, c], log, storage, jobs=3)
+    serial = boyleworkflow.make([a, b, c], log, storage, jobs=1)
+
+    assert parallel == serial
+    assert restore_and_read(parallel[c], storage) == "a\nb\n"
+
+
+def test_failing_run_is_raised(log, storage):
+    ok = shell_comp("echo ok > out")
+    failing = shell_comp("exit 1")
+
+    with pytest.raises(RunError):
+        boyleworkflow.make([ok, failing], log, storage, jobs=2)
+
+    # The successful run is still recorded.
+    calc = log.get_calc(ok)
+    assert storage.can_restore(log.get_result(calc, ok.loc).digest)
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class AppendOp(Op):
+    """Append a line to the (optional) input file at the same loc."""
+
+    line: str
+
+    @property
+    def definition(self):
+        return unique_json(attr.asdict(self))
+
+    @id_property
+    def op_id(self):
+        return attr.asdict(self)
+
+    def run(self, inputs, out_locs, storage):
+        with tempfile.TemporaryDirectory() as td:
+            place_inputs(inputs, td, storage)
+            results = []
+            for loc in out_locs:
+                path = os.path.join(td, loc)
+                content = ""
+                if os.path.exists(path):
+                    # Do not modify the placed file; it is a hardlink.
+                    with open(path, "r") as f:
+                        content = f.read()
+                    os.remove(path)
+                with open(path, "w") as f:
+                    f.write(content + self.line + "\n")
+                results.append(Result(loc, storage.store(path)))
+            return results
+
+
+def build_chain(n):
+    comp = Comp(AppendOp("0"), (), "x")
+    for i in range(1, n):
+        comp = Comp(AppendOp(str(i % 3)), (comp,), "x")
+    return comp
+
+
+class CountingLog(boyleworkflow.Log):
+    lookups = 0
+
+    def get_result(self, calc, loc):
+        self.lookups += 1
+        return super().get_result(calc, loc)
+
+
+def test_planning_is_linear_on_chain(storage):
+    n = 300
+    leaf = build_chain(n)
+
+    with tempfile.TemporaryDirectory() as td:
+        log = CountingLog(os.path.join(td, "log.db"))
+
+        results = boyleworkflow.make([leaf], log, storage)
+        content = restore_and_read(results[leaf], storage)
+        assert len(content.splitlines()) == n
+
+        # Every comp is looked up once when it becomes concrete.
+        assert log.lookups <= n
+
+        log.lookups = 0
+        assert boyleworkflow.make([leaf], log, storage) == results
+        assert log.lookups <= n
+
+        log.close()
+
+
+def test_rerun_when_not_restorable(log, storage):
+    leaf = build_chain(5)
+    results = boyleworkflow.make([leaf], log, storage)
+
+    # Remove everything from the storage: all of it must be rerun.
+    for dir_path, _, file_names in os.walk(storage.storage_dir):
+        for name in file_names:
+            os.remove(os.path.join(dir_path, name))
+    assert not storage.can_restore(results[leaf])
+
+    assert boyleworkflow.make([leaf], log, storage) == results
+    assert storage.can_restore(results[leaf])
+
+
+def test_plan(log, storage):
+    leaf = build_chain(4)
+    first, second, third, _ = get_upstream_sorted([leaf])
+
+    # Nothing has been run, so there is no estimate.
+    plan = boyleworkflow.plan([leaf], log, storage)
+    assert plan.restorable == set()
+    assert plan.calcs == {log.get_calc(first)}
+    assert plan.pending == {second, third, leaf}
+    assert plan.estimated_duration == datetime.timedelta()
+    assert plan.unestimated_runs == 4
+
+    boyleworkflow.make([second], log, storage)
+
+    # Pretend that all runs took a minute, then plan again.
+    log.conn.execute(
+        "UPDATE run SET end_time = "
+        "strftime('%Y-%m-%dT%H:%M:%f', start_time, '+60 seconds')"
+    )
+
+    plan = boyleworkflow.plan([leaf], log, storage)
+    assert plan.restorable == {first, second}
+    assert plan.calcs == {log.get_calc(third)}
+    assert plan.pending == {leaf}
+
+    # The op of the third step ("2") has not been run, but the one of
+    # the last step ("0") has.
+    assert plan.estimated_duration == datetime.timedelta(minutes=1)
+    assert plan.total_duration == datetime.timedelta(minutes=1)
+    assert plan.critical_path == datetime.timedelta(minutes=1)
+    assert plan.unestimated_runs == 1
+
+
+def test_plan_with_jobs(log, storage):
+    slow = Comp(AppendOp("slow"), (), "x")
+    other = Comp(AppendOp("other"), (), "x")
+    chain = Comp(AppendOp("chain 0"), (), "x")
+    for i in range(1, 3):
+        chain = Comp(AppendOp(f"chain {i}"), (chain,), "x")
+    requested = [slow, other, chain]
+
+    # Record earlier runs of the ops, with some other inputs.
+    t = datetime.datetime(2000, 1, 1)
+    for comp in get_upstream_sorted(requested):
+        duration = datetime.timedelta(seconds=10 if comp is slow else 4)
+        calc = Calc(comp.op, [Result("y", "some digest")])
+        result = Result("x", "some other digest")
+        log.save_run(calc, [result], t, t + duration)
+
+    def estimate(jobs):
+        plan = boyleworkflow.plan(requested, log, storage, jobs=jobs)
+        assert plan.total_duration == datetime.timedelta(seconds=26)
+        assert plan.critical_path == datetime.timedelta(seconds=12)
+        return plan.estimated_duration.total_seconds()
+
+    assert estimate(1) == 26
+    # The chain and the slow step first, then the other step.
+    assert estimate(2) == 14
+    assert estimate(3) == 12
+
+
+def test_critical_path_first():
+    # A long chain and a few independent short steps, which come first
+    # in the requested order and would therefore be started first.
+    short_steps = [Comp(AppendOp(f"short {i}"), (), "x") for i in range(3)]
+    chain = Comp(AppendOp("chain 0"), (), "x")
+    for i in range(1, 3):
+        chain = Comp(AppendOp(f"chain {i}"), (chain,), "x")
+    requested = short_steps + [chain]
+
+    durations = {comp.op: 1 for comp in get_upstream_sorted(requested)}
+
+    assert simulate_makespan(requested, durations, 2, prioritize=False) == 4
+    assert simulate_makespan(requested, durations, 2) == 3
+
+
+def test_priorities_use_recorded_durations(log, storage):
+    slow = Comp(AppendOp("slow"), (), "x")
+    fast = Comp(AppendOp("fast"), (), "x")
+    merged = Comp(AppendOp("merged"), (fast,), "x")
+
+    # Record earlier runs of the ops, with some other inputs.
+    t = datetime.datetime(2000, 1, 1)
+    for comp, seconds in [(slow, 10), (fast, 2)]:
+        duration = datetime.timedelta(seconds=seconds)
+        calc = Calc(comp.op, [Result("y", "some digest")])
+        result = Result("x", "some other digest")
+        log.save_run(calc, [result], t, t + duration)
+
+    scheduler = Scheduler([merged, slow], log, storage)
+    assert scheduler.priorities[slow] == 10
+    assert scheduler.priorities[fast] == 2 + 1
+    assert scheduler.pop_ready()[0].op == slow.op
+
+
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_make_async(log, storage):
+    n = 16
+
+    with tempfile.TemporaryDirectory() as barrier_dir:
+        # As in test_parallel_make, only finishes if all steps are in
+        # progress at the same time.
+        wait_for_all = (
+            f"touch {barrier_dir}/$STEP && "
+            f"timeout 10 sh -c "
+            f"'until [ $(ls {barrier_dir} | wc -l) -ge {n} ]; "
+            f"do sleep 0.01; done'"
+        )
+
+        steps = [
+            shell_comp(f"STEP={i} && {wait_for_all} && echo {i} > out")
+            for i in range(n)
+        ]
+
+        # Renames have a native run_async(), AppendOp uses the default.
+        renamed = [
+            Comp(RenameOp("out", "x"), [step], "x") for step in steps
+        ]
+        appended = [Comp(AppendOp("end"), [r], "x") for r in renamed]
+
+        results = run_async(
+            boyleworkflow.make_async(appended, log, storage, jobs=n)
+        )
+
+    for i, comp in enumerate(appended):
+        assert restore_and_read(results[comp], storage) == f"{i}\nend\n"
+
+    # Everything is recorded as usual.
+    assert boyleworkflow.make(appended, log, storage) == results
+
+
+def test_make_async_failing_run(log, storage):
+    failing = shell_comp("exit 1")
+
+    with pytest.raises(RunError):
+        run_async(boyleworkflow.make_async([failing], log, storage))
+
+
+@pytest.mark.parametrize("loc", ["out", "../stdout"])
+def test_make_async_cancelled(log, storage, loc):
+    with tempfile.TemporaryDirectory() as td:
+        marker = os.path.join(td, "marker")
+        slow = shell_comp(f"sleep 1 && touch {marker} && echo > out", loc=loc)
+
+        with pytest.raises(asyncio.TimeoutError):
+            run_async(
+                asyncio.wait_for(
+                    boyleworkflow.make_async([slow], log, storage), 0.2
+                )
+            )
+
+        # The process was killed, not left running.
+        time.sleep(1.5)
+        assert not os.path.exists(marker)
+
+    # Nothing was recorded, and the log can still be used.
+    plan = boyleworkflow.plan([slow], log, storage)
+    assert plan.calcs == {log.get_calc(slow)}
+
+
+def test_directory_outputs(log, storage):
+    shards = shell_comp(
+        "mkdir -p out/sub && "
+        "for i in 1 2 3; do echo $i > out/$i; done && "
+        "echo 1 > out/sub/1"
+    )
+    summary = shell_comp(
+        "cat shards/1 shards/2 shards/3 shards/sub/1 > out",
+        [Comp(RenameOp("out", "shards"), [shards], "shards")],
+    )
+
+    results = boyleworkflow.make([shards, summary], log, storage)
+
+    assert results[shards].startswith("tree-")
+    assert restore_and_read(results[summary], storage) == "1\n2\n3\n1\n"
+
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "restored")
+        storage.restore(results[shards], path)
+        assert sorted(os.listdir(path)) == ["1", "2", "3", "sub"]
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_captured_outputs(log, storage, use_async):
+    # Enough output to fill the pipes, on both stdout and stderr.
+    cmd = "yes out | head -c 1000000; yes err | head -c 1000000 >&2"
+    comps = [
+        shell_comp(f"{cmd}; echo {use_async} > out", loc=loc)
+        for loc in ["out", "../stdout", "../stderr"]
+    ]
+
+    if use_async:
+        results = run_async(boyleworkflow.make_async(comps, log, storage))
+    else:
+        results = boyleworkflow.make(comps, log, storage)
+
+    out, stdout, stderr = [
+        restore_and_read(results[comp], storage) for comp in comps
+    ]
+    assert out == f"{use_async}\n"
+    assert stdout == ("out\n" * 250000)[:1000000]
+    assert stderr == ("err\n" * 250000)[:1000000]
+    assert not [
+        name for name in os.listdir(storage.storage_dir)
+        if name.endswith(".tmp")
+    ]
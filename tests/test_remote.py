@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `boyleworkflow` package."""
+
+import tempfile
+import shutil
+import os
+
+import pytest
+
+import boyleworkflow
+from boyleworkflow.core import Comp
+from boyleworkflow.ops import ShellOp, RenameOp
+from boyleworkflow.remote import DirectoryRemote
+from boyleworkflow.storage import Storage, RestoreError
+
+
+@pytest.fixture
+def temp_dir(request):
+
+    temp_dir = tempfile.mkdtemp()
+
+    def fin():
+        shutil.rmtree(temp_dir)
+
+    request.addfinalizer(fin)
+
+    return temp_dir
+
+
+def make_storage(temp_dir, name, **kwargs):
+    remote = DirectoryRemote(os.path.join(temp_dir, 'remote'))
+    return Storage(os.path.join(temp_dir, name), remote=remote, **kwargs)
+
+
+def write_files(root, files):
+    for name, content in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+
+def read_restored(storage, digest, name=''):
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, 'restored')
+        storage.restore(digest, path)
+        if name:
+            path = os.path.join(path, name)
+        with open(path, 'r') as f:
+            return f.read()
+
+
+def test_upload_and_fetch(temp_dir):
+    local = make_storage(temp_dir, 'local', chunk_size=64)
+    other = make_storage(temp_dir, 'other')
+
+    with tempfile.TemporaryDirectory() as td:
+        write_files(td, {
+            'a': 'content a',
+            'sub/b': 'content b',
+            'large': 'x' * 1000,
+        })
+        tree = local.store(td)
+        large = local.store(os.path.join(td, 'large'))
+
+    assert not other.can_restore(tree)
+
+    local.upload_async([tree])
+    local.wait_for_uploads()
+    assert local.uploads.uploaded == 1
+    assert local.uploads.failed == 0
+
+    # Only the tree listings are downloaded to check the tree.
+    assert other.can_restore_many([tree, large]) == {tree: True, large: True}
+    assert not other._is_hot(large)
+
+    assert other.prefetch([tree]) == 3
+    assert other.prefetch([tree]) == 0
+    assert other._is_hot(large)
+
+    assert read_restored(other, large) == 'x' * 1000
+    assert read_restored(other, tree, 'sub/b') == 'content b'
+
+
+def test_wrong_remote_contents(temp_dir):
+    local = make_storage(temp_dir, 'local')
+    other = make_storage(temp_dir, 'other')
+
+    with tempfile.TemporaryDirectory() as td:
+        write_files(td, {'a': 'content a'})
+        digest = local.store(os.path.join(td, 'a'))
+
+    local.upload_async([digest])
+    local.wait_for_uploads()
+
+    remote_path = local.remote._get_path(digest)
+    os.chmod(remote_path, 0o644)
+    with open(remote_path, 'w') as f:
+        f.write('content x')
+
+    with pytest.raises(RestoreError):
+        read_restored(other, digest)
+    assert not other._get_kinds(digest)
+
+
+def test_store_after_upload(temp_dir):
+    local = make_storage(temp_dir, 'local')
+    other = make_storage(temp_dir, 'other')
+
+    with tempfile.TemporaryDirectory() as td:
+        write_files(td, {'a': 'content a'})
+        digest = other.store(os.path.join(td, 'a'))
+        other.upload_async([digest])
+        other.wait_for_uploads()
+
+        # The same content, made here too, is kept here, without asking
+        # the remote.
+        lookups = []
+        has_many = local.remote.has_many
+        local.remote.has_many = lambda d: lookups.append(d) or has_many(d)
+        assert local.store(os.path.join(td, 'a')) == digest
+        assert lookups == []
+
+    assert local._get_kinds(digest)
+    shutil.rmtree(os.path.join(temp_dir, 'remote'))
+    assert read_restored(local, digest) == 'content a'
+
+
+def shell_comp(cmd, parent=None):
+    parents = [Comp(RenameOp('out', 'in'), [parent], 'in')] if parent else []
+    return Comp(ShellOp(cmd, shell=True), parents, 'out')
+
+
+def test_make_with_remote(temp_dir):
+    log = boyleworkflow.Log(os.path.join(temp_dir, 'log.db'))
+    counter_path = os.path.join(temp_dir, 'counter')
+
+    first = shell_comp(f'echo run >> {counter_path}; echo 1 > out')
+    second = shell_comp('cat in > out; echo 2 >> out', first)
+    third = shell_comp('cat in > out; echo 3 >> out', second)
+
+    boyleworkflow.make([second], log, make_storage(temp_dir, 'local'))
+
+    # With the same log and remote, only the new calc is run, with its
+    # input from the remote.
+    other = make_storage(temp_dir, 'other')
+    results = boyleworkflow.make([third], log, other)
+    with open(counter_path, 'r') as f:
+        assert f.read() == 'run\n'
+    assert read_restored(other, results[third]) == '1\n2\n3\n'
+    assert other._is_hot(log.get_result(log.get_calc(second), 'out').digest)
+
+    log.close()
@@ -7,6 +7,11 @@ import tempfile
 import shutil
 import os
 import time
+import io
+import hashlib
+import pickle
+import datetime
+import errno
 
 import pytest
 
@@ -14,8 +19,11 @@ from click.testing import CliRunner
 
 import boyleworkflow
 from boyleworkflow import cli
-from boyleworkflow.util import set_file_permissions
-from boyleworkflow.storage import Storage
+from boyleworkflow import util, digest_cache, chunking, placement
+from boyleworkflow.util import set_file_permissions, digest_file, split_digest
+from boyleworkflow.storage import Storage, RestoreError, CODECS
+from boyleworkflow.storage import HOT, COLD, PACKED, CHUNKED
+from boyleworkflow.packs import NEW_PACK_SUFFIX, PackWriter, open_unused
 
 
 @pytest.fixture
@@ -162,4 +170,667 @@ def test_modify(storage):
 
             storage.store(orig_path)
 
-        assert storage.can_restore(digest)
\ No newline at end of file
+        assert storage.can_restore(digest)
+
+
+def store_content(storage, content):
+    with tempfile.TemporaryDirectory() as td:
+        p = os.path.join(td, 'my_file')
+        with open(p, 'w') as f:
+            f.write(content)
+        return storage.store(p)
+
+
+def restore_content(storage, digest):
+    with tempfile.TemporaryDirectory() as td:
+        p = os.path.join(td, 'restored')
+        storage.restore(digest, p)
+        with open(p, 'r') as f:
+            return f.read()
+
+
+def test_sharded_layout(storage):
+    digest = store_content(storage, 'abc')
+
+    assert storage.shard_depth == 2
+    assert os.path.isfile(
+        os.path.join(storage.storage_dir, digest[:2], digest[2:4], digest)
+    )
+
+    # The layout is recorded, so the store can be opened without it.
+    assert Storage(storage.storage_dir).shard_depth == 2
+    with pytest.raises(ValueError):
+        Storage(storage.storage_dir, shard_depth=1)
+
+
+def test_migrate_layout():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        # A store from before sharding has a meta dir but no layout file.
+        os.makedirs(os.path.join(storage_dir, 'meta'))
+        flat = Storage(storage_dir)
+        assert flat.shard_depth == 0
+
+        contents = [f'content {i}' for i in range(20)]
+        digests = [store_content(flat, c) for c in contents]
+        assert os.path.isfile(os.path.join(storage_dir, digests[0]))
+
+        sharded = Storage(storage_dir)
+        assert sharded.migrate_layout(3) == len(digests)
+        assert sharded.migrate_layout(3) == 0
+
+        reopened = Storage(storage_dir)
+        assert reopened.shard_depth == 3
+        for digest, content in zip(digests, contents):
+            assert restore_content(reopened, digest) == content
+
+        # The old store object no longer finds anything.
+        assert not flat.can_restore(digests[0])
+
+        # Migrate back through the command line.
+        runner = CliRunner()
+        result = runner.invoke(
+            cli.main, ['migrate-storage', storage_dir, '--shard-depth', '0']
+        )
+        assert result.exit_code == 0, result.output
+        assert sorted(os.listdir(storage_dir)) == sorted(
+            digests + ['meta', 'cache', 'layout.json']
+        )
+        assert restore_content(Storage(storage_dir), digests[0]) == contents[0]
+
+
+def test_digest_algorithm():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        storage = Storage(storage_dir, digest_algorithm='blake2b')
+        digest = store_content(storage, 'abc')
+
+        algorithm, hex_digest = split_digest(digest)
+        assert algorithm == 'blake2b'
+        assert hex_digest == hashlib.blake2b(b'abc').hexdigest()
+        assert os.path.isfile(
+            os.path.join(storage_dir, hex_digest[:2], hex_digest[2:4], digest)
+        )
+        assert restore_content(storage, digest) == 'abc'
+
+        # Old (SHA-1) digests can still be restored.
+        sha1_digest = store_content(Storage(storage_dir), 'abc')
+        assert sha1_digest == hashlib.sha1(b'abc').hexdigest()
+        assert restore_content(storage, sha1_digest) == 'abc'
+
+    with pytest.raises(ValueError):
+        Storage(storage_dir, digest_algorithm='no such algorithm')
+
+
+@pytest.mark.parametrize('size', [0, 1, 1000, 3 << 20])
+def test_digest_file(size, monkeypatch):
+    content = os.urandom(size)
+    with tempfile.TemporaryDirectory() as td:
+        p = os.path.join(td, 'my_file')
+        with open(p, 'wb') as f:
+            f.write(content)
+
+        expected = hashlib.sha256(content).hexdigest()
+        assert digest_file(p, 'sha256') == 'sha256-' + expected
+
+        # Also through a memory map.
+        monkeypatch.setattr(util, '_MMAP_THRESHOLD', 1)
+        assert digest_file(p, 'sha256') == 'sha256-' + expected
+
+
+def test_store_many(storage):
+    contents = [f'content {i}' for i in range(10)] + ['content 0']
+    with tempfile.TemporaryDirectory() as td:
+        paths = []
+        for i, content in enumerate(contents):
+            p = os.path.join(td, f'file {i}')
+            with open(p, 'w') as f:
+                f.write(content)
+            paths.append(p)
+
+        digests = storage.store_many(paths, max_workers=4)
+
+    assert digests[0] == digests[-1]
+    for digest, content in zip(digests, contents):
+        assert restore_content(storage, digest) == content
+
+
+def test_digest_cache(storage, monkeypatch):
+    # Do not wait for the files to become old enough to be cached.
+    monkeypatch.setattr(digest_cache, '_RACY_SECONDS', 0)
+    cache = storage.digest_cache
+
+    with tempfile.TemporaryDirectory() as td:
+        p = os.path.join(td, 'my_file')
+        with open(p, 'w') as f:
+            f.write('abc')
+
+        digest = storage.store(p)
+        assert (cache.hits, cache.misses) == (0, 1)
+
+        # Not hashed again, also not through a new Storage object.
+        hashed = []
+        monkeypatch.setattr(
+            boyleworkflow.storage,
+            'digest_file',
+            lambda *args: hashed.append(args) or digest_file(*args),
+        )
+        assert storage.store(p) == digest
+        reopened = Storage(storage.storage_dir)
+        assert reopened.store(p) == digest
+        assert hashed == []
+        assert cache.hits == 1
+        assert reopened.digest_cache.hits == 1
+
+        # A modified file is hashed again.
+        set_file_permissions(p, write=True)
+        with open(p, 'a') as f:
+            f.write('d')
+        new_digest = storage.store(p)
+        assert len(hashed) == 1
+        assert new_digest != digest
+        assert restore_content(storage, new_digest) == 'abcd'
+        assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_digest_cache_skips_recent_files(storage):
+    with tempfile.TemporaryDirectory() as td:
+        p = os.path.join(td, 'my_file')
+        with open(p, 'w') as f:
+            f.write('abc')
+
+        # Just written, so it could still change without a new mtime.
+        storage.store(p)
+        storage.store(p)
+        assert storage.digest_cache.hits == 0
+
+
+def test_storage_pickle(storage):
+    # Also with an open connection to the digest cache.
+    store_content(storage, 'abc')
+    copy = pickle.loads(pickle.dumps(storage))
+    assert copy == storage
+    assert copy.digest_cache.path == storage.digest_cache.path
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_compress_cold(storage, codec):
+    content = 'abc\n' * 1000
+    digest = store_content(storage, content)
+
+    # Recently used objects are not compressed.
+    report = storage.compress_cold(datetime.timedelta(days=1), codec)
+    assert report.objects == 0
+
+    report = storage.compress_cold(datetime.timedelta(), codec)
+    assert report.objects == 1
+    assert report.bytes_before == len(content)
+    assert 0 < report.bytes_after < report.bytes_before
+    assert report.bytes_saved == report.bytes_before - report.bytes_after
+    usage = storage.get_usage()
+    assert usage[HOT] == (0, 0)
+    assert usage[COLD] == (1, report.bytes_after)
+
+    assert storage.can_restore(digest)
+    assert restore_content(storage, digest) == content
+    assert restore_content(storage, digest) == content
+    assert storage.restore_stats.counts[HOT] == 1
+    assert storage.restore_stats.counts[COLD] == 1
+    assert storage.restore_stats.mean_seconds(COLD) > 0
+
+    # Both tiers now have the object, until compressed again.
+    assert storage.get_usage()[HOT] == (1, len(content))
+    report = storage.compress_cold(datetime.timedelta(), codec)
+    assert report.objects == 1
+    assert storage.get_usage()[HOT] == (0, 0)
+
+    # Compressed objects can be migrated.
+    storage.migrate_layout(1)
+    assert restore_content(storage, digest) == content
+
+
+def test_compress_cold_detects_modification(storage):
+    digest = store_content(storage, 'abc')
+    storage.compress_cold(datetime.timedelta())
+
+    # Pretend the compressed file was modified.
+    (cold_path,) = [
+        path for _, path in storage._iter_objects() if path != digest
+    ]
+    os.utime(cold_path, ns=(0, 0))
+
+    assert not storage.can_restore(digest)
+    with pytest.raises(RestoreError):
+        restore_content(storage, digest)
+
+
+def write_tree(root, files):
+    for rel_path, content in files.items():
+        path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+
+def read_tree(root):
+    files = {}
+    for dir_path, _, file_names in os.walk(root):
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            with open(path, 'r') as f:
+                files[os.path.relpath(path, root)] = f.read()
+    return files
+
+
+def test_store_tree(storage):
+    files = {
+        'a': 'content a',
+        'b': 'content b',
+        os.path.join('sub', 'a'): 'content a',
+        os.path.join('sub', 'deeper', 'c'): 'content c',
+        os.path.join('other', 'a'): 'content a',
+    }
+
+    with tempfile.TemporaryDirectory() as td:
+        src = os.path.join(td, 'src')
+        write_tree(src, files)
+        os.makedirs(os.path.join(src, 'empty'))
+        digest = storage.store(src)
+
+        # The same contents give the same digest.
+        copy = os.path.join(td, 'copy')
+        write_tree(copy, files)
+        os.makedirs(os.path.join(copy, 'empty'))
+        assert storage.store(copy) == digest
+
+    assert util.is_tree_digest(digest)
+    assert storage.can_restore(digest)
+
+    # Each distinct file is stored once.
+    file_digests = {
+        d for d, _ in storage._iter_objects() if not util.is_tree_digest(d)
+    }
+    assert len(file_digests) == 3
+
+    with tempfile.TemporaryDirectory() as td:
+        dst = os.path.join(td, 'restored')
+        storage.restore(digest, dst)
+        assert read_tree(dst) == files
+        assert os.listdir(os.path.join(dst, 'empty')) == []
+
+    # A tree with a missing file cannot be restored.
+    (c_digest,) = [
+        d for d in file_digests
+        if restore_content(storage, d) == 'content c'
+    ]
+    os.remove(storage._get_store_path(c_digest))
+    assert not storage.can_restore(digest)
+    with tempfile.TemporaryDirectory() as td:
+        with pytest.raises(RestoreError):
+            storage.restore(digest, os.path.join(td, 'restored'))
+
+
+def test_chunking_is_content_defined():
+    content = os.urandom(1 << 18)
+    chunks = list(chunking.iter_chunks(io.BytesIO(content), 1 << 12))
+    assert b''.join(chunks) == content
+    assert all(len(c) <= 1 << 14 for c in chunks)
+
+    # Inserting some bytes only changes the chunks near the insertion.
+    changed = content[:100000] + b'inserted' + content[100000:]
+    changed_chunks = list(chunking.iter_chunks(io.BytesIO(changed), 1 << 12))
+    assert b''.join(changed_chunks) == changed
+    assert len(set(chunks) - set(changed_chunks)) <= 2
+
+
+def test_chunked_storage():
+    chunk_size = 1 << 12
+    content = os.urandom(1 << 18)
+    versions = [
+        content,
+        content[:100000] + b'inserted' + content[100000:],
+        content[:200000] + content[200100:],
+    ]
+
+    with tempfile.TemporaryDirectory() as storage_dir:
+        storage = Storage(storage_dir, chunk_size=chunk_size)
+
+        digests = []
+        for version in versions:
+            with tempfile.TemporaryDirectory() as td:
+                p = os.path.join(td, 'my_file')
+                with open(p, 'wb') as f:
+                    f.write(version)
+                digests.append(storage.store(p))
+
+        # The digests are of the whole files.
+        assert digests[0] == hashlib.sha1(content).hexdigest()
+
+        # The versions share most of their chunks.
+        usage = storage.get_usage()
+        assert usage[CHUNKED][0] == 3
+        assert usage[HOT][1] < 1.2 * len(content)
+
+        for digest, version in zip(digests, versions):
+            assert storage.can_restore(digest)
+            with tempfile.TemporaryDirectory() as td:
+                p = os.path.join(td, 'restored')
+                storage.restore(digest, p)
+                with open(p, 'rb') as f:
+                    assert f.read() == version
+        assert storage.restore_stats.counts[CHUNKED] == 3
+
+        # All chunks are reachable from the chunked files.
+        closure = storage.get_closure(digests)
+        assert {d for d, _ in storage._iter_objects()} == closure
+
+        # Small files are not chunked.
+        assert storage.get_usage()[HOT][0] == len(closure) - 3
+        store_content(storage, 'abc')
+        assert storage.get_usage()[HOT][0] == len(closure) - 2
+
+        # A missing chunk is noticed.
+        chunk = next(d for d in closure if d not in digests)
+        os.remove(storage._get_store_path(chunk))
+        assert not all(storage.can_restore(d) for d in digests)
+
+
+def test_placement_across_file_systems(storage, monkeypatch):
+    link_calls = []
+
+    def cross_device_link(src, dst):
+        link_calls.append(dst)
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(placement.os, 'link', cross_device_link)
+
+    digests = [store_content(storage, f'content {i}') for i in range(3)]
+    for i, digest in enumerate(digests):
+        assert restore_content(storage, digest) == f'content {i}'
+
+    # Hardlinks are only tried once for each pair of file systems.
+    assert len(link_calls) <= 2
+    counts = storage.placer.counts
+    assert sum(n for (op, _), n in counts.items() if op == 'store') == 3
+    assert sum(n for (op, _), n in counts.items() if op == 'restore') == 3
+    assert counts[('store', placement.HARDLINK)] == 0
+
+    # Copies are read-only like the stored objects.
+    with tempfile.TemporaryDirectory() as td:
+        p = os.path.join(td, 'restored')
+        storage.restore(digests[0], p)
+        assert not any(util.get_file_permissions(p)['write'])
+        assert storage.can_restore(digests[0])
+
+
+def test_placement_link_not_permitted(storage, monkeypatch):
+    link = os.link
+    link_calls = []
+
+    def protected_link(src, dst):
+        # E.g., fs.protected_hardlinks on a file of another user.
+        link_calls.append(dst)
+        if len(link_calls) == 1:
+            raise OSError(errno.EPERM, os.strerror(errno.EPERM))
+        link(src, dst)
+
+    monkeypatch.setattr(placement.os, 'link', protected_link)
+
+    digest = store_content(storage, 'content')
+    assert restore_content(storage, digest) == 'content'
+
+    # Only the first file is copied.
+    counts = storage.placer.counts
+    assert counts[('store', placement.HARDLINK)] == 0
+    assert counts[('restore', placement.HARDLINK)] == 1
+    assert len(link_calls) == 2
+
+
+@pytest.mark.parametrize('name', [n for n, _ in placement.STRATEGIES])
+def test_placement_strategies(name, monkeypatch):
+    names = [n for n, _ in placement.STRATEGIES]
+    strategies = placement.STRATEGIES[names.index(name):]
+    monkeypatch.setattr(placement, 'STRATEGIES', strategies)
+
+    with tempfile.TemporaryDirectory() as td:
+        src = os.path.join(td, 'src')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(3 << 20))
+        os.chmod(src, 0o500)
+
+        placer = placement.Placer()
+        dst = os.path.join(td, 'dst')
+        used = placer.place(src, dst, 'test')
+
+        with open(src, 'rb') as f1, open(dst, 'rb') as f2:
+            assert f1.read() == f2.read()
+        assert os.stat(dst).st_mode == os.stat(src).st_mode
+        assert placer.counts == {('test', used): 1}
+
+
+def test_import_markers():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        # A store from before the index, with a marker for each object
+        # that has the mtime of the object.
+        meta_dir = os.path.join(storage_dir, 'meta')
+        os.makedirs(meta_dir)
+        digests = []
+        for content in ['kept', 'modified', 'markerless']:
+            digest = hashlib.sha1(content.encode()).hexdigest()
+            path = os.path.join(storage_dir, digest)
+            with open(path, 'w') as f:
+                f.write(content)
+            if content != 'markerless':
+                shutil.copy2(path, os.path.join(meta_dir, digest))
+            digests.append(digest)
+
+        os.utime(os.path.join(storage_dir, digests[1]), (0, 0))
+
+        storage = Storage(storage_dir)
+        assert storage.can_restore_many(digests) == {
+            digests[0]: True,
+            digests[1]: False,
+            digests[2]: False,
+        }
+        assert restore_content(storage, digests[0]) == 'kept'
+        assert all(
+            name.startswith('index.db') for name in os.listdir(meta_dir)
+        )
+
+
+def test_can_restore_many(storage):
+    with tempfile.TemporaryDirectory() as td:
+        write_tree(td, {'a': 'content a', 'sub/b': 'content b'})
+        tree = storage.store(td)
+        file_digest = storage.store(os.path.join(td, 'a'))
+
+    absent = hashlib.sha1(b'absent').hexdigest()
+    digests = [tree, file_digest, absent]
+    assert storage.can_restore_many(digests) == {
+        tree: True,
+        file_digest: True,
+        absent: False,
+    }
+
+    # Replacing an object is detected even with the same size and mtime.
+    path = storage._get_store_path(file_digest)
+    stat = os.stat(path)
+    with open(path + '.new', 'w') as f:
+        f.write('content x')
+    os.utime(path + '.new', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(path + '.new', path)
+
+    fresh = Storage(storage.storage_dir)
+    for s in [storage, fresh]:
+        assert s.can_restore_many(digests) == {
+            tree: False,
+            file_digest: False,
+            absent: False,
+        }
+
+
+def test_open_writer(storage):
+    with storage.open_writer() as writer:
+        writer.write(b'abc')
+        writer.write(memoryview(b'def'))
+
+    assert writer.digest == store_content(storage, 'abcdef')
+    assert restore_content(storage, writer.digest) == 'abcdef'
+
+    with pytest.raises(ValueError):
+        with storage.open_writer() as writer:
+            writer.write(b'discarded')
+            raise ValueError()
+    assert writer.digest is None
+
+    digest = storage.store_stream(io.BytesIO(b'x' * (3 << 20)))
+    assert restore_content(storage, digest) == 'x' * (3 << 20)
+
+    # Only the objects are left.
+    assert not [
+        name for name in os.listdir(storage.storage_dir)
+        if name.endswith('.tmp')
+    ]
+    assert len(list(storage._iter_objects())) == 2
+
+
+def test_packfiles():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        storage = Storage(storage_dir, pack_threshold=1000)
+
+        large = 'x' * 1000
+        with tempfile.TemporaryDirectory() as td:
+            write_tree(td, {'a': 'small a', 'b': 'small b', 'c': large})
+            tree = storage.store(td)
+        small = store_content(storage, 'small a')
+        other = store_content(storage, 'small c')
+
+        # The small files and the listing are packed, in a single pack.
+        usage = storage.get_usage()
+        assert usage[PACKED][0] == 4
+        assert usage[HOT] == (1, len(large))
+        assert len(os.listdir(os.path.join(storage_dir, 'packs'))) == 1
+        assert not os.path.exists(storage._get_store_path(small))
+
+        assert storage.can_restore_many([tree, small]) == {
+            tree: True, small: True
+        }
+        assert storage.read_bytes(small) == b'small a'
+        assert restore_content(storage, small) == 'small a'
+        assert storage.restore_stats.counts[PACKED] == 1
+        with tempfile.TemporaryDirectory() as td:
+            p = os.path.join(td, 'restored')
+            storage.restore(tree, p)
+            assert read_tree(p) == {'a': 'small a', 'b': 'small b', 'c': large}
+
+        # Another process finds the objects, through its own writer.
+        copy = pickle.loads(pickle.dumps(storage))
+        assert copy.read_bytes(small) == b'small a'
+        assert store_content(copy, 'small d')
+
+        # Removed objects stay in the pack until it is compacted.
+        keep = storage.get_closure([tree])
+        report = storage.sweep(keep, datetime.timedelta())
+        assert report.objects_removed == 2
+        assert not storage.can_restore(other)
+
+        # Few of the bytes are removed.
+        assert storage.repack().packs == 0
+
+        # Packs that other processes write to are skipped.
+        report = storage.repack(max_garbage=0)
+        assert report.packs == 1
+        assert report.objects == 3
+        assert report.bytes_freed == len('small c')
+        copy.packs.close()
+        # The pack of the copy has no objects left, but is new.
+        assert storage.repack(max_garbage=0).packs == 0
+        report = storage.repack(max_garbage=0, min_age=datetime.timedelta())
+        assert report.packs == 1
+        assert report.objects == 0
+        assert report.bytes_freed == len('small d')
+        assert len(os.listdir(os.path.join(storage_dir, 'packs'))) == 1
+
+        # The copy reads the objects from their new pack.
+        assert copy.read_bytes(small) == b'small a'
+        assert restore_content(storage, small) == 'small a'
+
+        # Packed objects are checked when read.
+        pack, offset, size = storage.index.get_packed([small])[small]
+        path = os.path.join(storage_dir, 'packs', pack)
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            f.write(b'X')
+        with pytest.raises(RestoreError):
+            restore_content(storage, small)
+
+        runner = CliRunner()
+        result = runner.invoke(
+            cli.main, ['repack', storage_dir, '--max-garbage', '0']
+        )
+        assert result.exit_code == 0, result.output
+        assert 'Compacted 0 packs' in result.output
+
+
+def assert_keeps_existing(storage, digest):
+    # Restoring onto an existing file fails, and leaves the file alone.
+    with tempfile.TemporaryDirectory() as td:
+        p = os.path.join(td, 'existing')
+        with open(p, 'w') as f:
+            f.write('existing')
+        with pytest.raises(FileExistsError):
+            storage.restore(digest, p)
+        with open(p, 'r') as f:
+            assert f.read() == 'existing'
+
+
+def test_restore_onto_existing(storage):
+    assert_keeps_existing(storage, store_content(storage, 'hot'))
+
+
+def test_restore_packed_onto_existing():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        storage = Storage(storage_dir, pack_threshold=4096)
+        digest = store_content(storage, 'packed')
+        assert storage._get_kinds(digest) == [PACKED]
+        assert_keeps_existing(storage, digest)
+
+
+def test_restore_chunked_onto_existing():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        storage = Storage(storage_dir, chunk_size=1024)
+        digest = store_content(storage, 'chunked' * 1000)
+        assert storage._get_kinds(digest) == [CHUNKED]
+        assert_keeps_existing(storage, digest)
+
+
+def test_new_packs():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        storage = Storage(storage_dir, pack_threshold=1000)
+        pack_dir = os.path.join(storage_dir, 'packs')
+        writer = PackWriter(pack_dir)
+
+        # Objects are recorded while their pack is locked.
+        def record(pack, offset):
+            assert open_unused(os.path.join(pack_dir, pack)) is None
+            recorded.append((pack, offset))
+
+        recorded = []
+        pack, _ = writer.append(b'data', record)
+        assert recorded == [(pack, 0)]
+        assert os.listdir(pack_dir) == [pack]
+
+        # New packs that are empty or not in the index are kept.
+        writer.close()
+        writer.append(b'')
+        writer.close()
+        assert storage.repack(max_garbage=0).packs == 0
+        assert len(os.listdir(pack_dir)) == 2
+
+        # Packs that were never named are left by failed writers.
+        stale = os.path.join(pack_dir, 'pack-stale' + NEW_PACK_SUFFIX)
+        open(stale, 'wb').close()
+        storage.repack(max_garbage=0)
+        assert os.path.exists(stale)
+        for name in os.listdir(pack_dir):
+            os.utime(os.path.join(pack_dir, name), (0, 0))
+        assert storage.repack(max_garbage=0).packs == 2
+        assert os.listdir(pack_dir) == []
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `boyleworkflow` package."""
+
+import tempfile
+import shutil
+import os
+import json
+import datetime
+
+import pytest
+
+from click.testing import CliRunner
+
+import boyleworkflow
+from boyleworkflow import cli
+from boyleworkflow.core import Comp
+from boyleworkflow.ops import ShellOp, RenameOp
+from boyleworkflow.storage import Storage, HOT, PACKED, CHUNKED
+from boyleworkflow.verify import verify_storage, CHECKPOINT_FILE
+
+
+@pytest.fixture
+def temp_dir(request):
+
+    temp_dir = tempfile.mkdtemp()
+
+    def fin():
+        shutil.rmtree(temp_dir)
+
+    request.addfinalizer(fin)
+
+    return temp_dir
+
+
+@pytest.fixture
+def log(request, temp_dir):
+    log = boyleworkflow.Log(os.path.join(temp_dir, "log.db"))
+    request.addfinalizer(log.close)
+    return log
+
+
+@pytest.fixture
+def storage(temp_dir):
+    return Storage(os.path.join(temp_dir, "storage"))
+
+
+def store_content(storage, content):
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "file")
+        with open(path, "wb") as f:
+            f.write(content)
+        return storage.store(path)
+
+
+def corrupt(path, offset=0):
+    # Flip a byte without changing the stat that the index records.
+    stat = os.stat(path)
+    os.chmod(path, 0o644)
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 1]))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def count_runs(log):
+    return log.conn.execute("SELECT COUNT(*) FROM run").fetchone()[0]
+
+
+def test_verify_storage(log, storage):
+    tree = Comp(
+        ShellOp("mkdir out && echo a > out/a && echo b > out/b", shell=True),
+        [],
+        "out",
+    )
+    count = Comp(
+        ShellOp("ls in | wc -l > out", shell=True),
+        [Comp(RenameOp("out", "in"), [tree], "in")],
+        "out",
+    )
+    boyleworkflow.make([tree, count], log, storage)
+    runs = count_runs(log)
+
+    report = verify_storage(storage, log, max_workers=1)
+    assert report.finished
+    assert report.corrupt == ()
+    assert report.objects == len(list(storage.iter_stored_objects()))
+
+    # Corruption that keeps the stat is not noticed otherwise.
+    digest = store_content(storage, b"a\n")
+    corrupt(storage._get_store_path(digest))
+    assert storage.can_restore(digest)
+
+    report = verify_storage(storage, log, max_workers=2)
+    assert report.corrupt == ((digest, HOT),)
+    assert not storage.can_restore(digest)
+    assert os.listdir(os.path.join(storage.storage_dir, "quarantine"))
+
+    # The tree with the file is distrusted (as the output of the comp
+    # and the renaming) and made again, but not the comp that uses it, as
+    # the tree comes out the same.
+    assert report.distrusted == 2
+    results = boyleworkflow.make([count], log, storage)
+    assert count_runs(log) == runs + 2
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "restored")
+        storage.restore(results[count], path)
+        with open(path, "r") as f:
+            assert f.read().strip() == "2"
+
+    # The new run vouches for the result again.
+    boyleworkflow.make([tree, count], log, storage)
+    assert count_runs(log) == runs + 2
+
+
+def test_verify_chunks(temp_dir):
+    storage = Storage(os.path.join(temp_dir, "storage"), chunk_size=1 << 10)
+    missing = store_content(storage, os.urandom(1 << 13))
+    swapped = store_content(storage, os.urandom(1 << 13))
+    assert storage._get_kinds(missing) == [CHUNKED]
+    assert verify_storage(storage, max_workers=1).corrupt == ()
+
+    # A chunk is lost, e.g., quarantined.
+    chunks = storage._read_chunk_index(missing)
+    storage.quarantine(chunks[1], HOT)
+
+    # The chunk list is valid, but not of this file.
+    chunks_path = storage._get_chunks_path(swapped)
+    with open(chunks_path, "r") as f:
+        chunks = json.load(f)["chunks"]
+    os.chmod(chunks_path, 0o644)
+    with open(chunks_path, "w") as f:
+        json.dump({"chunks": chunks[::-1]}, f)
+
+    report = verify_storage(storage, max_workers=1)
+    assert set(report.corrupt) == {(missing, CHUNKED), (swapped, CHUNKED)}
+
+
+def test_verify_throttle(storage, monkeypatch):
+    for i in range(4):
+        store_content(storage, b"content %d" % i)
+
+    sleeps = []
+    monkeypatch.setattr(boyleworkflow.verify.time, "sleep", sleeps.append)
+
+    # Each object read is followed by a pause.
+    report = verify_storage(storage, bytes_per_second=1, max_workers=1)
+    assert len(sleeps) == report.objects == 4
+    assert sleeps == sorted(sleeps)
+
+
+def test_verify_checkpoint(storage):
+    digests = [store_content(storage, b"content %d" % i) for i in range(10)]
+    checkpoint_path = os.path.join(
+        storage.storage_dir, "cache", CHECKPOINT_FILE
+    )
+
+    first = verify_storage(storage, max_workers=1, limit=4)
+    assert (first.objects, first.finished) == (4, False)
+    assert os.path.exists(checkpoint_path)
+
+    second = verify_storage(storage, max_workers=1, limit=4)
+    assert (second.objects, second.finished) == (4, False)
+    third = verify_storage(storage, max_workers=1, limit=4)
+    assert (third.objects, third.finished) == (2, True)
+    assert not os.path.exists(checkpoint_path)
+
+    # Then it starts over, checking every object once per pass.
+    assert verify_storage(storage, max_workers=1).objects == len(digests)
+
+
+def test_verify_kinds(temp_dir):
+    storage_dir = os.path.join(temp_dir, "storage")
+    storage = Storage(storage_dir, chunk_size=1 << 10, pack_threshold=100)
+    packed = store_content(storage, b"small")
+    cold = store_content(storage, b"cold" * 100)
+    chunked = store_content(storage, os.urandom(1 << 14))
+    storage.compress_cold(datetime.timedelta(), codec="gzip")
+    assert storage._get_kinds(chunked) == [CHUNKED]
+
+    pack, offset, _ = storage.index.get_packed([packed])[packed]
+    corrupt(os.path.join(storage_dir, "packs", pack), offset)
+    cold_path = storage._get_compressed_path(cold, "gzip")
+    corrupt(cold_path, os.path.getsize(cold_path) - 8)
+    corrupt(storage._get_chunks_path(chunked), 1)
+
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ["verify", storage_dir])
+    assert result.exit_code == 1, result.output
+    assert "quarantined 3" in result.output
+
+    # Packed objects found before are remembered, so open the store again.
+    storage = Storage(storage_dir, chunk_size=1 << 10, pack_threshold=100)
+    for digest in [packed, cold, chunked]:
+        assert not storage.can_restore(digest)
+    assert PACKED not in storage._get_kinds(packed)
+
+    # The objects can be stored again.
+    assert store_content(storage, b"small") == packed
+    assert storage.can_restore(packed)
+
+    result = runner.invoke(cli.main, ["verify", storage_dir])
+    assert result.exit_code == 0, result.output
+    assert "quarantined 0" in result.output